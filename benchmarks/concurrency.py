@@ -0,0 +1,162 @@
+"""
+Message throughput of many concurrent WebSocket connections by database executor.
+
+Every configuration runs in its own process: the default thread-sensitive
+database_sync_to_async (one shared thread), dedicated executors of
+--workers threads (CHAT_DB_EXECUTOR_WORKERS) and a consumer using Django's
+async ORM (aexists/acreate). --db-latency-ms adds a sleep to every query to
+stand in for the network round trip to Postgres; with BENCHMARK_USE_SERVICES
+set, pass 0 and measure the real thing.
+
+    python -m benchmarks.concurrency [--connections 50] [--messages 20] [--workers 4,16]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks import utils
+
+utils.setup()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.core.exceptions import ValidationError  # noqa: E402
+from django.db import connection, connections  # noqa: E402
+from django.db.backends.signals import connection_created  # noqa: E402
+from django.urls import path  # noqa: E402
+
+from chat.consumers import ChatConsumer  # noqa: E402
+from chat.middleware import JWTAuthMiddleware  # noqa: E402
+from chat.models import Channel, Message, User  # noqa: E402
+from chat.serializers import message_payload  # noqa: E402
+
+
+class AsyncORMChatConsumer(ChatConsumer):
+    async def check_permission_to_channel(self, user, channel_id):
+        from django.db.models import Exists, Q
+        return await User.objects.filter(
+            Exists(Channel.objects.filter(id=channel_id)),
+            Q(is_moderator=True) | Q(channels=channel_id, is_blocked=False),
+            pk=user.id,
+        ).aexists()
+
+    async def create_message(self, channel_id, user, content):
+        if user.is_blocked:
+            raise ValidationError("User is blocked.")
+        message = await Message.objects.acreate(channel_id=channel_id, sender_id=user.id, content=content)
+        return message_payload(message, user.username)
+
+
+def add_latency(seconds):
+    def delay(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        # Fires on every reconnect of the same thread-local wrapper.
+        if delay not in connection.execute_wrappers:
+            connection.execute_wrappers.append(delay)
+
+    connection_created.connect(install, weak=False)
+    for conn in connections.all():
+        install(None, conn)
+
+
+def run(args):
+    connection.settings_dict['CONN_MAX_AGE'] = args.conn_max_age
+    if connection.vendor == 'sqlite':
+        # Worker threads need a database they can all open, not a per-connection in-memory one.
+        connection.settings_dict['TEST']['NAME'] = str(settings.BASE_DIR / 'benchmark_concurrency.sqlite3')
+        connection.settings_dict['OPTIONS']['init_command'] = 'PRAGMA journal_mode=WAL; PRAGMA synchronous=OFF;'
+
+    with utils.test_database():
+        users = utils.create_users('bench', args.connections)
+        targets = []
+        for user in users:
+            channel = Channel.objects.create(name=f'bench-{user.pk}', owner=user)
+            channel.members.add(user)
+            targets.append((channel.pk, utils.token_for(user)))
+
+        if args.async_orm:
+            application = JWTAuthMiddleware(URLRouter([
+                path('ws/chat/<int:channel_id>', AsyncORMChatConsumer.as_asgi()),
+            ]))
+        else:
+            application = utils.websocket_application()
+        if args.db_latency_ms:
+            add_latency(args.db_latency_ms / 1000)
+
+        result = {}
+
+        async def client(channel_id, token):
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{channel_id}?token={token}')
+            await communicator.connect(timeout=60)
+            await communicator.receive_from(timeout=60)
+            return communicator
+
+        async def talk(communicator):
+            for i in range(args.messages):
+                await communicator.send_to(text_data=json.dumps({'message': f'message {i}'}))
+                await communicator.receive_from(timeout=60)
+
+        async def scenario():
+            communicators = await asyncio.gather(*(client(channel_id, token) for channel_id, token in targets))
+            with utils.Timer() as timer:
+                await asyncio.gather(*(talk(communicator) for communicator in communicators))
+            result['elapsed'] = timer.elapsed
+            await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+        async_to_sync(scenario)()
+        result['stored'] = Message.objects.count()
+
+    sent = args.connections * args.messages
+    return {
+        'messages_per_second': sent / result['elapsed'],
+        'ms_per_message': result['elapsed'] * 1000 / args.messages,
+        'stored': result['stored'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--workers', default='4,16', help='Comma separated executor sizes to compare.')
+    parser.add_argument('--db-latency-ms', type=float, default=2.0)
+    parser.add_argument('--conn-max-age', type=int, default=600, help='CONN_MAX_AGE, 0 reconnects on every call.')
+    parser.add_argument('--async-orm', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args)))
+        return
+
+    configurations = [('thread-sensitive (default)', 0, False), ('async ORM', 0, True)]
+    configurations += [(f'executor, {workers} workers', int(workers), False) for workers in args.workers.split(',')]
+    common = [
+        '--connections', str(args.connections), '--messages', str(args.messages),
+        '--db-latency-ms', str(args.db_latency_ms), '--conn-max-age', str(args.conn_max_age),
+    ]
+    for title, workers, async_orm in configurations:
+        command = [sys.executable, '-m', 'benchmarks.concurrency', '--child', *common]
+        if async_orm:
+            command.append('--async-orm')
+        env = dict(os.environ, CHAT_DB_EXECUTOR_WORKERS=str(workers))
+        output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        utils.report(f'{title}, {args.connections} connections x {args.messages} messages', [
+            ('messages/sec', report['messages_per_second']),
+            ('round trip ms/message', report['ms_per_message']),
+            ('messages stored', report['stored']),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Fan-out cost of one chat message on the in-memory channel layer.
+
+Compares the previous event format (a dict that every subscriber's
+chat_message encodes again) with the pre-encoded frame sent by the current
+ChatConsumer. Subscribers are real ChatConsumer instances whose socket
+send is replaced with a no-op.
+
+    python -m benchmarks.fanout [--subscribers 2000] [--messages 20]
+"""
+import argparse
+import asyncio
+import json
+
+from benchmarks import utils
+
+utils.setup()
+
+from channels.layers import InMemoryChannelLayer  # noqa: E402
+
+from chat.consumers import MESSAGE_TYPE_CHAT, ChatConsumer  # noqa: E402
+from chat.encoding import dumps, orjson  # noqa: E402
+
+
+class LegacyChatConsumer(ChatConsumer):
+    async def chat_message(self, event):
+        message = event.get('message')
+        if message:
+            await self.send(text_data=json.dumps(message))
+
+
+def sample_message(i):
+    return {
+        'id': i,
+        'channel': 1,
+        'sender': 'sender',
+        'content': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 3,
+        'created_at': '2024-10-18T08:06:00.123456Z',
+    }
+
+
+async def fan_out(consumer_class, subscribers, messages, make_event):
+    layer = InMemoryChannelLayer(capacity=messages + 10)
+    group = 'chat_1'
+    consumers = []
+    for _ in range(subscribers):
+        consumer = consumer_class()
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            pass
+
+        consumer.send = send
+        consumer.channel_name = await layer.new_channel()
+        await layer.group_add(group, consumer.channel_name)
+        consumers.append(consumer)
+
+    # The in-memory layer's own bookkeeping is O(subscribers) per receive, so
+    # delivery and the consumers' handlers are timed separately.
+    layer_time = handler_time = 0
+    for i in range(messages):
+        with utils.Timer() as timer:
+            await layer.group_send(group, make_event(sample_message(i)))
+            events = [await layer.receive(consumer.channel_name) for consumer in consumers]
+        layer_time += timer.elapsed
+        with utils.Timer() as timer:
+            for consumer, event in zip(consumers, events):
+                await consumer.chat_message(event)
+        handler_time += timer.elapsed
+    return layer_time, handler_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--subscribers', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20)
+    args = parser.parse_args()
+
+    def per_recipient(message):
+        return {'type': MESSAGE_TYPE_CHAT, 'message': message}
+
+    def pre_encoded(message):
+        return {'type': MESSAGE_TYPE_CHAT, 'text': dumps(message)}
+
+    encoder = 'orjson' if orjson else 'json'
+    for title, consumer_class, make_event in (
+        ('encode per recipient (json)', LegacyChatConsumer, per_recipient),
+        (f'pre-encoded once ({encoder})', ChatConsumer, pre_encoded),
+    ):
+        layer_time, handler_time = asyncio.run(fan_out(consumer_class, args.subscribers, args.messages, make_event))
+        utils.report(f'{title}, {args.subscribers} subscribers, ms/message', [
+            ('chat_message handlers', handler_time * 1000 / args.messages),
+            ('in-memory layer delivery', layer_time * 1000 / args.messages),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Queries and thread-pool hops per WebSocket chat message.
+
+Compares the current ``ChatConsumer`` ingest path with the previous one
+(uncached permission check, Channel refetch, DRF serialization in a second
+hop), reproduced below as ``LegacyChatConsumer``.
+
+    python -m benchmarks.ingest [--messages 500]
+"""
+import argparse
+
+from benchmarks import utils
+
+utils.setup()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.db import database_sync_to_async  # noqa: E402
+from channels.middleware import BaseMiddleware  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.core.exceptions import ValidationError  # noqa: E402
+from django.db import DEFAULT_DB_ALIAS, connections  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from django.urls import path  # noqa: E402
+
+from chat.consumers import ChatConsumer  # noqa: E402
+from chat.middleware import JWTAuthMiddleware  # noqa: E402
+from chat.models import Channel, User  # noqa: E402
+
+
+class LegacyUserMiddleware(BaseMiddleware):
+    """Puts a full User row in the scope, as the legacy consumer expects."""
+
+    async def __call__(self, scope, receive, send):
+        user = scope['user']
+        if user.is_authenticated:
+            scope['user'] = await database_sync_to_async(User.objects.get)(pk=user.pk)
+        return await super().__call__(scope, receive, send)
+
+
+class LegacyChatConsumer(ChatConsumer):
+    async def has_permission_to_channel(self, user, channel_id, use_cache=True):
+        return await self.legacy_permission_check(user, channel_id)
+
+    @database_sync_to_async
+    def legacy_permission_check(self, user, channel_id):
+        try:
+            channel = Channel.objects.prefetch_related('members').get(id=channel_id)
+            return user.is_moderator or (user in channel.members.all() and not user.is_blocked)
+        except Channel.DoesNotExist:
+            return False
+
+    async def create_message(self, channel_id, user, content):
+        message = await self.legacy_create_message(channel_id, user, content)
+        return await self.legacy_serialize_message(message)
+
+    @database_sync_to_async
+    def legacy_create_message(self, channel_id, user, content):
+        from chat.models import Message
+        channel = Channel.objects.prefetch_related('members').get(id=channel_id)
+        if user.is_blocked:
+            raise ValidationError("User is blocked.")
+        return Message.objects.create(channel=channel, sender=user, content=content)
+
+    @database_sync_to_async
+    def legacy_serialize_message(self, message):
+        from chat.serializers import MessageSerializer
+        return MessageSerializer(message).data
+
+
+def measure(application, channel, token, messages):
+    # Queries run on this (main) thread, hence the reference to its connection.
+    conn = connections[DEFAULT_DB_ALIAS]
+    result = {}
+
+    async def scenario():
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{channel.pk}?token={token}')
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        with utils.count_thread_hops() as hops, utils.Timer() as timer:
+            queries_before = len(conn.queries_log)
+            for i in range(messages):
+                await communicator.send_json_to({'message': f'message {i}'})
+                await communicator.receive_json_from()
+            result['queries'] = len(conn.queries_log) - queries_before
+        result['hops'] = hops['hops']
+        result['elapsed'] = timer.elapsed
+        await communicator.disconnect()
+
+    with CaptureQueriesContext(conn):
+        async_to_sync(scenario)()
+
+    return [
+        ('queries/message', result['queries'] / messages),
+        ('thread hops/message', result['hops'] / messages),
+        ('ms/message', result['elapsed'] * 1000 / messages),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--members', type=int, default=5000)
+    args = parser.parse_args()
+
+    with utils.test_database():
+        user = utils.create_user('bench')
+        channel = Channel.objects.create(name='bench', owner=user)
+        channel.members.add(user)
+        others = utils.create_users('member', args.members - 1)
+        channel.members.add(*others)
+        token = utils.token_for(user)
+
+        legacy = JWTAuthMiddleware(LegacyUserMiddleware(URLRouter([
+            path('ws/chat/<int:channel_id>', LegacyChatConsumer.as_asgi()),
+        ])))
+        utils.report(f'before ({args.members} members)', measure(legacy, channel, token, args.messages))
+        utils.report(f'after ({args.members} members)', measure(utils.websocket_application(), channel, token, args.messages))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Overhead of the metrics instrumentation on the WebSocket message path.
+
+Sends the same messages through ChatConsumer with recording switched on and
+off, alternating rounds to even out warm-up and noise, and reports the
+difference per message.
+
+    python -m benchmarks.metrics [--messages 500] [--rounds 5]
+"""
+import argparse
+
+from benchmarks import utils
+
+utils.setup()
+
+from benchmarks.ingest import measure  # noqa: E402
+from chat import metrics  # noqa: E402
+from chat.models import Channel  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    with utils.test_database():
+        user = utils.create_user('bench')
+        channel = Channel.objects.create(name='bench', owner=user)
+        channel.members.add(user)
+        token = utils.token_for(user)
+        application = utils.websocket_application()
+
+        timings = {True: [], False: []}
+        for _ in range(args.rounds):
+            for enabled in (False, True):
+                metrics.set_enabled(enabled)
+                rows = dict(measure(application, channel, token, args.messages))
+                timings[enabled].append(rows['ms/message'])
+        metrics.set_enabled(True)
+
+    disabled, enabled = min(timings[False]), min(timings[True])
+    utils.report(f'best of {args.rounds} rounds, {args.messages} messages', [
+        ('metrics off, ms/message', disabled),
+        ('metrics on, ms/message', enabled),
+        ('overhead, %', (enabled - disabled) * 100 / disabled),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Cost per user of one socket per channel (ws/chat/<id>) against one multiplexed socket (ws/chat/).
+
+Every user is a member of --channels channels and opens them all, either as
+separate sockets or with one subscribe frame. Reports handshakes, queries,
+connect time and the Python memory held per user while connected. Every
+socket is one file descriptor on the server (and one Redis subscription
+with the pub/sub layer), so sockets per user is the fd count. Memory is
+measured in-process and includes the test client's share of each socket,
+compare the two rows rather than reading them as absolute figures.
+
+    python -m benchmarks.multiplex [--users 50] [--channels 30]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import tracemalloc
+
+from benchmarks import utils
+
+utils.setup()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.db import DEFAULT_DB_ALIAS, connections  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from prometheus_client import REGISTRY  # noqa: E402
+
+from chat.cache import membership_cache  # noqa: E402
+from chat.history import recent_history  # noqa: E402
+from chat.middleware import token_cache  # noqa: E402
+from chat.models import Channel  # noqa: E402
+from chat.presence import presence, presence_notifier  # noqa: E402
+
+
+def reset_caches(channel_ids):
+    membership_cache.clear()
+    token_cache.clear()
+    presence.clear()
+    presence_notifier.clear()
+    for channel_id in channel_ids:
+        recent_history.invalidate(channel_id)
+
+
+def handshakes():
+    """Successful token checks so far, from the prometheus_client registry."""
+    return sum(
+        REGISTRY.get_sample_value('chat_ws_handshake_seconds_count', {'outcome': outcome}) or 0
+        for outcome in ('cache_hits', 'claims', 'db_lookups')
+    )
+
+
+async def open_per_channel(application, token, channel_ids):
+    communicators = []
+    for channel_id in channel_ids:
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{channel_id}?token={token}')
+        await communicator.connect(timeout=60)
+        await communicator.receive_from(timeout=60)
+        communicators.append(communicator)
+    return communicators
+
+
+async def open_multiplexed(application, token, channel_ids):
+    communicator = WebsocketCommunicator(application, f'/ws/chat/?token={token}')
+    await communicator.connect(timeout=60)
+    await communicator.send_to(text_data=json.dumps({'action': 'subscribe', 'channels': channel_ids}))
+    for _ in channel_ids:
+        await communicator.receive_from(timeout=60)
+    return [communicator]
+
+
+def measure(application, tokens, channel_ids, open_sockets):
+    reset_caches(channel_ids)
+    handshakes_before = handshakes()
+    result = {}
+
+    async def scenario():
+        gc.collect()
+        baseline = tracemalloc.get_traced_memory()[0]
+        with utils.Timer() as timer:
+            # Users connect concurrently, each one opens its channels in order
+            opened = await asyncio.gather(*(open_sockets(application, token, channel_ids) for token in tokens))
+        gc.collect()
+        result['memory'] = tracemalloc.get_traced_memory()[0] - baseline
+        result['elapsed'] = timer.elapsed
+        result['sockets'] = sum(len(communicators) for communicators in opened)
+        await asyncio.gather(*(
+            communicator.disconnect() for communicators in opened for communicator in communicators
+        ))
+
+    # Database calls run on this thread
+    with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+        async_to_sync(scenario)()
+
+    users = len(tokens)
+    return [
+        ('sockets (server fds) per user', result['sockets'] / users),
+        ('handshakes per user', (handshakes() - handshakes_before) / users),
+        ('queries per user', len(queries) / users),
+        ('connect ms per user', result['elapsed'] * 1000 / users),
+        ('memory KiB per user', result['memory'] / 1024 / users),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--channels', type=int, default=30)
+    args = parser.parse_args()
+
+    with utils.test_database():
+        users = utils.create_users('bench', args.users)
+        channels = [Channel.objects.create(name=f'bench-{i}', owner=users[0]) for i in range(args.channels)]
+        for channel in channels:
+            channel.members.add(*users)
+        channel_ids = [channel.pk for channel in channels]
+        tokens = [utils.token_for(user) for user in users]
+        application = utils.websocket_application()
+
+        tracemalloc.start()
+        for title, open_sockets in (('socket per channel', open_per_channel), ('multiplexed', open_multiplexed)):
+            utils.report(
+                f'{title}, {args.users} users x {args.channels} channels',
+                measure(application, tokens, channel_ids, open_sockets),
+            )
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    main()
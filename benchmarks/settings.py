@@ -0,0 +1,25 @@
+from chat_api.settings import *  # noqa: F401,F403
+
+# Benchmarks run in-process against SQLite and the in-memory channel layer
+# unless BENCHMARK_USE_SERVICES is set, in which case the regular
+# Postgres/Redis configuration from chat_api.settings is kept.
+if not os.getenv('BENCHMARK_USE_SERVICES'):  # noqa: F405
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'benchmark.sqlite3',  # noqa: F405
+        }
+    }
+    # The default capacity of 100 frames per channel silently drops messages
+    # once a client falls behind a burst.
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': 100000},
+        }
+    }
+
+# Clients here send as fast as they can, measure the pipeline and not the
+# rate limiter.
+CHAT_RATE_LIMIT = {'rate': 0, 'burst': 0}
+CHAT_RATE_LIMIT_CHANNELS = {}
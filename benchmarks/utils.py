@@ -0,0 +1,90 @@
+import contextlib
+import os
+import time
+
+import django
+
+
+def setup():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    django.setup()
+
+
+@contextlib.contextmanager
+def test_database():
+    from django.db import connection
+
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextlib.contextmanager
+def count_thread_hops():
+    """Count ``SyncToAsync`` calls (one thread-pool hop each) made inside the block."""
+    from asgiref.sync import SyncToAsync
+
+    counter = {'hops': 0}
+    original_call = SyncToAsync.__call__
+
+    async def counting_call(self, *args, **kwargs):
+        counter['hops'] += 1
+        return await original_call(self, *args, **kwargs)
+
+    SyncToAsync.__call__ = counting_call
+    try:
+        yield counter
+    finally:
+        SyncToAsync.__call__ = original_call
+
+
+def create_user(username, **kwargs):
+    from chat.models import User
+
+    # Password hashing is irrelevant for benchmarks and dominates setup time.
+    user = User(username=username, **kwargs)
+    user.set_unusable_password()
+    user.save()
+    return user
+
+
+def create_users(prefix, count):
+    from chat.models import User
+
+    users = [User(username=f'{prefix}{i}', password='!') for i in range(count)]
+    return User.objects.bulk_create(users, batch_size=500)
+
+
+def token_for(user):
+    from chat.tokens import ChatRefreshToken
+
+    return str(ChatRefreshToken.for_user(user).access_token)
+
+
+def websocket_application():
+    from channels.routing import URLRouter
+
+    from chat.middleware import JWTAuthMiddleware
+    from chat_api.routing import websocket_urlpatterns
+
+    return JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+
+def report(title, rows):
+    print(title)
+    width = max(len(name) for name, _ in rows)
+    for name, value in rows:
+        if isinstance(value, float):
+            value = f'{value:.3f}'
+        print(f'  {name.ljust(width)}  {value}')
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,79 @@
+"""
+Encode cost and bytes on the wire of JSON text frames against MessagePack binary frames.
+
+History: a welcome frame with CHAT_HISTORY_LENGTH messages from --senders
+distinct users, encoded as sent to each client. Fan-out: one chat message,
+encoded to JSON once per group_send and forwarded as is to every subscriber,
+binary sockets convert it to MessagePack once per process.
+
+    python -m benchmarks.wire [--senders 5] [--content-length 80] [--repeat 20000]
+"""
+import argparse
+import timeit
+
+from benchmarks import utils
+
+utils.setup()
+
+from django.conf import settings  # noqa: E402
+
+from chat.encoding import binary_frame, binary_from_text, dumps, orjson, pack  # noqa: E402
+
+
+def sample_message(i, senders, content_length):
+    sender_id = i % senders + 1
+    return {
+        'id': 1000000 + i,
+        'channel': 42,
+        'sender': f'user-{sender_id}',
+        'sender_id': sender_id,
+        'content': ('Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 10)[:content_length],
+        'created_at': f'2024-10-18T08:{i % 60:02d}:00.123456Z',
+    }
+
+
+def measure(encode, repeat):
+    """Microseconds per encode and encoded size in bytes."""
+    encoded = encode()
+    size = len(encoded if isinstance(encoded, bytes) else encoded.encode())
+    seconds = min(timeit.repeat(encode, number=repeat, repeat=3))
+    return seconds * 1e6 / repeat, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--senders', type=int, default=5)
+    parser.add_argument('--content-length', type=int, default=80)
+    parser.add_argument('--repeat', type=int, default=20000)
+    args = parser.parse_args()
+
+    history = [sample_message(i, args.senders, args.content_length) for i in range(settings.CHAT_HISTORY_LENGTH)]
+    welcome = {
+        'type': 'welcome',
+        'message': 'Welcome to the chat!',
+        'user': 'user-1',
+        'history': history,
+        'next': 'MjAyNC0xMC0xOFQwODowMDowMC4xMjM0NTYrMDA6MDB8MTAwMDAwMA==',
+        'online': [f'user-{i}' for i in range(1, args.senders + 1)],
+    }
+    message = history[0]
+    encoder = 'orjson' if orjson else 'json'
+
+    for title, json_encode, binary_encode in (
+        (f'history, welcome with {len(history)} messages', lambda: dumps(welcome), lambda: pack(binary_frame(welcome))),
+        ('fan-out, one chat message', lambda: dumps(message),
+         lambda: binary_from_text.__wrapped__(dumps(message), True)),
+    ):
+        json_us, json_size = measure(json_encode, args.repeat)
+        binary_us, binary_size = measure(binary_encode, args.repeat)
+        utils.report(title, [
+            (f'{encoder} encode us', json_us),
+            ('msgpack encode us', binary_us),
+            (f'{encoder} bytes', json_size),
+            ('msgpack bytes', binary_size),
+            ('msgpack size, % of json', binary_size * 100 / json_size),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Message write throughput with and without the write-behind buffer.
+
+Every connection sends to its own channel so fan-out stays constant and the
+numbers reflect the INSERT path.
+
+    python -m benchmarks.write_behind [--connections 50] [--messages 40]
+"""
+import argparse
+import asyncio
+
+from benchmarks import utils
+
+utils.setup()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.db import DEFAULT_DB_ALIAS, connections  # noqa: E402
+from django.test import override_settings  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from chat.buffer import write_buffer  # noqa: E402
+from chat.models import Channel, Message  # noqa: E402
+
+
+def measure(application, targets, messages):
+    conn = connections[DEFAULT_DB_ALIAS]
+    result = {}
+
+    async def client(channel, token):
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{channel.pk}?token={token}')
+        await communicator.connect()
+        await communicator.receive_json_from()
+        return communicator
+
+    async def send(communicator):
+        for i in range(messages):
+            await communicator.send_json_to({'message': f'message {i}'})
+        for _ in range(messages):
+            await communicator.receive_json_from(timeout=30)
+
+    async def scenario():
+        communicators = await asyncio.gather(*(client(channel, token) for channel, token in targets))
+        queries_before = len(conn.queries_log)
+        with utils.Timer() as timer:
+            await asyncio.gather(*(send(communicator) for communicator in communicators))
+            await write_buffer.drain()
+        result['inserts'] = sum(
+            1 for query in list(conn.queries_log)[queries_before:] if query['sql'].startswith('INSERT')
+        )
+        result['elapsed'] = timer.elapsed
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+    with CaptureQueriesContext(conn):
+        async_to_sync(scenario)()
+
+    total = len(targets) * messages
+    return [
+        ('messages/sec', total / result['elapsed']),
+        ('INSERT statements', result['inserts']),
+        ('messages stored', Message.objects.count()),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=40)
+    args = parser.parse_args()
+
+    modes = [
+        ('direct INSERT', {'MESSAGE_WRITE_BEHIND': False}),
+        ('write-behind, ack after flush', {'MESSAGE_WRITE_BEHIND': True, 'MESSAGE_WRITE_BEHIND_ACK': 'flush'}),
+        ('write-behind, ack immediately', {'MESSAGE_WRITE_BEHIND': True, 'MESSAGE_WRITE_BEHIND_ACK': 'immediate'}),
+    ]
+
+    with utils.test_database():
+        users = utils.create_users('writer', args.connections)
+        targets = []
+        for user in users:
+            channel = Channel.objects.create(name=user.username, owner=user)
+            channel.members.add(user)
+            targets.append((channel, utils.token_for(user)))
+
+        application = utils.websocket_application()
+        for title, overrides in modes:
+            Message.objects.all().delete()
+            with override_settings(**overrides):
+                utils.report(
+                    f'{title} ({args.connections} connections x {args.messages} messages)',
+                    measure(application, targets, args.messages)
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 from django.contrib import admin
 
-from chat.models import User, Channel, Message
+from chat.models import ArchivedMessage, ReadState, User, Channel, Message
 
 
 admin.site.register(User)
 admin.site.register(Channel)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(ArchivedMessage)
+admin.site.register(ReadState)
@@ -0,0 +1,99 @@
+import asyncio
+import atexit
+import logging
+
+from django.conf import settings
+
+from chat.db import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+ACK_AFTER_FLUSH = 'flush'
+ACK_IMMEDIATELY = 'immediate'
+
+
+class MessageWriteBuffer:
+    """
+    Per-process write-behind buffer for chat messages.
+
+    Messages are collected from all consumers of the process and written with
+    a single ``bulk_create`` every ``MESSAGE_FLUSH_INTERVAL_MS`` milliseconds or
+    as soon as ``MESSAGE_FLUSH_BATCH_SIZE`` messages are pending.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    def add(self, message, wait=True):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if wait else None
+        self._pending.append((message, future))
+
+        if len(self._pending) >= settings.MESSAGE_FLUSH_BATCH_SIZE:
+            self._start_flush(loop)
+        elif self._timer is None:
+            self._timer = loop.call_later(
+                settings.MESSAGE_FLUSH_INTERVAL_MS / 1000, self._start_flush, loop
+            )
+        return future
+
+    def _start_flush(self, loop):
+        task = loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _take_batch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        return batch
+
+    async def flush(self):
+        batch = self._take_batch()
+        if not batch:
+            return
+
+        try:
+            await self.write([message for message, _ in batch])
+        except Exception as e:
+            logger.error(f"Error flushing {len(batch)} buffered messages: {e}")
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+
+        for message, future in batch:
+            if future is not None and not future.done():
+                future.set_result(message)
+
+    async def drain(self):
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def drain_sync(self):
+        batch = self._take_batch()
+        if batch:
+            self._write([message for message, _ in batch])
+
+    @database_sync_to_async
+    def write(self, messages):
+        self._write(messages)
+
+    @staticmethod
+    def _write(messages):
+        from chat.models import Message
+        from chat.unread import advance_counts
+        Message.objects.bulk_create(messages)
+        # Once per channel per batch, outside the insert
+        advance_counts({message.channel_id for message in messages})
+
+    def __len__(self):
+        return len(self._pending)
+
+
+write_buffer = MessageWriteBuffer()
+atexit.register(write_buffer.drain_sync)
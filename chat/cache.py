@@ -0,0 +1,130 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from chat.dispatch import dispatcher
+
+MESSAGE_TYPE_MEMBERSHIP_INVALIDATE = 'membership_invalidate'
+
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def add(self, key, value=True, ttl=None):
+        """Set ``key`` unless it is already there, returns whether it was set."""
+        if self.max_size <= 0:
+            return True
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] >= time.monotonic():
+                return False
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+membership_cache = TTLCache(settings.MEMBERSHIP_CACHE_SIZE, settings.MEMBERSHIP_CACHE_TTL)
+# Ids of invalidation events already applied in this process
+applied_invalidations = TTLCache(4096, 60)
+
+
+def invalidate_membership(channel_id=None, user_ids=None):
+    """Drop cached ``(channel_id, user_id)`` entries, ``None`` matches any."""
+    if channel_id is not None and user_ids is not None:
+        # Exact keys, no scan of the whole cache
+        membership_cache.delete_many([(channel_id, user_id) for user_id in user_ids])
+        return
+
+    user_ids = set(user_ids) if user_ids is not None else None
+
+    def matches(key):
+        key_channel_id, key_user_id = key
+        if channel_id is not None and key_channel_id != channel_id:
+            return False
+        return user_ids is None or key_user_id in user_ids
+
+    membership_cache.delete_matching(matches)
+
+
+def membership_invalidation_event(channel_id, user_ids=None, revoke=False):
+    """``revoke`` also drops cached handshake credentials of ``user_ids``."""
+    return {
+        'type': MESSAGE_TYPE_MEMBERSHIP_INVALIDATE,
+        'event_id': uuid.uuid4().hex,
+        'channel_id': channel_id,
+        'user_ids': list(user_ids) if user_ids is not None else None,
+        'revoke': revoke,
+    }
+
+
+def claim_invalidation(event):
+    """
+    The group event reaches every consumer of the room in this process,
+    only the first one to claim it applies it.
+    """
+    event_id = event.get('event_id')
+    return event_id is None or applied_invalidations.add(event_id)
+
+
+def broadcast_membership_invalidation(channel_ids, user_ids=None, revoke=False):
+    events = []
+    for channel_id in channel_ids:
+        invalidate_membership(channel_id, user_ids)
+        event = membership_invalidation_event(channel_id, user_ids, revoke)
+        # Already applied here
+        claim_invalidation(event)
+        events.append((f'chat_{channel_id}', event))
+    dispatcher.send(events)
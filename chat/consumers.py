@@ -1,17 +1,69 @@
-import json
+import asyncio
+import functools
 import logging
+import uuid
+from datetime import datetime
+from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
+import msgpack
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.utils import timezone
+
+from chat.buffer import ACK_AFTER_FLUSH, write_buffer
+from chat.cache import claim_invalidation, invalidate_membership, membership_cache
+from chat.db import database_sync_to_async
+from chat.encoding import (FORMAT_MSGPACK, SUBPROTOCOL_MSGPACK, binary_frame, binary_from_text, dumps, loads, pack,
+                           unpack)
+from chat.history import recent_history
+from chat.metrics import WS_CONNECTIONS, WS_EVENT_SECONDS, WS_SLOW_CLOSED, group_send, timed, track_group
+from chat.middleware import get_user_from_db, revoke_user
+from chat.outbound import KIND_CHAT, KIND_EPHEMERAL, KIND_REPLY, OutboundQueue
+from chat.presence import presence, presence_notifier
+from chat.ratelimit import check_rate_limit, check_subscribe_rate_limit
+from chat.unread import message_counter
 
 logger = logging.getLogger(__name__)
 
 MESSAGE_TYPE_CHAT = 'chat_message'
 MESSAGE_TYPE_WELCOME = 'welcome'
 MESSAGE_TYPE_ERROR = 'error'
+MESSAGE_TYPE_HISTORY = 'history'
+MESSAGE_TYPE_UNSUBSCRIBED = 'unsubscribed'
+MESSAGE_TYPE_RESYNC = 'resync'
+MESSAGE_TYPE_READ = 'read'
+
+ERROR_RATE_LIMITED = 'rate_limited'
+ERROR_FORBIDDEN = 'forbidden'
+ERROR_NOT_SUBSCRIBED = 'not_subscribed'
+ERROR_TOO_MANY_CHANNELS = 'too_many_channels'
+ERROR_TOO_FAR_BEHIND = 'too_far_behind'
+
+CLOSE_CODE_TOO_SLOW = 4008
+
+# Recent history appends of buffered messages, referenced until done
+history_tasks = set()
+
+ACTION_MESSAGE = 'message'
+ACTION_HISTORY = 'history'
+ACTION_TYPING = 'typing'
+ACTION_MARK_READ = 'mark_read'
+ACTION_SUBSCRIBE = 'subscribe'
+ACTION_UNSUBSCRIBE = 'unsubscribe'
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    joined = False
+    outbound = None
+    # MessagePack over bytes_data instead of JSON text, see chat.encoding
+    binary = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # channel_id -> (ids, last id) of the messages sent by the last resync
+        self.resynced = {}
+
+    @timed(WS_EVENT_SECONDS.labels('connect'))
     async def connect(self):
         self.channel_id = self.scope['url_route']['kwargs'].get('channel_id')
         if not self.channel_id:
@@ -26,7 +78,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         try:
-            has_permission = await self.has_permission_to_channel(user, self.channel_id)
+            has_permission = await self.has_permission_to_channel(user, self.channel_id, use_cache=False)
         except ObjectDoesNotExist:
             await self.close()
             return
@@ -44,128 +96,733 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
-        await self.send_welcome_message()
+        await self.accept_negotiated()
+        self.joined = True
+        WS_CONNECTIONS.inc()
+        self.start_outbound()
+        await self.join_channel(self.channel_id)
+        since = self.query_param('since')
+        if since is None:
+            await self.send_welcome_message(self.channel_id)
+        else:
+            await self.resync(self.channel_id, since)
 
+    @timed(WS_EVENT_SECONDS.labels('disconnect'))
     async def disconnect(self, close_code):
+        if self.joined:
+            self.joined = False
+            WS_CONNECTIONS.dec()
+            self.stop_outbound()
+            await self.leave_channel(self.channel_id)
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await message_counter.drain()
+
+    def query_param(self, name):
+        return parse_qs(self.scope['query_string'].decode()).get(name, [None])[0]
+
+    async def accept_negotiated(self):
+        """Accepts in binary mode if the client offers the subprotocol or asks with ?format=msgpack."""
+        subprotocol = None
+        if SUBPROTOCOL_MSGPACK in self.scope.get('subprotocols', ()):
+            self.binary, subprotocol = True, SUBPROTOCOL_MSGPACK
+        elif self.query_param('format') == FORMAT_MSGPACK:
+            self.binary = True
+        await self.accept(subprotocol)
+
+    def encode(self, data):
+        return pack(binary_frame(data)) if self.binary else dumps(data)
 
-    async def receive(self, text_data):
+    def decode(self, text_data, bytes_data):
+        """The client's frame as a dict, raises ValueError if it can't be read."""
         try:
-            data = json.loads(text_data)
-        except json.JSONDecodeError:
-            await self.send_error("Invalid JSON format.")
+            data = unpack(bytes_data) if bytes_data is not None else loads(text_data)
+        except (TypeError, ValueError, msgpack.UnpackException) as e:
+            # e.g. a MessagePack map keyed by an array: unhashable in Python
+            raise ValueError(f'Unreadable frame: {e}') from e
+        if not isinstance(data, dict):
+            raise ValueError('Expected an object.')
+        return data
+
+    async def send_data(self, data):
+        await self.send_raw(self.encode(data))
+
+    async def send_raw(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    def start_outbound(self):
+        if settings.CHAT_OUTBOUND_HIGH_WATER > 0:
+            self.outbound = OutboundQueue(
+                self.send_raw, self.encode, settings.CHAT_OUTBOUND_HIGH_WATER, settings.CHAT_OUTBOUND_LAG_TIMEOUT
+            )
+
+    def stop_outbound(self):
+        if self.outbound is not None:
+            self.outbound.stop()
+            self.outbound = None
+
+    async def send_outbound(self, frame, channel_id=None, message_id=None, kind=KIND_CHAT):
+        """Group event frames go through the outbound queue, replies to the client are sent directly."""
+        if self.outbound is None:
+            await self.send_raw(frame)
+            return
+        if not self.outbound.put(frame, channel_id, message_id, kind):
+            WS_SLOW_CLOSED.inc()
+            self.stop_outbound()
+            await self.close(code=CLOSE_CODE_TOO_SLOW)
+
+    async def join_channel(self, channel_id):
+        """Bookkeeping once the socket is in the channel's group."""
+        track_group(f'chat_{channel_id}', 1)
+        recent_history.watch(channel_id)
+        user = self.scope['user']
+        try:
+            if await presence.join(channel_id, user.id, user.username):
+                presence_notifier.joined(channel_id, user.username)
+        except Exception as e:
+            logger.error(f"Error updating presence: {e}")
+
+    async def leave_channel(self, channel_id):
+        track_group(f'chat_{channel_id}', -1)
+        self.resynced.pop(channel_id, None)
+        recent_history.unwatch(channel_id)
+        user = self.scope['user']
+        try:
+            if await presence.leave(channel_id, user.id):
+                presence_notifier.left(channel_id, user.username)
+        except Exception as e:
+            logger.error(f"Error updating presence: {e}")
+
+    @timed(WS_EVENT_SECONDS.labels('receive'))
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.decode(text_data, bytes_data)
+        except ValueError:
+            await self.send_error("Invalid MessagePack format." if bytes_data is not None else "Invalid JSON format.")
+            return
+
+        await self.handle_channel_action(self.channel_id, data.get('action', ACTION_MESSAGE), data)
+
+    async def handle_channel_action(self, channel_id, action, data):
+        if action == ACTION_TYPING:
+            # Coalesced per channel and never touches the database, so not rate limited.
+            presence_notifier.typing(channel_id, self.scope['user'].username)
+            return
+
+        if not await check_rate_limit(channel_id, self.scope['user']):
+            await self.send_error("Too many messages, slow down.", code=ERROR_RATE_LIMITED, channel_id=channel_id)
+            return
+
+        if action == ACTION_HISTORY:
+            await self.send_history(channel_id, data.get('before'))
+            return
+        if action == ACTION_MARK_READ:
+            await self.mark_read(channel_id, data.get('id'))
+            return
+        if action != ACTION_MESSAGE:
+            await self.send_error(f"Unknown action: {action}.", channel_id=channel_id)
             return
 
         message_content = data.get('message')
         if not message_content:
-            await self.send_error("Message content is missing.")
+            await self.send_error("Message content is missing.", channel_id=channel_id)
             return
 
         user = self.scope['user']
 
         try:
-            has_permission = await self.has_permission_to_channel(user, self.channel_id)
+            has_permission = await self.has_permission_to_channel(user, channel_id)
         except ObjectDoesNotExist:
-            await self.send_error("Channel does not exist.")
+            await self.send_error("Channel does not exist.", channel_id=channel_id)
             return
         except Exception as e:
             logger.error(f"Error checking permissions: {e}")
-            await self.send_error("Internal server error.")
+            await self.send_error("Internal server error.", channel_id=channel_id)
             return
 
         if not has_permission:
-            await self.send_error("You do not have permission to send messages to this channel.")
+            await self.send_error("You do not have permission to send messages to this channel.", channel_id=channel_id)
             return
 
         try:
-            message = await self.create_message(user, message_content)
-            serialized_message = await self.serialize_message(message)
+            if settings.MESSAGE_WRITE_BEHIND:
+                serialized_message = await self.buffer_message(channel_id, user, message_content)
+            else:
+                serialized_message = await self.create_message(channel_id, user, message_content)
+                message_counter.add(channel_id)
         except ValidationError as ve:
-            await self.send_error(f"Validation error: {ve}")
+            await self.send_error(f"Validation error: {ve}", channel_id=channel_id)
             return
         except Exception as e:
             logger.error(f"Error creating message: {e}")
-            await self.send_error("Failed to create message.")
+            await self.send_error("Failed to create message.", channel_id=channel_id)
             return
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': MESSAGE_TYPE_CHAT,
-                'message': serialized_message
-            }
-        )
+        # Encoded once here instead of once per recipient in chat_message, binary sockets convert it.
+        event = {
+            'type': MESSAGE_TYPE_CHAT,
+            'text': dumps(serialized_message),
+            'compact': True,
+            'channel_id': channel_id,
+            'id': serialized_message['id'],
+        }
+        if not recent_history.shared:
+            # Other processes append it to their local history, appended below in this one
+            event['event_id'] = uuid.uuid4().hex
+            claim_invalidation(event)
+        await group_send(self.channel_layer, f'chat_{channel_id}', event)
+
+        # Not persisted yet with write-behind acks before the flush, appended once written
+        if serialized_message['id'] is not None:
+            await self.append_recent_history(channel_id, serialized_message)
+
+    async def append_recent_history(self, channel_id, serialized_message):
+        try:
+            await recent_history.append(channel_id, serialized_message)
+        except Exception as e:
+            logger.error(f"Error updating recent history: {e}")
+
+    def buffered_message_written(self, channel_id, username, future):
+        from chat.serializers import message_payload
+        if future.cancelled() or future.exception() is not None:
+            return
+        payload = message_payload(future.result(), username)
+        task = asyncio.get_running_loop().create_task(self.append_recent_history(channel_id, payload))
+        history_tasks.add(task)
+        task.add_done_callback(history_tasks.discard)
 
     async def chat_message(self, event):
-        message = event.get('message')
-        if message:
-            await self.send(text_data=json.dumps(message))
+        if 'event_id' in event and claim_invalidation(event):
+            await self.append_broadcast_history(event)
+        frame = event.get('text')
+        if frame is None and event.get('message'):
+            frame = dumps(event['message'])
+        if frame and self.binary:
+            # Compact messages carry the payload of message_payload
+            frame = binary_from_text(frame, event.get('compact', False))
+        if frame and not self.was_resynced(event.get('channel_id'), event.get('id')):
+            await self.send_outbound(frame, event.get('channel_id'), event.get('id'))
+
+    async def append_broadcast_history(self, event):
+        """Local history of a message sent through another process, by the first consumer here to get it."""
+        if event['id'] is None:
+            # Written behind over there and not in the database yet, the next welcome reads it from there
+            recent_history.invalidate(event['channel_id'])
+            return
+        await self.append_recent_history(event['channel_id'], loads(event['text']))
+
+    def was_resynced(self, channel_id, message_id):
+        """Whether the live message ``message_id`` already went out in a resync of ``channel_id``."""
+        if message_id is None or channel_id not in self.resynced:
+            return False
+        ids, last_id = self.resynced[channel_id]
+        if message_id > last_id:
+            # Live messages are past the resync from here on
+            del self.resynced[channel_id]
+        return message_id in ids
 
-    async def send_welcome_message(self):
+    async def send_frame(self, event):
+        frame = binary_from_text(event['text']) if self.binary else event['text']
+        await self.send_outbound(frame, kind=KIND_EPHEMERAL)
+
+    def tag(self, channel_id, data):
+        """Channel-scoped frames carry their channel id on multiplexed sockets."""
+        return data
+
+    async def send_welcome_message(self, channel_id, history=None):
         try:
-            recent_messages = await self.get_recent_messages()
-            serialized_messages = await self.serialize_messages(recent_messages)
+            if history is None:
+                history = await self.get_welcome_history(channel_id)
+            serialized_messages, next_cursor = history
 
             welcome_data = {
                 'type': MESSAGE_TYPE_WELCOME,
                 'message': 'Welcome to the chat!',
                 'user': self.scope['user'].username,
-                'history': serialized_messages
+                'history': serialized_messages,
+                'next': next_cursor,
+                'online': await self.get_online_users(channel_id),
             }
-            await self.send(text_data=json.dumps(welcome_data))
+            await self.send_data(self.tag(channel_id, welcome_data))
         except Exception as e:
             logger.error(f"Error sending welcome message: {e}")
-            error_data = {
-                'type': MESSAGE_TYPE_ERROR,
-                'message': "Couldn't load message history."
-            }
-            await self.send(text_data=json.dumps(error_data))
+            await self.send_error("Couldn't load message history.", channel_id=channel_id)
+
+    async def resync(self, channel_id, since):
+        """
+        Welcome a reconnecting client with exactly the messages after ``since``.
+
+        The gap goes out oldest first in ``resync`` frames of
+        CHAT_RESYNC_CHUNK_SIZE messages, the last one has ``done`` set. Clients
+        more than CHAT_RESYNC_MAX_MESSAGES behind get the regular welcome and a
+        ``too_far_behind`` error, and page back over REST instead.
+
+        The frames go through the outbound queue behind the live messages
+        already queued, minus those the resync sends again. Queued ones past
+        the last message it sends move behind it, and live messages handled
+        after it skip the ids it sent, so every message arrives once and in
+        order, except write-behind acks without an id yet.
+        """
+        try:
+            since = int(since)
+            too_far_behind = await self.is_too_far_behind(channel_id, since)
+        except (TypeError, ValueError):
+            await self.send_error("Invalid since, expected a message id.", channel_id=channel_id)
+            await self.send_welcome_message(channel_id)
+            return
+        except Exception as e:
+            logger.error(f"Error checking resync gap: {e}")
+            too_far_behind = True
+
+        if too_far_behind:
+            await self.send_welcome_message(channel_id)
+            await self.send_error("Too far behind, use REST history.", code=ERROR_TOO_FAR_BEHIND, channel_id=channel_id)
+            return
+
+        await self.send_welcome_message(channel_id, history=([], None))
+        chunk_size = settings.CHAT_RESYNC_CHUNK_SIZE
+        sent = 0
+        resynced = set()
+        while True:
+            try:
+                messages = await self.get_messages_since(channel_id, since, chunk_size)
+            except Exception as e:
+                logger.error(f"Error loading resync messages: {e}")
+                await self.send_error("Couldn't load missed messages.", channel_id=channel_id)
+                return
+            sent += len(messages)
+            resynced.update(message['id'] for message in messages)
+            # Bounded even if the gap grew since the check, newer messages arrive live
+            done = len(messages) < chunk_size or sent >= settings.CHAT_RESYNC_MAX_MESSAGES
+            frame = self.encode(self.tag(channel_id, {
+                'type': MESSAGE_TYPE_RESYNC,
+                'messages': messages,
+                'done': done,
+            }))
+            if messages and self.outbound is not None:
+                # Only what this chunk sends again, queued messages past the cap still go out
+                self.outbound.discard(channel_id, since, messages[-1]['id'])
+            await self.send_outbound(frame, channel_id, messages[-1]['id'] if messages else None, kind=KIND_REPLY)
+            if messages:
+                since = messages[-1]['id']
+            if done:
+                break
+        if self.outbound is not None:
+            self.outbound.requeue(channel_id, since)
+        if resynced:
+            self.resynced[channel_id] = (resynced, max(resynced))
+
+    async def get_welcome_history(self, channel_id):
+        from chat.pagination import encode_cursor
+        limit = settings.CHAT_HISTORY_LENGTH
+
+        try:
+            history = await recent_history.get(channel_id)
+        except Exception as e:
+            logger.error(f"Error reading recent history: {e}")
+            history = None
+
+        if history is None:
+            history, next_cursor = await self.get_recent_messages(channel_id, limit=limit)
+            await self.fill_recent_history(channel_id, history)
+            return history, next_cursor
+
+        history = history[:limit]
+        if len(history) < limit:
+            return history, None
+        last = history[-1]
+        return history, encode_cursor(datetime.fromisoformat(last['created_at']), last['id'])
+
+    async def fill_recent_history(self, channel_id, history):
+        try:
+            await recent_history.fill(channel_id, history)
+        except Exception as e:
+            logger.error(f"Error filling recent history: {e}")
+
+    async def get_online_users(self, channel_id):
+        try:
+            return await presence.online(channel_id)
+        except Exception as e:
+            logger.error(f"Error reading presence: {e}")
+            return []
+
+    async def send_history(self, channel_id, before):
+        try:
+            serialized_messages, next_cursor = await self.get_recent_messages(channel_id, before=before)
+        except ValueError:
+            await self.send_error("Invalid cursor.", channel_id=channel_id)
+            return
 
-    async def send_error(self, error_message):
+        history_data = {
+            'type': MESSAGE_TYPE_HISTORY,
+            'history': serialized_messages,
+            'next': next_cursor
+        }
+        await self.send_data(self.tag(channel_id, history_data))
+
+    async def mark_read(self, channel_id, message_id):
+        """
+        Moves the read pointer to ``message_id`` and answers with the unread
+        count. Members get it in the channel's next ``read_receipt`` frame
+        when the pointer moved.
+        """
+        if not isinstance(message_id, int) or isinstance(message_id, bool) or message_id < 1:
+            await self.send_error("Invalid id, expected a message id.", channel_id=channel_id)
+            return
+
+        user = self.scope['user']
+        try:
+            if not await self.has_permission_to_channel(user, channel_id):
+                await self.send_error("You do not have permission to access this channel.", code=ERROR_FORBIDDEN,
+                                      channel_id=channel_id)
+                return
+            last_read_id, unread = await self.update_read_state(channel_id, user, message_id)
+        except ObjectDoesNotExist:
+            await self.send_error("Message does not exist.", channel_id=channel_id)
+            return
+        except Exception as e:
+            logger.error(f"Error marking messages read: {e}")
+            await self.send_error("Internal server error.", channel_id=channel_id)
+            return
+
+        await self.send_data(self.tag(channel_id, {
+            'type': MESSAGE_TYPE_READ,
+            'last_read_id': last_read_id,
+            'unread': unread,
+        }))
+        if last_read_id == message_id:
+            # Coalesced per channel like typing, not one room-wide send per pointer move
+            presence_notifier.read(channel_id, user.username, last_read_id)
+
+    async def send_error(self, error_message, code=None, channel_id=None):
         error_data = {
             'type': MESSAGE_TYPE_ERROR,
             'message': error_message
         }
-        await self.send(text_data=json.dumps(error_data))
+        if code is not None:
+            error_data['code'] = code
+        if channel_id is not None:
+            error_data = self.tag(channel_id, error_data)
+        await self.send_data(error_data)
 
     async def force_disconnect(self, event):
-        target_user_id = event['user_id']
+        target_user_ids = event['user_ids'] if 'user_ids' in event else [event['user_id']]
 
-        if self.scope['user'].id == target_user_id:
+        if self.scope['user'].id in target_user_ids:
             await self.close(code=4000, reason='You were deleted from chat')
 
+    async def history_invalidate(self, event):
+        if claim_invalidation(event):
+            recent_history.invalidate(event['channel_id'])
+
+    async def membership_invalidate(self, event):
+        user = self.scope['user']
+        if event.get('revoke') and user.id in (event.get('user_ids') or ()):
+            # Every socket of the user, not only the one claiming the event
+            try:
+                self.scope['user'] = await get_user_from_db(user.id)
+            except ObjectDoesNotExist:
+                await self.close()
+                return
+        if not claim_invalidation(event):
+            return
+        invalidate_membership(event.get('channel_id'), event.get('user_ids'))
+        if event.get('revoke'):
+            for user_id in event.get('user_ids') or ():
+                revoke_user(user_id)
+
+    @database_sync_to_async
+    def get_recent_messages(self, channel_id, before=None, limit=None):
+        from chat.models import Message
+        from chat.pagination import encode_cursor, paginate_messages
+        from chat.serializers import message_payload
+        queryset = Message.objects.filter(channel_id=channel_id).select_related('sender')
+        messages, has_more = paginate_messages(queryset, before=before, limit=limit or settings.CHAT_HISTORY_LENGTH)
+        next_cursor = encode_cursor(messages[-1].created_at, messages[-1].id) if has_more else None
+        return [message_payload(message, message.sender.username) for message in messages], next_cursor
+
     @database_sync_to_async
-    def get_recent_messages(self, limit=20):
+    def is_too_far_behind(self, channel_id, since):
         from chat.models import Message
-        return Message.objects.filter(channel_id=self.channel_id).select_related('sender').order_by('-created_at')[:limit]
+        return Message.objects.filter(channel_id=channel_id, id__gt=since).order_by('id')[
+            settings.CHAT_RESYNC_MAX_MESSAGES:
+        ].exists()
 
     @database_sync_to_async
-    def serialize_messages(self, messages):
-        from chat.serializers import MessageSerializer
-        return MessageSerializer(messages, many=True).data
+    def get_messages_since(self, channel_id, since, limit):
+        from chat.models import Message
+        from chat.serializers import message_payload
+        # Range scan of message_channel_id_idx
+        messages = Message.objects.filter(channel_id=channel_id, id__gt=since).select_related('sender').order_by('id')
+        return [message_payload(message, message.sender.username) for message in messages[:limit]]
 
     @database_sync_to_async
-    def serialize_message(self, message):
-        from chat.serializers import MessageSerializer
-        return MessageSerializer(message).data
+    def create_message(self, channel_id, user, content):
+        from chat.models import Message
+        from chat.serializers import message_payload
+        if user.is_blocked:
+            raise ValidationError("User is blocked.")
+        message = Message.objects.create(channel_id=channel_id, sender_id=user.id, content=content)
+        return message_payload(message, user.username)
 
     @database_sync_to_async
-    def create_message(self, user, content):
-        from chat.models import Message, Channel
-        channel = Channel.objects.prefetch_related('members').get(id=self.channel_id)
+    def update_read_state(self, channel_id, user, message_id):
+        from chat.unread import mark_read
+        return mark_read(user.id, channel_id, message_id)
+
+    async def buffer_message(self, channel_id, user, content):
+        from chat.models import Message
+        from chat.serializers import message_payload
         if user.is_blocked:
             raise ValidationError("User is blocked.")
-        return Message.objects.create(channel=channel, sender=user, content=content)
+        message = Message(channel_id=channel_id, sender_id=user.id, content=content, created_at=timezone.now())
+        future = write_buffer.add(message)
+        if settings.MESSAGE_WRITE_BEHIND_ACK == ACK_AFTER_FLUSH:
+            message = await future
+        else:
+            # No thread hop or cache invalidation per message, the recent history gets it after the flush
+            future.add_done_callback(functools.partial(self.buffered_message_written, channel_id, user.username))
+        return message_payload(message, user.username)
+
+    async def has_permission_to_channel(self, user, channel_id, use_cache=True) -> bool:
+        key = (channel_id, user.id)
+        if use_cache:
+            has_permission = membership_cache.get(key)
+            if has_permission is not None:
+                return has_permission
+
+        has_permission = await self.check_permission_to_channel(user, channel_id)
+        membership_cache.set(key, has_permission)
+        return has_permission
 
     @database_sync_to_async
-    def has_permission_to_channel(self, user, channel_id) -> bool:
-        from chat.models import Channel
+    def check_permission_to_channel(self, user, channel_id) -> bool:
+        from django.db.models import Exists, Q
+        from chat.models import Channel, User
+        return User.objects.filter(
+            Exists(Channel.objects.filter(id=channel_id)),
+            Q(is_moderator=True) | Q(channels=channel_id, is_blocked=False),
+            pk=user.id,
+        ).exists()
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    One socket for many channels: ``ws/chat/``.
+
+    Clients send ``{"action": "subscribe", "channels": [...]}`` and
+    ``{"action": "unsubscribe", "channels": [...]}``, every other action names
+    its ``channel``. A subscribe may carry ``"since": {"<channel id>": <message
+    id>}`` to resync those channels like ``ws/chat/<id>?since=``. Channel-scoped frames are sent with a ``channel`` key,
+    chat messages already carry it. A subscribe checks permissions for all
+    requested channels in one query and loads the history missing from the
+    recent history cache in another.
+    """
+
+    def tag(self, channel_id, data):
+        return {**data, 'channel': channel_id}
+
+    @timed(WS_EVENT_SECONDS.labels('connect'))
+    async def connect(self):
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
+
+        self.channel_ids = set()
+        await self.accept_negotiated()
+        self.joined = True
+        WS_CONNECTIONS.inc()
+        self.start_outbound()
+
+    @timed(WS_EVENT_SECONDS.labels('disconnect'))
+    async def disconnect(self, close_code):
+        if self.joined:
+            self.joined = False
+            WS_CONNECTIONS.dec()
+            self.stop_outbound()
+            await self.unsubscribe(list(self.channel_ids))
+        await message_counter.drain()
+
+    @timed(WS_EVENT_SECONDS.labels('receive'))
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            channel = Channel.objects.prefetch_related('members').get(id=channel_id)
-            return user.is_moderator or (user in channel.members.all() and not user.is_blocked)
-        except Channel.DoesNotExist:
-            return False
\ No newline at end of file
+            data = self.decode(text_data, bytes_data)
+        except ValueError:
+            await self.send_error("Invalid MessagePack format." if bytes_data is not None else "Invalid JSON format.")
+            return
+
+        action = data.get('action', ACTION_MESSAGE)
+        if action in (ACTION_SUBSCRIBE, ACTION_UNSUBSCRIBE):
+            channel_ids = data.get('channels')
+            if not isinstance(channel_ids, list) or not all(
+                isinstance(channel_id, int) and not isinstance(channel_id, bool) for channel_id in channel_ids
+            ):
+                await self.send_error("Expected a list of channel ids.")
+                return
+            if not await check_subscribe_rate_limit(self.scope['user']):
+                await self.send_error("Too many subscriptions, slow down.", code=ERROR_RATE_LIMITED)
+                return
+            if action == ACTION_SUBSCRIBE:
+                since = data.get('since') or {}
+                if not isinstance(since, dict):
+                    await self.send_error("Expected since to map channel ids to message ids.")
+                    return
+                # JSON object keys are strings, MessagePack map keys may be ints
+                since = {str(channel_id): message_id for channel_id, message_id in since.items()}
+                await self.subscribe(channel_ids, since)
+            else:
+                for channel_id in await self.unsubscribe(channel_ids):
+                    await self.send_data({'type': MESSAGE_TYPE_UNSUBSCRIBED, 'channel': channel_id})
+            return
+
+        channel_id = data.get('channel')
+        if channel_id not in self.channel_ids:
+            await self.send_error("Not subscribed to this channel.", code=ERROR_NOT_SUBSCRIBED)
+            return
+        await self.handle_channel_action(channel_id, action, data)
+
+    async def subscribe(self, channel_ids, since=None):
+        since = since or {}
+        channel_ids = list(dict.fromkeys(channel_ids))
+        # Subscribing again with since resyncs, e.g. after a lagged notice
+        for channel_id in channel_ids:
+            if channel_id in self.channel_ids and str(channel_id) in since:
+                await self.resync(channel_id, since[str(channel_id)])
+
+        channel_ids = [channel_id for channel_id in channel_ids if channel_id not in self.channel_ids]
+        if len(self.channel_ids) + len(channel_ids) > settings.CHAT_MULTIPLEX_MAX_CHANNELS:
+            await self.send_error(
+                f"At most {settings.CHAT_MULTIPLEX_MAX_CHANNELS} channels per connection.", code=ERROR_TOO_MANY_CHANNELS
+            )
+            return
+        if not channel_ids:
+            return
+
+        user = self.scope['user']
+        try:
+            allowed = await self.check_permission_to_channels(user, channel_ids)
+        except Exception as e:
+            logger.error(f"Error checking permissions: {e}")
+            await self.send_error("Internal server error.")
+            return
+
+        for channel_id in channel_ids:
+            membership_cache.set((channel_id, user.id), channel_id in allowed)
+        denied = [channel_id for channel_id in channel_ids if channel_id not in allowed]
+        if denied:
+            await self.send_data({
+                'type': MESSAGE_TYPE_ERROR,
+                'message': "You do not have permission to access these channels.",
+                'code': ERROR_FORBIDDEN,
+                'channels': denied,
+            })
+
+        channel_ids = [channel_id for channel_id in channel_ids if channel_id in allowed]
+        for channel_id in channel_ids:
+            await self.channel_layer.group_add(f'chat_{channel_id}', self.channel_name)
+            self.channel_ids.add(channel_id)
+            await self.join_channel(channel_id)
+
+        histories = await self.get_welcome_histories([
+            channel_id for channel_id in channel_ids if str(channel_id) not in since
+        ])
+        for channel_id in channel_ids:
+            if str(channel_id) in since:
+                await self.resync(channel_id, since[str(channel_id)])
+            else:
+                await self.send_welcome_message(channel_id, histories.get(channel_id))
+
+    async def unsubscribe(self, channel_ids):
+        """Returns the channels actually left."""
+        left = []
+        for channel_id in channel_ids:
+            if channel_id not in self.channel_ids:
+                continue
+            self.channel_ids.discard(channel_id)
+            await self.leave_channel(channel_id)
+            await self.channel_layer.group_discard(f'chat_{channel_id}', self.channel_name)
+            left.append(channel_id)
+        return left
+
+    async def get_welcome_histories(self, channel_ids):
+        """Welcome history of every channel, cached ones first and the rest in one query."""
+        histories = {}
+        missing = []
+        for channel_id in channel_ids:
+            try:
+                history = await recent_history.get(channel_id)
+            except Exception as e:
+                logger.error(f"Error reading recent history: {e}")
+                history = None
+            if history is None:
+                missing.append(channel_id)
+            else:
+                histories[channel_id] = await self.get_welcome_history(channel_id)
+
+        if missing:
+            try:
+                loaded = await self.get_recent_messages_batch(missing, settings.CHAT_HISTORY_LENGTH)
+            except Exception as e:
+                logger.error(f"Error loading message history: {e}")
+                return histories
+            for channel_id, (history, next_cursor) in loaded.items():
+                await self.fill_recent_history(channel_id, history)
+                histories[channel_id] = history, next_cursor
+        return histories
+
+    async def force_disconnect(self, event):
+        target_user_ids = event['user_ids'] if 'user_ids' in event else [event['user_id']]
+        if self.scope['user'].id not in target_user_ids:
+            return
+
+        channel_id = event.get('channel_id')
+        if channel_id is None:
+            await self.close(code=4000, reason='You were deleted from chat')
+            return
+        await self.unsubscribe([channel_id])
+        await self.send_data({
+            'type': MESSAGE_TYPE_UNSUBSCRIBED,
+            'channel': channel_id,
+            'message': 'You were deleted from chat',
+        })
+
+    @database_sync_to_async
+    def get_recent_messages_batch(self, channel_ids, limit):
+        from django.db.models import F, Window
+        from django.db.models.functions import RowNumber
+        from chat.models import Message
+        from chat.pagination import encode_cursor
+        from chat.serializers import message_payload
+
+        # The newest limit + 1 messages of every channel, the extra one tells whether there are more
+        messages = Message.objects.filter(channel_id__in=channel_ids).annotate(
+            row_number=Window(
+                RowNumber(), partition_by=F('channel_id'), order_by=[F('created_at').desc(), F('id').desc()]
+            )
+        ).filter(row_number__lte=limit + 1).select_related('sender').order_by('channel_id', 'row_number')
+
+        by_channel = {channel_id: [] for channel_id in channel_ids}
+        for message in messages:
+            by_channel[message.channel_id].append(message)
+
+        histories = {}
+        for channel_id, page in by_channel.items():
+            next_cursor = encode_cursor(page[limit - 1].created_at, page[limit - 1].id) if len(page) > limit else None
+            histories[channel_id] = [message_payload(message, message.sender.username) for message in page[:limit]], next_cursor
+        return histories
+
+    @database_sync_to_async
+    def check_permission_to_channels(self, user, channel_ids):
+        from django.db.models import Exists, OuterRef, Q
+        from chat.models import Channel, User
+        return set(Channel.objects.filter(
+            Exists(User.objects.filter(
+                Q(is_moderator=True) | Q(channels=OuterRef('pk'), is_blocked=False), pk=user.id,
+            )),
+            pk__in=channel_ids,
+        ).values_list('id', flat=True))
@@ -0,0 +1,74 @@
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from chat.metrics import DB_CALL_SECONDS, DB_QUEUE_SECONDS, is_enabled
+
+_submitted_at = contextvars.ContextVar('database_sync_to_async_submitted_at', default=None)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Dedicated pool for database calls when ``CHAT_DB_EXECUTOR_WORKERS`` is set.
+
+    By default calls are thread-sensitive, so every database call of the
+    process runs on one shared thread. Size the pool like the connection pool,
+    every worker thread holds its own connection.
+    """
+    global _executor
+    if settings.CHAT_DB_EXECUTOR_WORKERS <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.CHAT_DB_EXECUTOR_WORKERS, thread_name_prefix='chat-db')
+        return _executor
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """
+    ``database_sync_to_async`` recording call latency and thread pool queue time.
+
+    Django 5.1's async ORM methods (``aget``, ``acreate``, ...) are
+    ``sync_to_async(thread_sensitive=True)`` wrappers themselves. They cost the
+    same hop per call without closing stale connections, so consumers group
+    their queries into one call of this instead.
+    """
+
+    def __init__(self, func, thread_sensitive=True, executor=None):
+        name = getattr(func, '__qualname__', repr(func))
+        self._call_seconds = DB_CALL_SECONDS.labels(name)
+
+        @functools.wraps(func)
+        def timed(*func_args, **func_kwargs):
+            # Runs in the worker thread, inside a copy of the caller's context.
+            submitted_at = _submitted_at.get()
+            if submitted_at is not None and is_enabled():
+                DB_QUEUE_SECONDS.observe(time.perf_counter() - submitted_at)
+            return func(*func_args, **func_kwargs)
+
+        executor = executor or get_executor()
+        if executor is not None:
+            thread_sensitive = False
+        super().__init__(timed, thread_sensitive=thread_sensitive, executor=executor)
+
+    async def __call__(self, *args, **kwargs):
+        if not is_enabled():
+            return await super().__call__(*args, **kwargs)
+        started = time.perf_counter()
+        token = _submitted_at.set(started)
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            _submitted_at.reset(token)
+            self._call_seconds.observe(time.perf_counter() - started)
+
+
+database_sync_to_async = InstrumentedDatabaseSyncToAsync
@@ -0,0 +1,91 @@
+import asyncio
+import atexit
+import logging
+import queue
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+
+from chat.metrics import group_send
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_BACKGROUND = 'background'
+DISPATCH_INLINE = 'inline'
+
+
+class EventDispatcher:
+    """
+    Sends channel layer group events on behalf of sync code (views, signals).
+
+    In background mode batches are queued and sent by a daemon thread with its
+    own event loop, so a request never waits on the channel layer. Batches
+    queued while a send is in flight are merged and their group_send calls run
+    concurrently. The in-memory layer is not thread-safe and is always served
+    inline.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def send(self, events):
+        """Queue ``(group, event)`` pairs."""
+        events = list(events)
+        if not events:
+            return
+
+        channel_layer = get_channel_layer()
+        if settings.CHAT_EVENT_DISPATCH == DISPATCH_INLINE or isinstance(channel_layer, InMemoryChannelLayer):
+            async_to_sync(self._send)(channel_layer, events)
+            return
+
+        self._ensure_thread()
+        self._queue.put(events)
+
+    def flush(self):
+        """Block until every queued batch has been sent."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='chat-event-dispatch', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        while True:
+            batches = [self._queue.get()]
+            while True:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            events = [event for batch in batches for event in batch]
+            try:
+                loop.run_until_complete(self._send(get_channel_layer(), events))
+            except Exception as e:
+                logger.error(f"Error dispatching {len(events)} channel layer events: {e}")
+            finally:
+                for _ in batches:
+                    self._queue.task_done()
+
+    @staticmethod
+    async def _send(channel_layer, events):
+        results = await asyncio.gather(
+            *(group_send(channel_layer, group, event) for group, event in events), return_exceptions=True
+        )
+        for (group, event), result in zip(events, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending {event['type']} to {group}: {result}")
+
+
+dispatcher = EventDispatcher()
+atexit.register(dispatcher.flush)
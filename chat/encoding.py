@@ -0,0 +1,91 @@
+import functools
+import json
+from datetime import datetime
+
+import msgpack
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(data):
+    return json.dumps(data)
+
+
+def _orjson_dumps(data):
+    return orjson.dumps(data).decode()
+
+
+def get_encoder(name):
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ImportError("CHAT_JSON_ENCODER is 'orjson' but orjson is not installed.")
+        return _orjson_dumps, orjson.loads
+    return _json_dumps, json.loads
+
+
+dumps, loads = get_encoder(settings.CHAT_JSON_ENCODER)
+
+
+# Binary mode: MessagePack frames over bytes_data, negotiated per connection
+# with the chat.msgpack subprotocol or ?format=msgpack. Messages carry the
+# sender's id and a millisecond timestamp, message lists come with one
+# {sender id: username} dictionary per frame.
+SUBPROTOCOL_MSGPACK = 'chat.msgpack'
+FORMAT_MSGPACK = 'msgpack'
+
+
+def pack(data):
+    return msgpack.packb(data)
+
+
+def unpack(data):
+    return msgpack.unpackb(data, strict_map_key=False)
+
+
+def timestamp_ms(created_at):
+    """Milliseconds since the epoch of a ``format_datetime`` string."""
+    return int(datetime.fromisoformat(created_at).timestamp() * 1000)
+
+
+def compact_message(payload):
+    """Binary form of a ``message_payload`` dict, without the sender's name."""
+    return {
+        'id': payload['id'],
+        'channel': payload['channel'],
+        'sender': payload['sender_id'],
+        'content': payload['content'],
+        'ts': timestamp_ms(payload['created_at']),
+    }
+
+
+def pack_message(payload):
+    """A live chat message, which carries its sender's name as it may not be in any dictionary yet."""
+    return pack({**compact_message(payload), 'name': payload['sender']})
+
+
+def binary_frame(frame):
+    """Compacts the message list of a welcome, history or resync frame and adds its sender dictionary."""
+    for key in ('history', 'messages'):
+        if key in frame:
+            messages = frame[key]
+            return {
+                **frame,
+                key: [compact_message(message) for message in messages],
+                'senders': {message['sender_id']: message['sender'] for message in messages},
+            }
+    return frame
+
+
+@functools.lru_cache(maxsize=1024)
+def binary_from_text(text, chat_message=False):
+    """
+    MessagePack form of a JSON frame received from the channel layer, which
+    carries the JSON form only. Converted once per process however many
+    binary sockets it goes to, ``chat_message`` for live chat messages.
+    """
+    data = loads(text)
+    return pack_message(data) if chat_message else pack(data)
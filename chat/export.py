@@ -0,0 +1,63 @@
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from chat.serializers import format_datetime
+
+# Rows are grouped into chunks of roughly this size before being yielded so
+# the response is not written one tiny line at a time.
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+
+def iter_ndjson(queryset):
+    """Yield NDJSON-encoded messages in bounded chunks using a server-side cursor."""
+    rows = queryset.order_by('created_at', 'id').values_list(
+        'id', 'sender__username', 'content', 'created_at'
+    ).iterator(chunk_size=settings.MESSAGE_EXPORT_CHUNK_SIZE)
+
+    buffer = []
+    buffered = 0
+    for message_id, sender, content, created_at in rows:
+        line = json.dumps({
+            'id': message_id,
+            'sender': sender,
+            'content': content,
+            'created_at': format_datetime(created_at),
+        }, ensure_ascii=False) + '\n'
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= EXPORT_BUFFER_SIZE:
+            yield ''.join(buffer).encode()
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def aiter_chunks(chunks):
+    """
+    Async iterator over ``chunks`` for ASGI responses, which otherwise read a
+    sync iterator in full before sending anything.
+
+    Each chunk is pulled with a thread-sensitive ``sync_to_async``, so the
+    server-side cursor stays on the connection of the request's thread.
+    """
+    chunks = iter(chunks)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    try:
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            await sync_to_async(chunks.close, thread_sensitive=True)()
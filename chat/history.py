@@ -0,0 +1,186 @@
+import json
+import logging
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from chat.cache import TTLCache, claim_invalidation
+from chat.dispatch import dispatcher
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_TYPE_HISTORY_INVALIDATE = 'history_invalidate'
+
+
+class LocalHistory:
+    """
+    Per-process ring buffers of serialized recent messages.
+
+    Messages sent through other processes are appended when their group
+    event arrives, and invalidations as ``history_invalidate`` group events.
+    Both only reach processes with a socket in the channel, so buffers are
+    only kept while the channel has local sockets. ``RedisHistory`` keeps a
+    single copy however many workers there are.
+    """
+    shared = False
+
+    def __init__(self, length, ttl, max_channels):
+        self.length = length
+        self._buffers = TTLCache(max_channels, ttl)
+        # channel_id -> local sockets in the channel
+        self._watchers = {}
+
+    def watch(self, channel_id):
+        self._watchers[channel_id] = self._watchers.get(channel_id, 0) + 1
+
+    def unwatch(self, channel_id):
+        count = self._watchers.get(channel_id, 0) - 1
+        if count > 0:
+            self._watchers[channel_id] = count
+        else:
+            # Invalidation events for this channel stop reaching this process
+            self._watchers.pop(channel_id, None)
+            self._buffers.delete(channel_id)
+
+    async def get(self, channel_id):
+        buffer = self._buffers.get(channel_id)
+        return list(buffer) if buffer is not None else None
+
+    async def fill(self, channel_id, messages):
+        if channel_id not in self._watchers:
+            return
+        self._buffers.set(channel_id, deque(messages[:self.length], maxlen=self.length))
+
+    async def append(self, channel_id, message):
+        buffer = self._buffers.get(channel_id)
+        if buffer is None:
+            return
+        if not buffer or message['id'] > buffer[0]['id']:
+            buffer.appendleft(message)
+            return
+        # Messages of other processes can arrive after newer ones
+        if any(item['id'] == message['id'] for item in buffer):
+            return
+        messages = sorted([*buffer, message], key=lambda item: item['id'], reverse=True)
+        buffer.clear()
+        buffer.extend(messages[:self.length])
+
+    def invalidate(self, channel_id):
+        self._buffers.delete(channel_id)
+
+
+class RedisHistory:
+    """Recent messages kept in a capped Redis list per channel, newest first."""
+    shared = True
+
+    def __init__(self, length, ttl, url):
+        self.length = length
+        self.ttl = ttl
+        self.url = url
+        self._client = None
+        self._sync_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio
+            self._client = redis.asyncio.from_url(self.url)
+        return self._client
+
+    @property
+    def sync_client(self):
+        if self._sync_client is None:
+            import redis
+            self._sync_client = redis.Redis.from_url(self.url)
+        return self._sync_client
+
+    @staticmethod
+    def _keys(channel_id):
+        key = f'chat:history:{channel_id}'
+        return key, f'{key}:warm'
+
+    async def get(self, channel_id):
+        key, warm_key = self._keys(channel_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            warm, items = await pipe.exists(warm_key).lrange(key, 0, self.length - 1).execute()
+        if not warm:
+            return None
+        return [json.loads(item) for item in items]
+
+    def watch(self, channel_id):
+        pass
+
+    def unwatch(self, channel_id):
+        pass
+
+    async def fill(self, channel_id, messages):
+        """
+        Messages other workers appended since the miss are already in the
+        list and newer than the database read, they are merged in rather
+        than overwritten.
+        """
+        from redis.exceptions import WatchError
+
+        key, warm_key = self._keys(channel_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key, warm_key)
+                if await pipe.exists(warm_key):
+                    return
+                merged = {message['id']: message for message in messages}
+                merged.update(
+                    (message['id'], message)
+                    for message in (json.loads(item) for item in await pipe.lrange(key, 0, self.length - 1))
+                )
+                messages = sorted(merged.values(), key=lambda message: message['id'], reverse=True)[:self.length]
+
+                pipe.multi()
+                pipe.delete(key)
+                if messages:
+                    pipe.rpush(key, *(json.dumps(message) for message in messages))
+                    pipe.expire(key, self.ttl)
+                pipe.set(warm_key, 1, ex=self.ttl)
+                await pipe.execute()
+            except WatchError:
+                # Appended to or filled meanwhile, left for the next miss
+                pass
+
+    async def append(self, channel_id, message):
+        key, _ = self._keys(channel_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lpush(key, json.dumps(message))
+            pipe.ltrim(key, 0, self.length - 1)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    def invalidate(self, channel_id):
+        self.sync_client.delete(*self._keys(channel_id))
+
+
+def get_recent_history():
+    backend = import_string(settings.CHAT_HISTORY_BACKEND)
+    options = dict(settings.CHAT_HISTORY_OPTIONS)
+    return backend(length=settings.CHAT_HISTORY_LENGTH, ttl=settings.CHAT_HISTORY_TTL, **options)
+
+
+recent_history = get_recent_history()
+
+
+def history_invalidation_event(channel_id):
+    return {'type': MESSAGE_TYPE_HISTORY_INVALIDATE, 'event_id': uuid.uuid4().hex, 'channel_id': channel_id}
+
+
+def invalidate_recent_history(channel_id):
+    """
+    Drops the recent history of ``channel_id`` here and, with the local
+    backend, in every ASGI process with a socket in the channel.
+    """
+    recent_history.invalidate(channel_id)
+    if recent_history.shared:
+        return
+    event = history_invalidation_event(channel_id)
+    # Already applied here
+    claim_invalidation(event)
+    dispatcher.send([(f'chat_{channel_id}', event)])
@@ -0,0 +1,82 @@
+import asyncio
+import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+from channels_redis.pubsub import RedisPubSubChannelLayer, RedisPubSubLoopLayer
+from channels_redis.utils import _wrap_close, decode_hosts
+
+
+class HashRing:
+    """
+    Consistent hash ring over shard names.
+
+    Every shard is placed on the ring ``replicas`` times, so adding or removing
+    a shard only moves the keys of its neighbours instead of reshuffling the
+    whole keyspace the way ``crc32 % len(hosts)`` does.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        ring = sorted(
+            (self._hash(f'{node}#{replica}'), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(replicas)
+        )
+        self._keys = [key for key, _ in ring]
+        self._indexes = [index for _, index in ring]
+
+    @staticmethod
+    def _hash(value):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+    def get_index(self, value):
+        if len(self.nodes) == 1:
+            return 0
+        position = bisect.bisect(self._keys, self._hash(value)) % len(self._keys)
+        return self._indexes[position]
+
+
+def shard_name(host):
+    """Stable identity of a decoded channels_redis host entry."""
+    if 'address' in host:
+        return host['address']
+    if 'master_name' in host:
+        return f"sentinel:{host['master_name']}"
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}"
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """``RedisChannelLayer`` placing groups and channels on a consistent hash ring."""
+
+    def __init__(self, hosts=None, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing(shard_name(host) for host in self.hosts)
+
+    def consistent_hash(self, value):
+        return self.ring.get_index(value)
+
+
+class ShardedRedisPubSubLoopLayer(RedisPubSubLoopLayer):
+    def __init__(self, hosts=None, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing(shard_name(host) for host in decode_hosts(hosts))
+
+    def _get_shard(self, channel_or_group_name):
+        return self._shards[self.ring.get_index(channel_or_group_name)]
+
+
+class ShardedRedisPubSubChannelLayer(RedisPubSubChannelLayer):
+    """``RedisPubSubChannelLayer`` placing groups and channels on a consistent hash ring."""
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            layer = self._layers[loop]
+        except KeyError:
+            layer = ShardedRedisPubSubLoopLayer(*self._args, **self._kwargs, channel_layer=self)
+            self._layers[loop] = layer
+            _wrap_close(self, loop)
+        return layer
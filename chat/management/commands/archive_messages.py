@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Message
+from chat.retention import archive_channel, retention_cutoffs
+
+
+class Command(BaseCommand):
+    help = (
+        'Move messages older than their channel retention (Channel.retention_days, '
+        'CHAT_RETENTION_DAYS by default) to the archive table in batches.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--channel', type=int, action='append', help='Only this channel, may be repeated.')
+        parser.add_argument('--batch-size', type=int, help='Messages per transaction, CHAT_ARCHIVE_BATCH_SIZE by default.')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between batches.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the messages to archive.')
+
+    def handle(self, *args, **options):
+        total = 0
+        for channel_id, cutoff in retention_cutoffs(options['channel']):
+            if options['dry_run']:
+                count = Message.objects.filter(channel_id=channel_id, created_at__lt=cutoff).count()
+            else:
+                count = archive_channel(channel_id, cutoff, options['batch_size'], options['pause'])
+            if count:
+                self.stdout.write(f'Channel {channel_id}: {count} messages before {cutoff.isoformat()}')
+            total += count
+
+        verb = 'to archive' if options['dry_run'] else 'archived'
+        self.stdout.write(self.style.SUCCESS(f'{total} messages {verb}.'))
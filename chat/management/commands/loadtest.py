@@ -0,0 +1,227 @@
+import asyncio
+import json
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import (CaptureQueriesContext, override_settings, setup_test_environment,
+                               teardown_test_environment)
+
+
+def percentiles(samples):
+    if len(samples) < 2:
+        value = samples[0] if samples else None
+        return {'p50': value, 'p95': value, 'p99': value}
+    cuts = statistics.quantiles(samples, n=100)
+    return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate users over ws/chat/<channel_id> and the REST API against a throwaway '
+        'test database and report throughput, latency, queries and memory. Run with '
+        '--settings=benchmarks.settings for SQLite and the in-memory channel layer.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Simulated WebSocket users.')
+        parser.add_argument('--channels', type=int, default=10, help='Channels the users are spread over.')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent by every user.')
+        parser.add_argument('--interval', type=float, default=0.0, help='Seconds between messages of one user.')
+        parser.add_argument('--rest-requests', type=int, default=200, help='Requests per REST endpoint.')
+        parser.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for deliveries.')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+        parser.add_argument('--output', help='Also write the JSON report to this file.')
+
+    def handle(self, *args, **options):
+        connection = connections[DEFAULT_DB_ALIAS]
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            # Users send as fast as they can, a dropped message would leave its readers waiting until --timeout
+            with override_settings(CHAT_RATE_LIMIT={'rate': 0, 'burst': 0}, CHAT_RATE_LIMIT_CHANNELS={}):
+                report = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        encoded = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(encoded + '\n')
+        if options['json']:
+            self.stdout.write(encoded)
+        else:
+            self.print_report(report)
+
+    def run(self, options):
+        from chat.models import Channel, User
+        from chat.tokens import ChatRefreshToken
+
+        users = User.objects.bulk_create(
+            User(username=f'loadtest{i}', password='!') for i in range(options['users'])
+        )
+        channels = [
+            Channel.objects.create(name=f'loadtest{i}', owner=users[i % len(users)])
+            for i in range(options['channels'])
+        ]
+        members = {channel.pk: [] for channel in channels}
+        for i, user in enumerate(users):
+            channel = channels[i % len(channels)]
+            members[channel.pk].append(user)
+        for channel in channels:
+            channel.members.add(*members[channel.pk])
+
+        tokens = {user.pk: str(ChatRefreshToken.for_user(user).access_token) for user in users}
+        targets = [(channel.pk, tokens[user.pk], len(members[channel.pk])) for channel in channels for user in members[channel.pk]]
+
+        return {
+            'revision': git_revision(),
+            'database': connections[DEFAULT_DB_ALIAS].vendor,
+            'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+            'options': {key: options[key] for key in ('users', 'channels', 'messages', 'interval', 'rest_requests')},
+            'websocket': self.run_websocket(targets, options),
+            'rest': self.run_rest(users[0], tokens[users[0].pk], channels[0], options['rest_requests']),
+        }
+
+    def run_websocket(self, targets, options):
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+
+        from chat.middleware import JWTAuthMiddleware
+        from chat_api.routing import websocket_urlpatterns
+
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        connection = connections[DEFAULT_DB_ALIAS]
+        messages = options['messages']
+        latencies = []
+        result = {}
+
+        async def connect(channel_id, token):
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{channel_id}?token={token}')
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f'Could not connect to channel {channel_id}')
+            await communicator.receive_from()
+            return communicator
+
+        async def write(communicator, index):
+            for seq in range(messages):
+                await communicator.send_to(text_data=json.dumps({'message': f'{index}:{seq}:{time.perf_counter()}'}))
+                if options['interval']:
+                    await asyncio.sleep(options['interval'])
+
+        async def read(communicator, expected):
+            received = 0
+            while received < expected:
+                frame = json.loads(await communicator.receive_from(timeout=options['timeout']))
+                if frame.get('type') == 'error':
+                    raise RuntimeError(f"Error frame: {frame['message']}")
+                content = frame.get('content')
+                if content is None:
+                    continue
+                latencies.append(time.perf_counter() - float(content.rsplit(':', 1)[1]))
+                received += 1
+            return received
+
+        async def scenario():
+            tracemalloc.start()
+            memory_before = tracemalloc.get_traced_memory()[0]
+            communicators = await asyncio.gather(*(connect(channel_id, token) for channel_id, token, _ in targets))
+            result['memory_per_connection'] = (tracemalloc.get_traced_memory()[0] - memory_before) / len(targets)
+            tracemalloc.stop()
+
+            queries_before = len(connection.queries_log)
+            started = time.perf_counter()
+            readers = [
+                asyncio.create_task(read(communicator, messages * fan_out))
+                for communicator, (_, _, fan_out) in zip(communicators, targets)
+            ]
+            await asyncio.gather(*(write(communicator, i) for i, communicator in enumerate(communicators)))
+            delivered = await asyncio.gather(*readers)
+            result['elapsed'] = time.perf_counter() - started
+            result['queries'] = len(connection.queries_log) - queries_before
+            result['delivered'] = sum(delivered)
+
+            await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+        with CaptureQueriesContext(connection):
+            async_to_sync(scenario)()
+
+        sent = len(targets) * messages
+        return {
+            'connections': len(targets),
+            'messages_sent': sent,
+            'messages_delivered': result['delivered'],
+            'messages_per_second': sent / result['elapsed'],
+            'deliveries_per_second': result['delivered'] / result['elapsed'],
+            'delivery_latency_ms': {key: value * 1000 for key, value in percentiles(latencies).items()},
+            'queries_per_message': result['queries'] / sent,
+            'memory_per_connection_bytes': result['memory_per_connection'],
+        }
+
+    def run_rest(self, user, token, channel, requests):
+        from django.urls import reverse
+        from rest_framework.test import APIClient
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+        endpoints = {
+            'channel_list': (reverse('channel-list'), {}),
+            'message_list': (reverse('messages-list'), {'channel': channel.pk}),
+        }
+
+        report = {}
+        connection = connections[DEFAULT_DB_ALIAS]
+        for name, (url, params) in endpoints.items():
+            timings = []
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(requests):
+                    started = time.perf_counter()
+                    response = client.get(url, params)
+                    timings.append(time.perf_counter() - started)
+                    if response.status_code != 200:
+                        raise RuntimeError(f'{url} returned {response.status_code}')
+            report[name] = {
+                'requests_per_second': requests / sum(timings),
+                'latency_ms': {key: value * 1000 for key, value in percentiles(timings).items()},
+                'queries_per_request': len(queries) / requests,
+            }
+        return report
+
+    def print_report(self, report):
+        ws = report['websocket']
+        latency = ws['delivery_latency_ms']
+        self.stdout.write(f"revision {report['revision']}, {report['database']}, {report['channel_layer']}")
+        self.stdout.write(
+            f"websocket: {ws['connections']} connections, {ws['messages_sent']} sent, "
+            f"{ws['messages_delivered']} delivered"
+        )
+        self.stdout.write(f"  messages/sec        {ws['messages_per_second']:.1f}")
+        self.stdout.write(f"  deliveries/sec      {ws['deliveries_per_second']:.1f}")
+        self.stdout.write(
+            f"  delivery latency ms p50 {latency['p50']:.2f}  p95 {latency['p95']:.2f}  p99 {latency['p99']:.2f}"
+        )
+        self.stdout.write(f"  queries/message     {ws['queries_per_message']:.2f}")
+        self.stdout.write(f"  memory/connection   {ws['memory_per_connection_bytes'] / 1024:.1f} KiB")
+        for name, endpoint in report['rest'].items():
+            latency = endpoint['latency_ms']
+            self.stdout.write(
+                f"{name}: {endpoint['requests_per_second']:.1f} req/s, "
+                f"p50 {latency['p50']:.2f} p95 {latency['p95']:.2f} p99 {latency['p99']:.2f} ms, "
+                f"{endpoint['queries_per_request']:.2f} queries/request"
+            )
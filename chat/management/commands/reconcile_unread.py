@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Channel
+from chat.unread import reconcile_channel
+
+
+class Command(BaseCommand):
+    help = (
+        'Recount Channel.message_count and the read counts behind unread counters from the message '
+        'table, fixing any drift of the incremental counters.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--channel', type=int, action='append', help='Only this channel, may be repeated.')
+
+    def handle(self, *args, **options):
+        channels = Channel.objects.order_by('id')
+        if options['channel']:
+            channels = channels.filter(pk__in=options['channel'])
+
+        drifted = 0
+        for channel_id in channels.values_list('id', flat=True).iterator():
+            drift, fixed = reconcile_channel(channel_id)
+            if drift or fixed:
+                self.stdout.write(f'Channel {channel_id}: message count off by {drift}, {fixed} read states fixed')
+                drifted += 1
+
+        self.stdout.write(self.style.SUCCESS(f'{drifted} channels reconciled.'))
@@ -0,0 +1,60 @@
+from django.db import transaction
+
+from chat.cache import broadcast_membership_invalidation
+from chat.dispatch import dispatcher
+from chat.models import Channel
+from chat.unread import start_reading
+
+MESSAGE_TYPE_FORCE_DISCONNECT = 'force_disconnect'
+
+Membership = Channel.members.through
+
+
+def kick_users(channel_ids, user_ids):
+    """Close the sockets of ``user_ids`` in every channel, one event per channel group."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    dispatcher.send(
+        (f'chat_{channel_id}', {'type': MESSAGE_TYPE_FORCE_DISCONNECT, 'channel_id': channel_id, 'user_ids': user_ids})
+        for channel_id in channel_ids
+    )
+
+
+def add_members(channel_id, user_ids):
+    """
+    Insert membership rows directly, skipping rows that already exist.
+
+    Bypasses ``m2m_changed``, so the membership cache is invalidated here.
+    """
+    Membership.objects.bulk_create(
+        [Membership(channel_id=channel_id, user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+    start_reading(channel_id, user_ids)
+    broadcast_membership_invalidation([channel_id], user_ids)
+
+
+def remove_members(channel_id, user_ids):
+    """Delete membership rows and disconnect the removed users, returns their ids."""
+    with transaction.atomic():
+        removed = list(
+            Membership.objects.select_for_update()
+            .filter(channel_id=channel_id, user_id__in=user_ids)
+            .values_list('user_id', flat=True)
+        )
+        if removed:
+            Membership.objects.filter(channel_id=channel_id, user_id__in=removed).delete()
+    if removed:
+        kick_users([channel_id], removed)
+        broadcast_membership_invalidation([channel_id], removed)
+    return removed
+
+
+def remove_member(channel_id, user_id):
+    """Single-statement variant of ``remove_members``, returns whether a row was deleted."""
+    deleted, _ = Membership.objects.filter(channel_id=channel_id, user_id=user_id).delete()
+    if deleted:
+        kick_users([channel_id], [user_id])
+        broadcast_membership_invalidation([channel_id], [user_id])
+    return bool(deleted)
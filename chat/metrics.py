@@ -0,0 +1,194 @@
+import functools
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import Http404, HttpResponse
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_enabled = settings.METRICS_ENABLED
+
+
+def set_enabled(enabled):
+    """Switches recording on the timed paths (events, group_send, database calls, HTTP requests)."""
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+# Gauges sum over live processes in prometheus_client multiprocess mode
+WS_CONNECTIONS = Gauge('chat_ws_connections', 'Open WebSocket connections.', multiprocess_mode='livesum')
+WS_GROUPS = Gauge(
+    'chat_ws_groups', 'Channel layer groups with at least one local subscriber, summed over processes.',
+    multiprocess_mode='livesum',
+)
+WS_EVENT_SECONDS = Histogram(
+    'chat_ws_event_seconds', 'Time spent in ChatConsumer connect, receive and disconnect.', ['event'],
+    buckets=LATENCY_BUCKETS,
+)
+WS_HANDSHAKE_SECONDS = Histogram(
+    'chat_ws_handshake_seconds', 'WebSocket token check latency by outcome.', ['outcome'], buckets=LATENCY_BUCKETS,
+)
+GROUP_SEND_SECONDS = Histogram('chat_group_send_seconds', 'Channel layer group_send latency.', buckets=LATENCY_BUCKETS)
+WS_OUTBOUND_QUEUED = Gauge(
+    'chat_ws_outbound_queued', 'Frames waiting in per-connection outbound queues.', multiprocess_mode='livesum'
+)
+WS_OUTBOUND_DROPPED = Counter(
+    'chat_ws_outbound_dropped_total', 'Frames dropped because the outbound queue was full.', ['kind']
+)
+WS_SLOW_CLOSED = Counter('chat_ws_slow_closed_total', 'Sockets closed for dropping frames for too long.')
+RATE_LIMIT = Counter('chat_rate_limit_total', 'Rate limited frames by action and outcome.', ['action', 'outcome'])
+DB_CALL_SECONDS = Histogram(
+    'chat_db_call_seconds', 'database_sync_to_async calls, from the await to the result.', ['function'],
+    buckets=LATENCY_BUCKETS,
+)
+DB_QUEUE_SECONDS = Histogram(
+    'chat_db_queue_seconds', 'Time database_sync_to_async calls wait for a worker thread.', buckets=LATENCY_BUCKETS
+)
+DB_CONNECTIONS_OPENED = Counter(
+    'chat_db_connections_opened_total', 'Database connections opened by Django (checkouts when pooled).', ['alias']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'chat_http_request_seconds', 'HTTP request latency.', ['view', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+HTTP_REQUEST_QUERIES = Histogram(
+    'chat_http_request_queries', 'Database queries per HTTP request.', ['view'], buckets=QUERY_COUNT_BUCKETS
+)
+
+_group_members = {}
+_group_lock = threading.Lock()
+
+
+def track_group(group, delta):
+    """Count local subscribers of ``group`` and keep ``chat_ws_groups`` in sync."""
+    with _group_lock:
+        count = _group_members.get(group, 0) + delta
+        if count > 0:
+            _group_members[group] = count
+        else:
+            _group_members.pop(group, None)
+        WS_GROUPS.set(len(_group_members))
+
+
+def timed(histogram):
+    """Decorator observing the duration of an async function in ``histogram``."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not _enabled:
+                return await func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+async def group_send(channel_layer, group, event):
+    if not _enabled:
+        await channel_layer.group_send(group, event)
+        return
+    started = time.perf_counter()
+    try:
+        await channel_layer.group_send(group, event)
+    finally:
+        GROUP_SEND_SECONDS.observe(time.perf_counter() - started)
+
+
+# psycopg_pool get_stats() keys exported as chat_db_pool_<key>
+POOL_STATS = {
+    'pool_size': (GaugeMetricFamily, 'Connections managed by the pool, in use or idle.'),
+    'pool_available': (GaugeMetricFamily, 'Idle connections in the pool.'),
+    'requests_waiting': (GaugeMetricFamily, 'Clients waiting for a connection.'),
+    'requests_num': (CounterMetricFamily, 'Connection requests served by the pool.'),
+    'requests_queued': (CounterMetricFamily, 'Connection requests that had to wait.'),
+    'connections_num': (CounterMetricFamily, 'Connections opened by the pool to the server.'),
+    'connections_lost': (CounterMetricFamily, 'Connections found broken by the pool.'),
+}
+
+
+class PoolCollector:
+    """Connection pool statistics, read at scrape time from the pools of the scraped process."""
+
+    def collect(self):
+        from django.db import connections
+
+        samples = {}
+        for conn in connections.all(initialized_only=True):
+            pool = getattr(type(conn), '_connection_pools', {}).get(conn.alias)
+            if pool is None:
+                continue
+            for stat, value in pool.get_stats().items():
+                samples.setdefault(stat, []).append((conn.alias, value))
+
+        for stat, (family, documentation) in POOL_STATS.items():
+            if stat in samples:
+                metric = family(f'chat_db_pool_{stat}', documentation, labels=['alias'])
+                for alias, value in samples[stat]:
+                    metric.add_metric([alias], value)
+                yield metric
+
+
+pool_collector = PoolCollector()
+REGISTRY.register(pool_collector)
+
+
+def get_registry():
+    """
+    The registry served on /metrics. With ``PROMETHEUS_MULTIPROC_DIR`` set
+    (gunicorn with several workers, see gunicorn.conf.py) it aggregates the
+    values every worker writes there, pool statistics stay those of the
+    worker answering the scrape.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(pool_collector)
+    return registry
+
+
+class MetricsMiddleware:
+    """Records latency and query count of every HTTP request, labelled by URL name."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not _enabled:
+            return self.get_response(request)
+
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.labels(view, request.method, str(response.status_code)).observe(elapsed)
+        HTTP_REQUEST_QUERIES.labels(view).observe(queries[0])
+        return response
+
+
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404()
+    return HttpResponse(generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST)
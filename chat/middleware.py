@@ -1,32 +1,108 @@
+import time
+from urllib.parse import parse_qs
+
 import jwt
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
+from django.conf import settings
+
+from chat.cache import TTLCache
+from chat.db import database_sync_to_async
+from chat.metrics import WS_HANDSHAKE_SECONDS
+from chat.tokens import USER_CLAIMS
+
+
+class ClaimsUser:
+    """Authenticated user built from token claims or a single user row."""
+
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def __init__(self, id, username, is_moderator, is_blocked):
+        self.id = self.pk = id
+        self.username = username
+        self.is_moderator = is_moderator
+        self.is_blocked = is_blocked
+
+    @classmethod
+    def from_claims(cls, payload):
+        return cls(payload['user_id'], *(payload[claim] for claim in USER_CLAIMS))
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, *(getattr(user, claim) for claim in USER_CLAIMS))
+
+    def __eq__(self, other):
+        from django.contrib.auth import get_user_model
+        if isinstance(other, (ClaimsUser, get_user_model())):
+            return self.pk == other.pk
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return self.username
+
+
+token_cache = TTLCache(settings.JWT_CACHE_SIZE, settings.JWT_CACHE_TTL)
+# user_id -> time.monotonic() of the last revocation (block, role change)
+revoked_users = TTLCache(settings.JWT_CACHE_SIZE, settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'].total_seconds())
+
+
+def record_handshake(outcome, started):
+    WS_HANDSHAKE_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+
+def revoke_user(user_id):
+    revoked_users.set(user_id, time.monotonic())
 
-from chat_api import settings
 
 @database_sync_to_async
-def get_user(token):
+def get_user_from_db(user_id):
+    from django.contrib.auth import get_user_model
+    return ClaimsUser.from_user(get_user_model().objects.get(id=user_id))
+
+
+async def get_user(token):
     from django.contrib.auth import get_user_model
     from django.contrib.auth.models import AnonymousUser
 
+    started = time.perf_counter()
+    cached = token_cache.get(token)
+    if cached is not None:
+        user, cached_at = cached
+        revoked_at = revoked_users.get(user.id)
+        if revoked_at is None or cached_at > revoked_at:
+            record_handshake('cache_hits', started)
+            return user
+
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.SIMPLE_JWT['ALGORITHM']])
-        user = get_user_model().objects.get(id=payload['user_id'])
-        return user
-    except (jwt.DecodeError, get_user_model().DoesNotExist):
+        if all(claim in payload for claim in USER_CLAIMS) and revoked_users.get(payload['user_id']) is None:
+            user = ClaimsUser.from_claims(payload)
+            outcome = 'claims'
+        else:
+            user = await get_user_from_db(payload['user_id'])
+            outcome = 'db_lookups'
+    except (jwt.InvalidTokenError, KeyError, get_user_model().DoesNotExist):
+        record_handshake('failures', started)
         return AnonymousUser()
 
+    # Never keep a token cached past its own expiry.
+    token_cache.set(token, (user, time.monotonic()), ttl=min(token_cache.ttl, payload['exp'] - time.time()))
+    record_handshake(outcome, started)
+    return user
+
 
 class JWTAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
         from django.contrib.auth.models import AnonymousUser
 
-        query_string = scope['query_string'].decode()
-        token = None
-        if 'token=' in query_string:
-            token = query_string.split('token=', 1)[1]
+        query = parse_qs(scope['query_string'].decode())
+        token = query.get('token', [None])[0]
         if token:
             scope['user'] = await get_user(token)
         else:
             scope['user'] = AnonymousUser()
-        return await super().__call__(scope, receive, send)
\ No newline at end of file
+        return await super().__call__(scope, receive, send)
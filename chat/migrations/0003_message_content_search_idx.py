@@ -0,0 +1,37 @@
+from django.db import migrations
+
+INDEX_NAME = 'message_content_search_idx'
+# Frozen here, the migration must build the same index whatever the settings
+# are when it runs. A different CHAT_SEARCH_CONFIG needs a migration of its own.
+SEARCH_CONFIG = 'simple'
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    from django.contrib.postgres.indexes import GinIndex
+    from django.contrib.postgres.search import SearchVector
+
+    Message = apps.get_model('chat', 'Message')
+    index = GinIndex(SearchVector('content', config=SEARCH_CONFIG), name=INDEX_NAME)
+    schema_editor.add_index(Message, index, concurrently=True)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY keeps the message table writable while the index builds
+    atomic = False
+
+    dependencies = [
+        ('chat', '0002_message_channel_created_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
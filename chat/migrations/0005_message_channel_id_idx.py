@@ -0,0 +1,17 @@
+# Generated by Django 5.1.2 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_channel_retention_days_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['channel', 'id'], name='message_channel_id_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_messages(apps, schema_editor):
+    Channel = apps.get_model('chat', 'Channel')
+    Message = apps.get_model('chat', 'Message')
+    counts = Message.objects.filter(channel_id=OuterRef('pk')).order_by().values('channel_id').annotate(
+        count=Count('*'),
+    ).values('count')
+    Channel.objects.update(message_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_channel_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='message_count',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_id', models.BigIntegerField()),
+                ('read_count', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.channel')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['channel', 'last_read_id'], name='readstate_channel_read_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'channel'), name='readstate_user_channel_unique')],
+            },
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
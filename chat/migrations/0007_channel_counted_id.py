@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:24
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_messages(apps, schema_editor):
+    Channel = apps.get_model('chat', 'Channel')
+    Message = apps.get_model('chat', 'Message')
+    messages = Message.objects.filter(channel_id=OuterRef('pk')).order_by().values('channel_id')
+    Channel.objects.update(
+        message_count=Coalesce(Subquery(messages.annotate(count=Count('*')).values('count')), 0),
+        counted_id=Coalesce(Subquery(messages.annotate(last_id=Max('id')).values('last_id')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_channel_message_count_readstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='counted_id',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
@@ -11,6 +11,13 @@ class Channel(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     members = models.ManyToManyField(User, related_name='channels')
     black_list = models.ManyToManyField(User, related_name='black_list', blank=True)
+    # Days messages are kept before archive_messages moves them out, 0 keeps them forever
+    # and unset falls back to CHAT_RETENTION_DAYS
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    # Live messages with id <= counted_id, so unread counts never COUNT the message table.
+    # New messages are counted in batches after their insert, reconcile_unread repairs any drift
+    message_count = models.PositiveBigIntegerField(default=0, editable=False)
+    counted_id = models.BigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -22,5 +29,53 @@ class Message(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['channel', 'created_at', 'id'], name='message_channel_created_idx'),
+            models.Index(fields=['channel', 'id'], name='message_channel_id_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.sender.username}: {self.content[:20]}'
+
+
+class ArchivedMessage(models.Model):
+    """Messages moved out of ``Message`` by ``archive_messages``, under their original ids."""
+    id = models.BigIntegerField(primary_key=True)
+    channel = models.ForeignKey(Channel, related_name='archived_messages', on_delete=models.CASCADE)
+    sender = models.ForeignKey(User, related_name='archived_messages', on_delete=models.CASCADE)
+    content = models.TextField()
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['channel', 'created_at', 'id'], name='archived_channel_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.sender.username}: {self.content[:20]}'
+
+
+class ReadState(models.Model):
+    """
+    How far ``user`` has read ``channel``: ``last_read_id`` is the newest
+    message read and ``read_count`` the number of messages up to it, so
+    ``message_count - read_count`` is the unread count.
+    """
+    user = models.ForeignKey(User, related_name='read_states', on_delete=models.CASCADE)
+    channel = models.ForeignKey(Channel, related_name='read_states', on_delete=models.CASCADE)
+    last_read_id = models.BigIntegerField()
+    read_count = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'channel'], name='readstate_user_channel_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['channel', 'last_read_id'], name='readstate_channel_read_idx'),
+        ]
+
     def __str__(self):
-        return f'{self.sender.username}: {self.content[:20]}'
\ No newline at end of file
+        return f'{self.user_id} read {self.channel_id} up to {self.last_read_id}'
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from chat.metrics import WS_OUTBOUND_DROPPED, WS_OUTBOUND_QUEUED
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_TYPE_LAGGED = 'lagged'
+
+KIND_CHAT = 'chat'
+KIND_EPHEMERAL = 'ephemeral'
+# Answers to the client's own requests, bounded by them, never dropped
+KIND_REPLY = 'reply'
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames between the channel layer and one socket.
+
+    Group events only append here, a writer task does the slow ``send``, so a
+    client on a bad link no longer stalls the consumer until the channel
+    layer drops its messages unseen. Once ``high_water`` frames are queued,
+    new frames are dropped until the queue drains to half of it. The client
+    then gets one ``lagged`` notice per affected channel, exactly where the
+    gap is: ``last_id`` is the last chat message it received before the gap,
+    to resync from. ``put`` returns False when the socket has kept dropping
+    for longer than ``lag_timeout`` seconds and should be closed.
+    """
+
+    def __init__(self, send, encode, high_water, lag_timeout):
+        self._send = send
+        self._encode = encode
+        self.high_water = high_water
+        self.low_water = max(1, high_water // 2)
+        self.lag_timeout = lag_timeout
+        self._frames = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # channel_id -> chat messages dropped since the last lagged notice
+        self.dropped = {}
+        # channel_id -> id of the last chat message queued
+        self.last_ids = {}
+        self.lagging_since = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, channel_id=None, message_id=None, kind=KIND_CHAT):
+        """``kind`` labels drops in metrics, only dropped chat messages are reported to the client."""
+        limit = self.high_water if self.lagging_since is None else self.low_water
+        if len(self._frames) >= limit and kind != KIND_REPLY:
+            WS_OUTBOUND_DROPPED.labels(kind).inc()
+            if kind != KIND_CHAT:
+                return True
+            self.dropped[channel_id] = self.dropped.get(channel_id, 0) + 1
+            now = time.monotonic()
+            if self.lagging_since is None:
+                self.lagging_since = now
+            return now - self.lagging_since <= self.lag_timeout
+
+        self._queue_lagged()
+        self._append(frame, channel_id, message_id)
+        if message_id is not None:
+            self.last_ids[channel_id] = message_id
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return True
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        WS_OUTBOUND_QUEUED.dec(len(self._frames))
+        self._frames.clear()
+
+    @staticmethod
+    def _between(entry, channel_id, after_id, up_to_id=None):
+        _, entry_channel_id, message_id = entry
+        return entry_channel_id == channel_id and message_id is not None and message_id > after_id and (
+            up_to_id is None or message_id <= up_to_id
+        )
+
+    def discard(self, channel_id, after_id, up_to_id):
+        """Drops the queued chat messages of ``channel_id`` with ``after_id < id <= up_to_id``, e.g. resynced."""
+        kept = deque(entry for entry in self._frames if not self._between(entry, channel_id, after_id, up_to_id))
+        WS_OUTBOUND_QUEUED.dec(len(self._frames) - len(kept))
+        self._frames = kept
+
+    def requeue(self, channel_id, after_id):
+        """Moves the queued chat messages of ``channel_id`` newer than ``after_id`` behind the rest, e.g. a resync."""
+        moved = [entry for entry in self._frames if self._between(entry, channel_id, after_id)]
+        if moved:
+            self._frames = deque(entry for entry in self._frames if not self._between(entry, channel_id, after_id))
+            self._frames.extend(moved)
+
+    def _append(self, frame, channel_id=None, message_id=None):
+        self._frames.append((frame, channel_id, message_id))
+        WS_OUTBOUND_QUEUED.inc()
+        self._wakeup.set()
+
+    def _queue_lagged(self):
+        if not self.dropped:
+            return
+        dropped, self.dropped = self.dropped, {}
+        self.lagging_since = None
+        for channel_id, count in dropped.items():
+            self._append(self._encode({
+                'type': MESSAGE_TYPE_LAGGED,
+                'channel': channel_id,
+                'dropped': count,
+                'last_id': self.last_ids.get(channel_id),
+            }))
+
+    async def _run(self):
+        while True:
+            if not self._frames:
+                # Drained with nothing queued after the gap
+                self._queue_lagged()
+            if not self._frames:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            frame, _, _ = self._frames.popleft()
+            WS_OUTBOUND_QUEUED.dec()
+            try:
+                await self._send(frame)
+            except Exception as e:
+                logger.error(f"Error sending frame: {e}")
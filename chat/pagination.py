@@ -0,0 +1,160 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_cursor(created_at, message_id):
+    raw = f'{created_at.isoformat()}|{message_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+
+
+def paginate_messages(queryset, before=None, after=None, limit=None):
+    """
+    Keyset pagination over ``(created_at, id)``.
+
+    Returns up to ``limit`` messages ordered newest first and whether more
+    messages exist past the page in the direction being read.
+    """
+    limit = limit or settings.MESSAGE_PAGE_SIZE
+
+    if after is not None:
+        created_at, message_id = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id)
+        ).order_by('created_at', 'id')
+    else:
+        if before is not None:
+            created_at, message_id = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+            )
+        queryset = queryset.order_by('-created_at', '-id')
+
+    messages = list(queryset[:limit + 1])
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after is not None:
+        messages.reverse()
+    return messages, has_more
+
+
+class MessageCursorPagination(BasePagination):
+    before_query_param = 'before'
+    after_query_param = 'after'
+    limit_query_param = 'limit'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.before = request.query_params.get(self.before_query_param)
+        self.after = request.query_params.get(self.after_query_param)
+
+        try:
+            self.page, self.has_more = paginate_messages(
+                queryset, before=self.before, after=self.after, limit=self.get_limit(request)
+            )
+        except ValueError:
+            raise NotFound('Invalid cursor')
+        return self.page
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return settings.MESSAGE_PAGE_SIZE
+        return max(1, min(limit, settings.MESSAGE_PAGE_MAX_SIZE))
+
+    def get_next_link(self):
+        # Older messages
+        if not self.page or (self.after is None and not self.has_more):
+            return None
+        last = self.page[-1]
+        url = remove_query_param(self.request.build_absolute_uri(), self.after_query_param)
+        return replace_query_param(url, self.before_query_param, encode_cursor(last.created_at, last.id))
+
+    def get_previous_link(self):
+        # Newer messages
+        if not self.page or (self.after is None and self.before is None) or (self.after is not None and not self.has_more):
+            return None
+        first = self.page[0]
+        url = remove_query_param(self.request.build_absolute_uri(), self.before_query_param)
+        return replace_query_param(url, self.after_query_param, encode_cursor(first.created_at, first.id))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class IdCursorPagination(CursorPagination):
+    """Cursor pagination for channel and member lists, ordered by primary key."""
+    ordering = 'id'
+    page_size = settings.CHANNEL_PAGE_SIZE
+    page_size_query_param = 'limit'
+    max_page_size = settings.CHANNEL_PAGE_MAX_SIZE
+
+
+class SearchCursorPagination(MessageCursorPagination):
+    """
+    Keyset pagination over ``(rank, id)``, best match first.
+
+    The cursor carries the rank of the last result, so every page is an
+    index-friendly range instead of an OFFSET over all matches.
+    """
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        queryset = queryset.order_by('-rank', '-id')
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor is not None:
+            try:
+                rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+                rank, message_id = float(rank), int(message_id)
+            except (binascii.Error, UnicodeDecodeError, ValueError):
+                raise NotFound('Invalid cursor')
+            queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=message_id))
+
+        limit = self.get_limit(request)
+        page = list(queryset[:limit + 1])
+        self.has_more = len(page) > limit
+        self.page = page[:limit]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        last = self.page[-1]
+        cursor = base64.urlsafe_b64encode(f'{last.rank!r}|{last.id}'.encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_previous_link(self):
+        return None
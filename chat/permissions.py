@@ -15,4 +15,9 @@ class IsOwnerOrModerator(permissions.BasePermission):
 
 class IsNotBlocked(permissions.BasePermission):
     def has_permission(self, request, view):
-        return not request.user.is_blocked
\ No newline at end of file
+        return not request.user.is_blocked
+
+
+class IsChannelOwnerOrModerator(permissions.BasePermission):
+    def has_object_permission(self, request, view, obj):
+        return obj.owner_id == request.user.id or request.user.is_moderator
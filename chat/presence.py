@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from chat.encoding import dumps
+from chat.metrics import group_send
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_TYPE_TYPING = 'typing'
+MESSAGE_TYPE_PRESENCE = 'presence'
+MESSAGE_TYPE_READ_RECEIPT = 'read_receipt'
+
+
+class LocalPresence:
+    """
+    Online users per channel, counted over the connections of this process.
+
+    A user stays online until the last of their connections to the channel
+    closes. Only sees this process, use ``RedisPresence`` with several workers.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # channel_id -> {user_id: [username, open connections]}
+        self._channels = {}
+
+    def _add(self, channel_id, user_id, username):
+        users = self._channels.setdefault(channel_id, {})
+        entry = users.setdefault(user_id, [username, 0])
+        entry[1] += 1
+        return entry[1] == 1
+
+    def _remove(self, channel_id, user_id):
+        users = self._channels.get(channel_id, {})
+        entry = users.get(user_id)
+        if entry is None:
+            return False
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+        del users[user_id]
+        if not users:
+            del self._channels[channel_id]
+        return True
+
+    async def join(self, channel_id, user_id, username):
+        """Returns whether the user just came online in the channel."""
+        return self._add(channel_id, user_id, username)
+
+    async def leave(self, channel_id, user_id):
+        """Returns whether the user just went offline in the channel."""
+        return self._remove(channel_id, user_id)
+
+    async def online(self, channel_id):
+        return sorted(username for username, _ in self._channels.get(channel_id, {}).values())
+
+    def clear(self):
+        self._channels.clear()
+
+
+class RedisPresence(LocalPresence):
+    """
+    Online users per channel shared by all workers.
+
+    Every worker keeps one member per online user in a sorted set per channel,
+    scored with its expiry. A single heartbeat task per worker refreshes all
+    of them every ``ttl / 3`` seconds, so members of a crashed worker expire.
+    """
+
+    def __init__(self, ttl, url):
+        super().__init__(ttl)
+        self.url = url
+        self.worker_id = uuid.uuid4().hex
+        self._client = None
+        self._heartbeat = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio
+            self._client = redis.asyncio.from_url(self.url, decode_responses=True)
+        return self._client
+
+    @staticmethod
+    def _key(channel_id):
+        return f'chat:presence:{channel_id}'
+
+    def _member(self, user_id, username):
+        return f'{user_id}|{self.worker_id}|{username}'
+
+    def _read_live_members(self, pipe, channel_id):
+        """Queue dropping expired members and reading the live ones on ``pipe``."""
+        now = time.time()
+        pipe.zremrangebyscore(self._key(channel_id), '-inf', now)
+        pipe.zrangebyscore(self._key(channel_id), now, '+inf')
+
+    def _has_other_member(self, members, user_id):
+        prefix = f'{user_id}|'
+        own = f'{user_id}|{self.worker_id}|'
+        return any(member.startswith(prefix) and not member.startswith(own) for member in members)
+
+    async def join(self, channel_id, user_id, username):
+        if not self._add(channel_id, user_id, username):
+            return False
+        self._start_heartbeat()
+        async with self.client.pipeline(transaction=True) as pipe:
+            self._read_live_members(pipe, channel_id)
+            pipe.zadd(self._key(channel_id), {self._member(user_id, username): time.time() + self.ttl})
+            pipe.expire(self._key(channel_id), self.ttl)
+            _, members, _, _ = await pipe.execute()
+        return not self._has_other_member(members, user_id)
+
+    async def leave(self, channel_id, user_id):
+        username = self._channels.get(channel_id, {}).get(user_id, [None])[0]
+        if not self._remove(channel_id, user_id):
+            return False
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._key(channel_id), self._member(user_id, username))
+            self._read_live_members(pipe, channel_id)
+            _, _, members = await pipe.execute()
+        return not self._has_other_member(members, user_id)
+
+    async def online(self, channel_id):
+        members = await self.client.zrangebyscore(self._key(channel_id), time.time(), '+inf')
+        return sorted({member.split('|', 2)[2] for member in members})
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.get_running_loop().create_task(self._run_heartbeat())
+
+    async def _run_heartbeat(self):
+        while self._channels:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing presence: {e}")
+
+    async def refresh(self):
+        expires_at = time.time() + self.ttl
+        async with self.client.pipeline(transaction=False) as pipe:
+            for channel_id, users in list(self._channels.items()):
+                pipe.zadd(self._key(channel_id), {
+                    self._member(user_id, username): expires_at for user_id, (username, _) in users.items()
+                })
+                pipe.expire(self._key(channel_id), self.ttl)
+            await pipe.execute()
+
+
+class PresenceNotifier:
+    """
+    Coalesces typing, join/leave and read receipt notifications per channel.
+
+    Whatever happened in a channel during ``CHAT_PRESENCE_INTERVAL_MS`` goes
+    out as at most one typing, one presence and one read receipt frame,
+    encoded once, however many users typed, came and went or read.
+    """
+
+    def __init__(self):
+        # channel_id -> {'typing': set, 'joined': set, 'left': set, 'read': {username: last_read_id}}
+        self._pending = {}
+        self._tasks = set()
+
+    def typing(self, channel_id, username):
+        self._get_pending(channel_id)['typing'].add(username)
+
+    def read(self, channel_id, username, last_read_id):
+        read = self._get_pending(channel_id)['read']
+        read[username] = max(last_read_id, read.get(username, 0))
+
+    def joined(self, channel_id, username):
+        pending = self._get_pending(channel_id)
+        if username in pending['left']:
+            pending['left'].discard(username)
+        else:
+            pending['joined'].add(username)
+
+    def left(self, channel_id, username):
+        pending = self._get_pending(channel_id)
+        if username in pending['joined']:
+            pending['joined'].discard(username)
+        else:
+            pending['left'].add(username)
+
+    def _get_pending(self, channel_id):
+        pending = self._pending.get(channel_id)
+        if pending is None:
+            pending = self._pending[channel_id] = {'typing': set(), 'joined': set(), 'left': set(), 'read': {}}
+            asyncio.get_running_loop().call_later(
+                settings.CHAT_PRESENCE_INTERVAL_MS / 1000, self._start_flush, channel_id
+            )
+        return pending
+
+    def clear(self):
+        self._pending.clear()
+
+    def _start_flush(self, channel_id):
+        task = asyncio.get_running_loop().create_task(self.flush(channel_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self, channel_id):
+        pending = self._pending.pop(channel_id, None)
+        if pending is None:
+            return
+
+        frames = []
+        if pending['typing']:
+            frames.append({'type': MESSAGE_TYPE_TYPING, 'channel': channel_id, 'users': sorted(pending['typing'])})
+        if pending['joined'] or pending['left']:
+            frames.append({
+                'type': MESSAGE_TYPE_PRESENCE,
+                'channel': channel_id,
+                'joined': sorted(pending['joined']),
+                'left': sorted(pending['left']),
+            })
+        if pending['read']:
+            frames.append({'type': MESSAGE_TYPE_READ_RECEIPT, 'channel': channel_id, 'read': pending['read']})
+
+        channel_layer = get_channel_layer()
+        for frame in frames:
+            try:
+                await group_send(channel_layer, f'chat_{channel_id}', {
+                    'type': 'send_frame', 'text': dumps(frame),
+                })
+            except Exception as e:
+                logger.error(f"Error sending {frame['type']} to channel {channel_id}: {e}")
+
+
+def get_presence():
+    backend = import_string(settings.CHAT_PRESENCE_BACKEND)
+    return backend(ttl=settings.CHAT_PRESENCE_TTL, **settings.CHAT_PRESENCE_OPTIONS)
+
+
+presence = get_presence()
+presence_notifier = PresenceNotifier()
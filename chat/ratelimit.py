@@ -0,0 +1,134 @@
+import logging
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from chat.cache import TTLCache
+from chat.metrics import RATE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Refill the bucket for the time elapsed since the last call, then take one
+# token. Uses the server clock so every worker sees the same time.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return allowed
+"""
+
+
+class LocalRateLimiter:
+    """
+    Per-process token buckets.
+
+    Every worker keeps its own buckets, so a client spreading connections over
+    several workers gets the limit once per worker; use ``RedisRateLimiter``
+    in multi-worker deployments.
+    """
+
+    def __init__(self, max_buckets):
+        self._buckets = TTLCache(max_buckets, ttl=0)
+
+    async def allow(self, key, rate, burst):
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # A bucket left alone this long is full again, no need to keep it.
+        self._buckets.set(key, (tokens, now), ttl=burst / rate)
+        return allowed
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class RedisRateLimiter:
+    """Token buckets shared by all workers, updated atomically by a Lua script."""
+
+    def __init__(self, url):
+        self.url = url
+        self._client = None
+        self._script = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio
+            self._client = redis.asyncio.from_url(self.url)
+        return self._client
+
+    async def allow(self, key, rate, burst):
+        if self._script is None:
+            self._script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        return bool(await self._script(keys=[f'chat:ratelimit:{key}'], args=[rate, burst]))
+
+
+def get_rate_limit(channel_id, user):
+    """``(rate, burst)`` for ``user`` in ``channel_id`` or ``None`` when unlimited."""
+    if user.is_moderator and settings.CHAT_RATE_LIMIT_EXEMPT_MODERATORS:
+        return None
+    return limit_of(settings.CHAT_RATE_LIMIT_CHANNELS.get(str(channel_id), settings.CHAT_RATE_LIMIT))
+
+
+def get_subscribe_rate_limit(user):
+    """``(rate, burst)`` of subscribe and unsubscribe frames of ``user`` or ``None`` when unlimited."""
+    if user.is_moderator and settings.CHAT_RATE_LIMIT_EXEMPT_MODERATORS:
+        return None
+    return limit_of(settings.CHAT_SUBSCRIBE_RATE_LIMIT)
+
+
+def limit_of(limit):
+    if not limit or not limit.get('rate'):
+        return None
+    return limit['rate'], limit['burst']
+
+
+async def take_token(key, limit, action):
+    if limit is None:
+        return True
+
+    try:
+        allowed = await rate_limiter.allow(key, *limit)
+    except Exception as e:
+        # Fail open, a limiter outage must not take the chat down with it.
+        logger.error(f"Error checking rate limit: {e}")
+        return True
+    RATE_LIMIT.labels(action, 'allowed' if allowed else 'dropped').inc()
+    return allowed
+
+
+async def check_rate_limit(channel_id, user):
+    return await take_token(f'{channel_id}:{user.id}', get_rate_limit(channel_id, user), 'message')
+
+
+async def check_subscribe_rate_limit(user):
+    """
+    One token per subscribe or unsubscribe frame of ``user``, whatever its
+    number of channels, shared by all of the user's sockets so reconnecting
+    doesn't refill it. Counted under the ``'subscribe'`` action.
+    """
+    return await take_token(f'subscribe:{user.id}', get_subscribe_rate_limit(user), 'subscribe')
+
+
+def get_rate_limiter():
+    backend = import_string(settings.CHAT_RATE_LIMIT_BACKEND)
+    return backend(**settings.CHAT_RATE_LIMIT_OPTIONS)
+
+
+rate_limiter = get_rate_limiter()
@@ -0,0 +1,66 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.history import invalidate_recent_history
+from chat.models import ArchivedMessage, Channel, Message
+from chat.unread import forget_messages
+
+
+def retention_cutoffs(channel_ids=None, now=None):
+    """Yields ``(channel_id, cutoff)`` for every channel with a retention policy."""
+    now = now or timezone.now()
+    channels = Channel.objects.all()
+    if channel_ids:
+        channels = channels.filter(pk__in=channel_ids)
+    if not settings.CHAT_RETENTION_DAYS:
+        channels = channels.filter(retention_days__isnull=False)
+
+    for channel_id, retention_days in channels.filter(
+        Q(retention_days__isnull=True) | Q(retention_days__gt=0)
+    ).values_list('id', 'retention_days').iterator():
+        days = retention_days if retention_days is not None else settings.CHAT_RETENTION_DAYS
+        yield channel_id, now - timedelta(days=days)
+
+
+def archive_channel(channel_id, cutoff, batch_size=None, pause=0):
+    """
+    Moves messages of ``channel_id`` created before ``cutoff`` to
+    ``ArchivedMessage``, oldest first.
+
+    Every batch is copied and deleted in its own transaction, so the message
+    table is never locked for long and an interrupted run loses nothing.
+    Returns the number of messages archived.
+    """
+    batch_size = batch_size or settings.CHAT_ARCHIVE_BATCH_SIZE
+    expired = Message.objects.filter(channel_id=channel_id, created_at__lt=cutoff).order_by('created_at', 'id')
+
+    archived = 0
+    while True:
+        with transaction.atomic():
+            batch = list(expired.select_for_update()[:batch_size])
+            if not batch:
+                break
+            ArchivedMessage.objects.bulk_create([
+                ArchivedMessage(
+                    id=message.id, channel_id=message.channel_id, sender_id=message.sender_id,
+                    content=message.content, created_at=message.created_at,
+                )
+                for message in batch
+            ], ignore_conflicts=True)
+            message_ids = [message.id for message in batch]
+            Message.objects.filter(id__in=message_ids).delete()
+            forget_messages(channel_id, message_ids)
+        archived += len(batch)
+        if len(batch) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    if archived:
+        invalidate_recent_history(channel_id)
+    return archived
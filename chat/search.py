@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.functions import Cast
+
+from chat.models import Message
+
+
+def search_vector():
+    """The expression of ``message_content_search_idx``, filters must match it exactly to use the index."""
+    from django.contrib.postgres.search import SearchVector
+    return SearchVector('content', config=settings.CHAT_SEARCH_CONFIG)
+
+
+def search_messages(user, text, channel_id=None):
+    """
+    Messages matching ``text`` in the channels ``user`` is a member of,
+    annotated with a float ``rank``.
+
+    On Postgres this is a websearch query against the GIN expression index,
+    ranked with ``ts_rank``. Other databases (SQLite in tests) fall back to
+    a case-insensitive match of every word with a constant rank, so results
+    come newest first.
+    """
+    queryset = Message.objects.filter(channel__in=user.channels.values('id')).select_related('sender')
+    if channel_id is not None:
+        queryset = queryset.filter(channel_id=channel_id)
+
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+
+        query = SearchQuery(text, config=settings.CHAT_SEARCH_CONFIG, search_type='websearch')
+        vector = search_vector()
+        # ts_rank is a real, cast so cursors round-trip exactly through a Python float
+        return queryset.annotate(search=vector).filter(search=query).annotate(
+            rank=Cast(SearchRank(vector, query), FloatField())
+        )
+
+    words = Q()
+    for word in text.split():
+        words &= Q(content__icontains=word)
+    return queryset.filter(words).annotate(rank=Value(0.0, output_field=FloatField()))
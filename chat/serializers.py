@@ -1,7 +1,10 @@
 from django.contrib.auth.password_validation import validate_password
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 
-from chat.models import Channel, Message, User
+from chat.models import ArchivedMessage, Channel, Message, User
+from chat.tokens import ChatRefreshToken
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -23,6 +26,14 @@ class RegisterSerializer(serializers.ModelSerializer):
         return user
 
 
+class ChatTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = ChatRefreshToken
+
+
+class ChatTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = ChatRefreshToken
+
+
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
 
@@ -42,13 +53,70 @@ class UserSerializer(serializers.ModelSerializer):
 class ChannelSerializer(serializers.ModelSerializer):
     class Meta:
         model = Channel
-        fields = ['id', 'name', 'owner', 'members', 'black_list']
+        fields = ['id', 'name', 'owner', 'members', 'black_list', 'retention_days']
         read_only_fields = ['members', 'owner']
 
 
+class BulkMembershipSerializer(serializers.Serializer):
+    user_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=1000)
+
+
+class ChannelListSerializer(serializers.ModelSerializer):
+    member_count = serializers.IntegerField(read_only=True)
+    is_member = serializers.BooleanField(read_only=True)
+    last_read_id = serializers.IntegerField(read_only=True)
+    unread = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Channel
+        fields = ['id', 'name', 'owner', 'member_count', 'is_member', 'last_read_id', 'unread']
+
+
+class MarkReadSerializer(serializers.Serializer):
+    message_id = serializers.IntegerField(min_value=1)
+
+
+class MemberSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'is_moderator']
+
+
 class MessageSerializer(serializers.ModelSerializer):
     sender = serializers.ReadOnlyField(source='sender.username')
+    sender_id = serializers.ReadOnlyField()
 
     class Meta:
         model = Message
-        fields = ['id', 'channel', 'sender', 'content', 'created_at']
\ No newline at end of file
+        fields = ['id', 'channel', 'sender', 'sender_id', 'content', 'created_at']
+
+
+class ArchivedMessageSerializer(MessageSerializer):
+    class Meta(MessageSerializer.Meta):
+        model = ArchivedMessage
+
+
+class MessageSearchSerializer(MessageSerializer):
+    rank = serializers.FloatField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['rank']
+
+def format_datetime(value):
+    """Same ISO 8601 output as DRF's ``DateTimeField``."""
+    value = timezone.localtime(value).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def message_payload(message, sender_username):
+    """Plain-dict equivalent of ``MessageSerializer`` for the WebSocket hot path."""
+    return {
+        'id': message.id,
+        'channel': message.channel_id,
+        'sender': sender_username,
+        'sender_id': message.sender_id,
+        'content': message.content,
+        'created_at': format_datetime(message.created_at),
+    }
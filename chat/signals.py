@@ -1,25 +1,52 @@
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.db.models.signals import m2m_changed
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 
-from chat.models import Channel
+from chat.cache import broadcast_membership_invalidation, invalidate_membership
+from chat.history import invalidate_recent_history
+from chat.membership import kick_users
+from chat.metrics import DB_CONNECTIONS_OPENED
+from chat.middleware import revoke_user
+from chat.models import Channel, User
 
 
 @receiver(m2m_changed, sender=Channel.members.through)
-def user_removal_from_members(sender, instance, action, pk_set, **kwargs):
+def user_removal_from_members(sender, instance, action, reverse, pk_set, **kwargs):
     if action == "pre_remove":
-        user_ids = pk_set
-        channel_id = instance.id
-
-        channel_layer = get_channel_layer()
-        group_name = f'chat_{channel_id}'
-
-        for user_id in user_ids:
-            async_to_sync(channel_layer.group_send)(
-                group_name,
-                {
-                    'type': 'force_disconnect',
-                    'user_id': user_id,
-                }
-            )
\ No newline at end of file
+        if reverse:
+            # instance is a User leaving the channels in pk_set
+            kick_users(pk_set, [instance.id])
+        else:
+            kick_users([instance.id], pk_set)
+
+
+@receiver(m2m_changed, sender=Channel.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == "pre_clear":
+        # instance is a User whose memberships are about to be dropped
+        channel_ids = list(instance.channels.values_list('id', flat=True))
+        broadcast_membership_invalidation(channel_ids, [instance.id])
+    elif reverse and action in ("post_add", "post_remove"):
+        broadcast_membership_invalidation(pk_set, [instance.id])
+    elif not reverse and action in ("post_add", "post_remove", "post_clear"):
+        broadcast_membership_invalidation([instance.id], pk_set)
+
+
+@receiver(post_delete, sender=Channel)
+def channel_deleted(sender, instance, **kwargs):
+    invalidate_membership(channel_id=instance.id)
+    invalidate_recent_history(instance.id)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    # Claims embedded in already issued tokens may be stale now, in this process
+    # and in those with sockets in the user's channels.
+    if not created:
+        revoke_user(instance.id)
+        broadcast_membership_invalidation(instance.channels.values_list('id', flat=True), [instance.id], revoke=True)
+
+
+@receiver(connection_created)
+def database_connection_created(sender, connection, **kwargs):
+    DB_CONNECTIONS_OPENED.labels(connection.alias).inc()
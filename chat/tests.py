@@ -1,9 +1,58 @@
+import asyncio
+import gzip
+import json
+import os
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from prometheus_client import REGISTRY, CollectorRegistry, Histogram
 from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase, APIClient
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from chat.buffer import write_buffer
+from chat.cache import membership_cache, membership_invalidation_event
+from chat.consumers import ChatConsumer, MultiplexChatConsumer, history_tasks
+from chat.db import database_sync_to_async, get_executor
+from chat.dispatch import EventDispatcher
+from chat.encoding import dumps, pack, unpack
+from chat.history import LocalHistory, RedisHistory, history_invalidation_event, recent_history
+from chat.layers import HashRing, ShardedRedisChannelLayer, ShardedRedisPubSubChannelLayer, shard_name
+from chat.metrics import set_enabled, timed
+from chat.middleware import JWTAuthMiddleware, get_user, revoked_users, token_cache
+from chat.models import ArchivedMessage, ReadState, User, Channel, Message
+from chat.pagination import encode_cursor
+from chat.presence import LocalPresence, RedisPresence, presence, presence_notifier
+from chat.ratelimit import LocalRateLimiter, RedisRateLimiter, get_rate_limit, rate_limiter
+from chat.serializers import MessageSerializer, message_payload
+from chat.tokens import ChatRefreshToken
+from chat.unread import MessageCounter, message_counter
+from chat_api.routing import websocket_urlpatterns
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
-from chat.models import User, Channel
+
+def sample(name, labels=None):
+    """Current value of a sample in the default prometheus_client registry."""
+    return REGISTRY.get_sample_value(name, labels) or 0
 
 
 class ChannelAPITestCase(APITestCase):
@@ -52,9 +101,49 @@ class ChannelAPITestCase(APITestCase):
 
         response = self.client.get(reverse('channel-list'))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
-        self.assertEqual(response.data[0]['name'], 'Test Channel')
-        self.assertEqual(response.data[1]['name'], 'Test Channel 2')
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(response.data['results'][0]['name'], 'Test Channel')
+        self.assertEqual(response.data['results'][1]['name'], 'Test Channel 2')
+
+    def test_list_channels_counts_and_pagination(self):
+        users = [User.objects.create_user(username=f'member{i}', password='testpass1234') for i in range(3)]
+        for i in range(5):
+            channel = Channel.objects.create(name=f'Channel {i}', owner=self.second_user)
+            channel.members.add(*users[:i % 4])
+            if i % 2:
+                channel.members.add(self.user)
+
+        # user lookup, one annotated page
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('channel-list'), {'limit': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('members', response.data['results'][0])
+        self.assertEqual(
+            [(c['member_count'], c['is_member']) for c in response.data['results']],
+            [(0, False), (2, True), (2, False)],
+        )
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(
+            [(c['name'], c['member_count'], c['is_member']) for c in response.data['results']],
+            [('Channel 3', 4, True), ('Channel 4', 0, False)],
+        )
+        self.assertIsNone(response.data['next'])
+
+    def test_list_channel_members(self):
+        channel = Channel.objects.create(name='Test Channel', owner=self.second_user)
+        users = [User.objects.create_user(username=f'member{i}', password='testpass1234') for i in range(3)]
+        channel.members.add(*users)
+
+        url = reverse('channel-members', kwargs={'pk': channel.pk})
+        response = self.client.get(url, {'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['username'] for m in response.data['results']], ['member0', 'member1'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([m['username'] for m in response.data['results']], ['member2'])
+
+        response = self.client.get(reverse('channel-members', kwargs={'pk': 0}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_retrieve_channel(self):
         channel = Channel.objects.create(name='Test Channel', owner=self.user)
@@ -119,6 +208,63 @@ class ChannelAPITestCase(APITestCase):
         self.assertEqual(channel.members.count(), 1)
         self.assertEqual(channel.members.first(), self.second_user)
 
+    def test_join_leave_query_count(self):
+        channel = Channel.objects.create(name='Test Channel', owner=self.second_user)
+        join_url = reverse('channel-join', kwargs={'pk': channel.pk})
+        leave_url = reverse('channel-leave', kwargs={'pk': channel.pk})
+
+        # user lookup, membership/ban EXISTS, insert, newest message for the read state
+        with self.assertNumQueries(4):
+            response = self.client.put(join_url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(2):
+            response = self.client.put(join_url, format='json')
+        self.assertEqual(response.data, {'status': 'already joined'})
+
+        # user lookup, delete
+        with self.assertNumQueries(2):
+            response = self.client.put(leave_url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(channel.members.filter(pk=self.user.pk).exists())
+
+        response = self.client.put(leave_url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.put(reverse('channel-leave', kwargs={'pk': 0}), format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_join_and_leave(self):
+        channel = Channel.objects.create(name='Test Channel', owner=self.user)
+        channel.members.add(self.user)
+        users = [User.objects.create_user(username=f'bulk{i}', password='testpass1234') for i in range(4)]
+        users[1].is_blocked = True
+        users[1].save()
+        channel.black_list.add(users[2])
+        channel.members.add(users[3])
+
+        join_url = reverse('channel-bulk-join', kwargs={'pk': channel.pk})
+        user_ids = [user.pk for user in users] + [0]
+        with self.assertNumQueries(5):
+            response = self.client.post(join_url, {'user_ids': user_ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'added': [users[0].pk]})
+        self.assertEqual(set(channel.members.all()), {self.user, users[0], users[3]})
+
+        leave_url = reverse('channel-bulk-leave', kwargs={'pk': channel.pk})
+        response = self.client.post(leave_url, {'user_ids': user_ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(response.data['removed']), [users[0].pk, users[3].pk])
+        self.assertEqual(list(channel.members.all()), [self.user])
+
+        response = self.client.post(leave_url, {'user_ids': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Only the owner or a moderator can manage members in bulk
+        channel = Channel.objects.create(name='Test Channel 2', owner=self.second_user)
+        url = reverse('channel-bulk-join', kwargs={'pk': channel.pk})
+        response = self.client.post(url, {'user_ids': [self.user.pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_permission_required(self):
         self.client.credentials(HTTP_AUTHORIZATION='')
         url = reverse('channel-list')
@@ -141,4 +287,1455 @@ class ModeratorAPITestCase(APITestCase):
         url = reverse('block-user', kwargs={'user_id': self.second_user.pk})
         response = self.client.post(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['is_blocked'], True)
\ No newline at end of file
+        self.assertEqual(response.data['is_blocked'], True)
+
+class MessageAPITestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass1234')
+        self.channel = Channel.objects.create(name='Test Channel', owner=self.user)
+        self.channel.members.add(self.user)
+        self.messages = Message.objects.bulk_create(
+            Message(channel=self.channel, sender=self.user, content=f'message {i}') for i in range(5)
+        )
+
+        refresh = RefreshToken.for_user(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(refresh.access_token))
+
+    def test_cursor_pagination(self):
+        url = reverse('messages-list')
+        response = self.client.get(url, {'channel': self.channel.pk, 'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['content'] for m in response.data['results']], ['message 4', 'message 3'])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([m['content'] for m in response.data['results']], ['message 2', 'message 1'])
+
+        newer = self.client.get(response.data['previous'])
+        self.assertEqual([m['content'] for m in newer.data['results']], ['message 4', 'message 3'])
+        self.assertIsNone(newer.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([m['content'] for m in response.data['results']], ['message 0'])
+        self.assertIsNone(response.data['next'])
+
+    def test_export(self):
+        url = reverse('channel-export', kwargs={'pk': self.channel.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['content'] for line in lines], [f'message {i}' for i in range(5)])
+
+        response = self.client.get(url, {'compress': 'gzip'})
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+
+        future = (timezone.now() + timedelta(days=1)).isoformat()
+        response = self.client.get(url, {'since': future})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+        response = self.client.get(url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_streams_under_asgi(self):
+        url = reverse('channel-export', kwargs={'pk': self.channel.pk})
+        token = str(RefreshToken.for_user(self.user).access_token)
+
+        async def scenario():
+            response = await AsyncClient().get(url, {'compress': 'gzip'}, headers={'Authorization': 'Bearer ' + token})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.is_async)
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        lines = gzip.decompress(async_to_sync(scenario)()).decode().splitlines()
+        self.assertEqual([json.loads(line)['content'] for line in lines], [f'message {i}' for i in range(5)])
+
+    def test_export_requires_owner_or_moderator(self):
+        other = User.objects.create_user(username='testuser2', password='testpass1234')
+        self.channel.members.add(other)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(other).access_token))
+        response = self.client.get(reverse('channel-export', kwargs={'pk': self.channel.pk}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('messages-list'), {'channel': self.channel.pk, 'before': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_archive_messages(self):
+        old = timezone.now() - timedelta(days=10)
+        Message.objects.filter(id__in=[m.id for m in self.messages[:3]]).update(created_at=old)
+        kept = Channel.objects.create(name='Kept Channel', owner=self.user, retention_days=0)
+        Message.objects.create(channel=kept, sender=self.user, content='kept')
+        Message.objects.filter(channel=kept).update(created_at=old)
+
+        # No retention configured anywhere
+        call_command('archive_messages', stdout=StringIO())
+        self.assertEqual(ArchivedMessage.objects.count(), 0)
+
+        self.channel.retention_days = 7
+        self.channel.save()
+        output = StringIO()
+        call_command('archive_messages', '--dry-run', stdout=output)
+        self.assertIn('3 messages to archive', output.getvalue())
+        self.assertEqual(ArchivedMessage.objects.count(), 0)
+
+        with override_settings(CHAT_RETENTION_DAYS=1):
+            call_command('archive_messages', '--batch-size', '2', stdout=StringIO())
+        self.assertEqual(sorted(ArchivedMessage.objects.values_list('id', flat=True)), [m.id for m in self.messages[:3]])
+        self.assertEqual(Message.objects.filter(channel=self.channel).count(), 2)
+        self.assertTrue(Message.objects.filter(channel=kept).exists())
+
+        # Archived history continues from the last live page with the same cursor
+        url = reverse('messages-list')
+        response = self.client.get(url, {'channel': self.channel.pk})
+        self.assertEqual([m['content'] for m in response.data['results']], ['message 4', 'message 3'])
+        last = response.data['results'][-1]
+        cursor = encode_cursor(parse_datetime(last['created_at']), last['id'])
+        response = self.client.get(url, {'channel': self.channel.pk, 'archive': 1, 'before': cursor})
+        self.assertEqual([m['content'] for m in response.data['results']], ['message 2', 'message 1', 'message 0'])
+
+
+    def test_unread_counts(self):
+        other = User.objects.create_user(username='testuser2', password='testpass1234')
+        other_channel = Channel.objects.create(name='Other Channel', owner=other)
+        Channel.objects.create(name='Not Joined', owner=other)
+        list_url = reverse('channel-list')
+        read_url = reverse('channel-read', kwargs={'pk': self.channel.pk})
+
+        # Messages were bulk inserted behind the counter's back
+        output = StringIO()
+        call_command('reconcile_unread', stdout=output)
+        self.assertIn('1 channels reconciled', output.getvalue())
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.message_count, 5)
+
+        def unread():
+            # user lookup, one annotated page
+            with self.assertNumQueries(2):
+                response = self.client.get(list_url)
+            return [(c['last_read_id'], c['unread']) for c in response.data['results']]
+
+        self.assertEqual(unread(), [(None, 5), (None, None), (None, None)])
+
+        response = self.client.put(read_url, {'message_id': self.messages[2].id}, format='json')
+        self.assertEqual(response.data, {'channel': self.channel.pk, 'last_read_id': self.messages[2].id, 'unread': 2})
+        # The pointer never moves back
+        response = self.client.put(read_url, {'message_id': self.messages[1].id}, format='json')
+        self.assertEqual(response.data['last_read_id'], self.messages[2].id)
+        self.assertEqual(response.data['unread'], 2)
+
+        self.client.post(reverse('messages-list'), {'channel': self.channel.pk, 'content': 'new'}, format='json')
+        self.assertEqual(unread(), [(self.messages[2].id, 3), (None, None), (None, None)])
+        response = self.client.delete(
+            reverse('messages-detail', kwargs={'pk': self.messages[0].id}) + f'?channel={self.channel.pk}'
+        )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(unread()[0], (self.messages[2].id, 3))
+        response = self.client.delete(
+            reverse('messages-detail', kwargs={'pk': self.messages[4].id}) + f'?channel={self.channel.pk}'
+        )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(unread()[0], (self.messages[2].id, 2))
+
+        # Archiving takes messages out of the counters too
+        Message.objects.filter(id__in=[m.id for m in self.messages[1:3]]).update(created_at=timezone.now() - timedelta(days=10))
+        with override_settings(CHAT_RETENTION_DAYS=7):
+            call_command('archive_messages', stdout=StringIO())
+        self.assertEqual(unread()[0], (self.messages[2].id, 2))
+
+        # Counters in sync, drift repaired
+        output = StringIO()
+        call_command('reconcile_unread', stdout=output)
+        self.assertIn('0 channels reconciled', output.getvalue())
+        Channel.objects.filter(pk=self.channel.pk).update(message_count=100)
+        ReadState.objects.update(read_count=50)
+        call_command('reconcile_unread', '--channel', str(self.channel.pk), stdout=StringIO())
+        self.assertEqual(unread()[0], (self.messages[2].id, 2))
+
+        response = self.client.put(read_url, {'message_id': self.messages[3].id}, format='json')
+        self.assertEqual(response.data['unread'], 1)
+        response = self.client.put(read_url, {'message_id': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        foreign = Message.objects.create(channel=other_channel, sender=other, content='elsewhere')
+        response = self.client.put(read_url, {'message_id': foreign.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.put(reverse('channel-read', kwargs={'pk': other_channel.pk}), {'message_id': foreign.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # New members start with nothing unread
+        self.client.put(reverse('channel-join', kwargs={'pk': other_channel.pk}), format='json')
+        self.assertEqual(unread()[1], (foreign.id, 0))
+
+    def test_search(self):
+        other_channel = Channel.objects.create(name='Other Channel', owner=self.user)
+        Message.objects.create(channel=other_channel, sender=self.user, content='message elsewhere')
+        Message.objects.create(channel=self.channel, sender=self.user, content='unrelated')
+
+        url = reverse('message-search')
+        response = self.client.get(url, {'q': 'Message', 'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['content'] for m in response.data['results']], ['message 4', 'message 3'])
+        self.assertIn('rank', response.data['results'][0])
+
+        contents = [m['content'] for m in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            contents += [m['content'] for m in response.data['results']]
+        # Only channels the caller is a member of
+        self.assertEqual(contents, [f'message {i}' for i in range(4, -1, -1)])
+
+        other_channel.members.add(self.user)
+        response = self.client.get(url, {'q': 'message elsewhere', 'channel': other_channel.pk})
+        self.assertEqual([m['content'] for m in response.data['results']], ['message elsewhere'])
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'q': 'message', 'cursor': 'garbage'}).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+
+class JWTAuthMiddlewareTestCase(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        revoked_users.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass1234')
+
+    def handshakes(self, outcome):
+        return sample('chat_ws_handshake_seconds_count', {'outcome': outcome})
+
+    def test_claims_token_needs_no_lookup(self):
+        token = str(ChatRefreshToken.for_user(self.user).access_token)
+        claims = self.handshakes('claims')
+        with self.assertNumQueries(0):
+            user = async_to_sync(get_user)(token)
+        self.assertEqual(user, self.user)
+        self.assertEqual(user.username, 'testuser')
+        self.assertEqual(self.handshakes('claims') - claims, 1)
+
+    def test_token_without_claims_is_cached(self):
+        token = str(RefreshToken.for_user(self.user).access_token)
+        db_lookups, cache_hits = self.handshakes('db_lookups'), self.handshakes('cache_hits')
+        with self.assertNumQueries(1):
+            async_to_sync(get_user)(token)
+        with self.assertNumQueries(0):
+            user = async_to_sync(get_user)(token)
+        self.assertEqual(user.id, self.user.id)
+        self.assertEqual(
+            (self.handshakes('db_lookups') - db_lookups, self.handshakes('cache_hits') - cache_hits), (1, 1)
+        )
+
+    def test_revoked_user_is_reloaded(self):
+        token = str(ChatRefreshToken.for_user(self.user).access_token)
+        async_to_sync(get_user)(token)
+
+        self.user.is_blocked = True
+        self.user.save()
+        with self.assertNumQueries(1):
+            user = async_to_sync(get_user)(token)
+        self.assertTrue(user.is_blocked)
+
+    def test_issued_tokens_carry_claims(self):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'testuser', 'password': 'testpass1234'})
+        payload = AccessToken(response.data['access']).payload
+        self.assertEqual(payload['username'], 'testuser')
+        self.assertFalse(payload['is_moderator'])
+        self.assertFalse(payload['is_blocked'])
+
+    def test_refresh_reads_current_claims(self):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'testuser', 'password': 'testpass1234'})
+        self.assertNotIn('is_moderator', RefreshToken(response.data['refresh']).payload)
+
+        User.objects.filter(pk=self.user.pk).update(is_moderator=True)
+        refreshed = self.client.post(reverse('token_refresh'), {'refresh': response.data['refresh']})
+        self.assertTrue(AccessToken(refreshed.data['access']).payload['is_moderator'])
+
+    def test_invalid_token(self):
+        failures = self.handshakes('failures')
+        self.assertFalse(async_to_sync(get_user)('not-a-token').is_authenticated)
+        self.assertEqual(self.handshakes('failures') - failures, 1)
+
+    def test_query_string_parsing(self):
+        channel = Channel.objects.create(name='Test Channel', owner=self.user)
+        channel.members.add(self.user)
+        token = str(ChatRefreshToken.for_user(self.user).access_token)
+
+        async def scenario():
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{channel.pk}?v=2&token={token}&x=1')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+
+application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+
+class ChatConsumerTestCase(APITestCase):
+    def setUp(self):
+        membership_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass1234')
+        self.second_user = User.objects.create_user(username='testuser2', password='testpass1234')
+        self.channel = Channel.objects.create(name='Test Channel', owner=self.user)
+        self.channel.members.add(self.user, self.second_user)
+        recent_history.invalidate(self.channel.pk)
+        rate_limiter.clear()
+        presence.clear()
+        presence_notifier.clear()
+        self.access_token = str(RefreshToken.for_user(self.user).access_token)
+
+    def tearDown(self):
+        # Counted before the test transaction rolls back, not on a later test's loop
+        message_counter.drain_sync()
+
+    def rate_limit_drops(self, action='message'):
+        return sample('chat_rate_limit_total', {'action': action, 'outcome': 'dropped'})
+
+    def communicator(self, user_token=None):
+        token = user_token or self.access_token
+        return WebsocketCommunicator(application, f'/ws/chat/{self.channel.pk}?token={token}')
+
+    def test_send_message(self):
+        async def scenario():
+            communicator = self.communicator()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            welcome = await communicator.receive_json_from()
+            self.assertEqual(welcome['type'], 'welcome')
+
+            await communicator.send_json_to({'message': 'hello'})
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['content'], 'hello')
+            self.assertEqual(response['sender'], self.user.username)
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(Message.objects.get().content, 'hello')
+
+    @override_settings(MESSAGE_WRITE_BEHIND=True, MESSAGE_WRITE_BEHIND_ACK='flush')
+    def test_write_behind_ack_after_flush(self):
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+            await communicator.send_json_to({'message': 'hello'})
+            response = await communicator.receive_json_from()
+            self.assertIsNotNone(response['id'])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(Message.objects.get().content, 'hello')
+
+    @override_settings(MESSAGE_WRITE_BEHIND=True, MESSAGE_WRITE_BEHIND_ACK='immediate', MESSAGE_FLUSH_INTERVAL_MS=10000)
+    def test_write_behind_ack_immediately(self):
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+            for content in ('first', 'second'):
+                await communicator.send_json_to({'message': content})
+                response = await communicator.receive_json_from()
+                self.assertIsNone(response['id'])
+                self.assertEqual(response['content'], content)
+
+            self.assertEqual(len(write_buffer), 2)
+            await write_buffer.drain()
+            # Appended to the recent history once written, with their ids
+            await asyncio.sleep(0)
+            await asyncio.gather(*history_tasks)
+            history = await recent_history.get(self.channel.pk)
+            self.assertEqual([m['content'] for m in history], ['second', 'first'])
+            self.assertTrue(all(m['id'] for m in history))
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(list(Message.objects.order_by('id').values_list('content', flat=True)), ['first', 'second'])
+
+    def test_write_behind_drain_sync(self):
+        async def scenario():
+            with override_settings(MESSAGE_FLUSH_INTERVAL_MS=10000):
+                write_buffer.add(Message(channel=self.channel, sender=self.user, content='pending'), wait=False)
+
+        async_to_sync(scenario)()
+        write_buffer.drain_sync()
+        self.assertEqual(len(write_buffer), 0)
+        self.assertEqual(Message.objects.get().content, 'pending')
+
+    @override_settings(CHAT_RESYNC_CHUNK_SIZE=4, CHAT_RESYNC_MAX_MESSAGES=10)
+    def test_resync_since(self):
+        messages = Message.objects.bulk_create(
+            Message(channel=self.channel, sender=self.user, content=f'message {i}') for i in range(30)
+        )
+
+        async def connect(since):
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/{self.channel.pk}?token={self.access_token}&since={since}'
+            )
+            await communicator.connect()
+            return communicator
+
+        async def scenario():
+            # Exactly the gap, oldest first, in chunks
+            communicator = await connect(messages[24].id)
+            welcome = await communicator.receive_json_from()
+            self.assertEqual((welcome['type'], welcome['history']), ('welcome', []))
+            first = await communicator.receive_json_from()
+            second = await communicator.receive_json_from()
+            self.assertEqual((first['type'], first['done'], second['done']), ('resync', False, True))
+            self.assertEqual([m['id'] for m in first['messages'] + second['messages']], [m.id for m in messages[25:]])
+            await communicator.disconnect()
+
+            communicator = await connect(messages[-1].id)
+            await communicator.receive_json_from()
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'resync', 'messages': [], 'done': True})
+            await communicator.disconnect()
+
+            communicator = await connect(messages[5].id)
+            welcome = await communicator.receive_json_from()
+            self.assertEqual(len(welcome['history']), 20)
+            self.assertEqual((await communicator.receive_json_from())['code'], 'too_far_behind')
+            await communicator.disconnect()
+
+            communicator = await connect('yesterday')
+            self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+            self.assertEqual((await communicator.receive_json_from())['type'], 'welcome')
+            await communicator.disconnect()
+
+            # Multiplexed, per channel
+            communicator = WebsocketCommunicator(application, f'/ws/chat/?token={self.access_token}')
+            await communicator.connect()
+            await communicator.send_json_to({
+                'action': 'subscribe', 'channels': [self.channel.pk], 'since': {str(self.channel.pk): messages[27].id}
+            })
+            self.assertEqual((await communicator.receive_json_from())['history'], [])
+            resync = await communicator.receive_json_from()
+            self.assertEqual((resync['channel'], resync['done']), (self.channel.pk, True))
+            self.assertEqual([m['id'] for m in resync['messages']], [m.id for m in messages[28:]])
+
+            # Live messages the resync already sent are skipped, newer ones come through
+            newer = await sync_to_async(Message.objects.create)(channel=self.channel, sender=self.user, content='newer')
+            for message in (messages[29], newer):
+                await get_channel_layer().group_send(f'chat_{self.channel.pk}', {
+                    'type': 'chat_message', 'text': dumps(message_payload(message, 'testuser')),
+                    'channel_id': self.channel.pk, 'id': message.id,
+                })
+            self.assertEqual((await communicator.receive_json_from())['id'], newer.id)
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+            # MessagePack maps may key since by int
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/?token={self.access_token}', subprotocols=['chat.msgpack']
+            )
+            await communicator.connect()
+            await communicator.send_to(bytes_data=pack({
+                'action': 'subscribe', 'channels': [self.channel.pk], 'since': {self.channel.pk: messages[27].id}
+            }))
+            self.assertEqual(unpack(await communicator.receive_from())['history'], [])
+            resync = unpack(await communicator.receive_from())
+            self.assertEqual([m['id'] for m in resync['messages']], [m.id for m in messages[28:]] + [newer.id])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_msgpack_mode(self):
+        message = Message.objects.create(channel=self.channel, sender=self.second_user, content='stored')
+
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/{self.channel.pk}?token={self.access_token}', subprotocols=['chat.msgpack']
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual((connected, subprotocol), (True, 'chat.msgpack'))
+            welcome = unpack(await communicator.receive_from())
+            self.assertEqual(welcome['history'], [{
+                'id': message.id, 'channel': self.channel.pk, 'sender': self.second_user.pk, 'content': 'stored',
+                'ts': int(message.created_at.timestamp() * 1000),
+            }])
+            self.assertEqual(welcome['senders'], {self.second_user.pk: 'testuser2'})
+
+            json_communicator = self.communicator()
+            await json_communicator.connect()
+            await json_communicator.receive_json_from()
+
+            await communicator.send_to(bytes_data=pack({'message': 'hello'}))
+            response = unpack(await communicator.receive_from())
+            self.assertEqual(
+                (response['sender'], response['name'], response['content']), (self.user.pk, 'testuser', 'hello')
+            )
+            self.assertIsInstance(response['ts'], int)
+            # Clients that did not negotiate keep getting JSON
+            self.assertEqual((await json_communicator.receive_json_from())['content'], 'hello')
+
+            await communicator.send_to(bytes_data=b'\xc1')
+            self.assertEqual(unpack(await communicator.receive_from())['message'], 'Invalid MessagePack format.')
+            # A map keyed by an array can't be a dict, the socket answers and stays open
+            await communicator.send_to(bytes_data=b'\x81\x91\x01\x01')
+            self.assertEqual(unpack(await communicator.receive_from())['message'], 'Invalid MessagePack format.')
+            await communicator.send_to(bytes_data=pack({'message': 'still here'}))
+            self.assertEqual(unpack(await communicator.receive_from())['content'], 'still here')
+            await json_communicator.receive_json_from()
+            await communicator.disconnect()
+            await json_communicator.disconnect()
+
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/{self.channel.pk}?token={self.access_token}&format=msgpack'
+            )
+            await communicator.connect()
+            self.assertEqual(unpack(await communicator.receive_from())['type'], 'welcome')
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_mark_read(self):
+        second_token = str(RefreshToken.for_user(self.second_user).access_token)
+
+        async def receive(communicator, frame_type):
+            while True:
+                frame = await communicator.receive_json_from()
+                # Chat messages are sent as bare payloads
+                if frame.get('type') == frame_type:
+                    return frame
+
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            await receive(communicator, 'welcome')
+            second_communicator = self.communicator(second_token)
+            await second_communicator.connect()
+            await receive(second_communicator, 'welcome')
+
+            ids = []
+            for content in ('one', 'two'):
+                await communicator.send_json_to({'message': content})
+                ids.append((await receive(communicator, None))['id'])
+                await receive(second_communicator, None)
+
+            await second_communicator.send_json_to({'action': 'mark_read', 'id': ids[0]})
+            self.assertEqual(await receive(second_communicator, 'read'), {'type': 'read', 'last_read_id': ids[0], 'unread': 1})
+            self.assertEqual(await receive(communicator, 'read_receipt'), {
+                'type': 'read_receipt', 'channel': self.channel.pk, 'read': {'testuser2': ids[0]},
+            })
+
+            await second_communicator.send_json_to({'action': 'mark_read', 'id': 'latest'})
+            self.assertEqual((await receive(second_communicator, 'error'))['message'], "Invalid id, expected a message id.")
+            await second_communicator.send_json_to({'action': 'mark_read', 'id': ids[1] + 100})
+            self.assertEqual((await receive(second_communicator, 'error'))['message'], "Message does not exist.")
+
+            # Counted after the inserts, once per channel
+            await message_counter.drain()
+
+            await communicator.disconnect()
+            await second_communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(Channel.objects.get(pk=self.channel.pk).message_count, 2)
+        read_state = ReadState.objects.get(user=self.second_user)
+        self.assertEqual(read_state.last_read_id, Message.objects.order_by('id').first().id)
+        # Marked before the messages were counted, still exactly one unread
+        self.assertEqual(read_state.read_count, 1)
+
+    def test_history_scroll_back(self):
+        Message.objects.bulk_create(
+            Message(channel=self.channel, sender=self.user, content=f'message {i}') for i in range(25)
+        )
+
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            welcome = await communicator.receive_json_from()
+            self.assertEqual(len(welcome['history']), 20)
+            self.assertEqual(welcome['history'][0]['content'], 'message 24')
+
+            await communicator.send_json_to({'action': 'history', 'before': welcome['next']})
+            history = await communicator.receive_json_from()
+            self.assertEqual(history['type'], 'history')
+            self.assertEqual([m['content'] for m in history['history']], [f'message {i}' for i in range(4, -1, -1)])
+            self.assertIsNone(history['next'])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_welcome_served_from_recent_history(self):
+        Message.objects.create(channel=self.channel, sender=self.user, content='stored')
+
+        async def scenario():
+            first = self.communicator()
+            await first.connect()
+            welcome = await first.receive_json_from()
+            self.assertEqual([m['content'] for m in welcome['history']], ['stored'])
+
+            await first.send_json_to({'message': 'live'})
+            await first.receive_json_from()
+
+            with patch.object(ChatConsumer, 'get_recent_messages') as get_recent_messages:
+                second = self.communicator()
+                await second.connect()
+                welcome = await second.receive_json_from()
+                get_recent_messages.assert_not_called()
+            self.assertEqual([m['content'] for m in welcome['history']], ['live', 'stored'])
+            self.assertIsNone(welcome['next'])
+
+            # Edits and deletes in another process reach this one through the channel layer
+            await get_channel_layer().group_send(f'chat_{self.channel.pk}', history_invalidation_event(self.channel.pk))
+            self.assertTrue(await first.receive_nothing())
+            self.assertIsNone(await recent_history.get(self.channel.pk))
+
+            await first.disconnect()
+            await second.receive_json_from()
+            await second.send_json_to({'message': 'refill'})
+            await second.receive_json_from()
+            await second.disconnect()
+            # No local socket left to receive invalidations, so nothing is kept
+            self.assertIsNone(await recent_history.get(self.channel.pk))
+
+        async_to_sync(scenario)()
+
+    def test_recent_history_gets_other_processes_messages(self):
+        Message.objects.create(channel=self.channel, sender=self.user, content='stored')
+
+        async def scenario():
+            first, second = self.communicator(), self.communicator()
+            for communicator in (first, second):
+                await communicator.connect()
+                await communicator.receive_json_from()
+
+            # Sent through another ASGI process, two sockets here get it but it's appended once
+            remote = await sync_to_async(Message.objects.create)(channel=self.channel, sender=self.user, content='remote')
+            await get_channel_layer().group_send(f'chat_{self.channel.pk}', {
+                'type': 'chat_message', 'text': dumps(message_payload(remote, 'testuser')), 'compact': True,
+                'channel_id': self.channel.pk, 'id': remote.id, 'event_id': 'remote',
+            })
+            for communicator in (first, second):
+                self.assertEqual((await communicator.receive_json_from())['content'], 'remote')
+            self.assertEqual([m['content'] for m in await recent_history.get(self.channel.pk)], ['remote', 'stored'])
+
+            # Written behind over there, not in the database yet
+            await get_channel_layer().group_send(f'chat_{self.channel.pk}', {
+                'type': 'chat_message', 'text': dumps({'id': None, 'content': 'pending'}), 'compact': True,
+                'channel_id': self.channel.pk, 'id': None, 'event_id': 'pending',
+            })
+            await first.receive_json_from()
+            await second.receive_json_from()
+            self.assertIsNone(await recent_history.get(self.channel.pk))
+
+            await first.disconnect()
+            await second.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_HISTORY_LENGTH=2)
+    def test_recent_history_length(self):
+        Message.objects.bulk_create(
+            Message(channel=self.channel, sender=self.user, content=f'message {i}') for i in range(3)
+        )
+
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            welcome = await communicator.receive_json_from()
+            self.assertEqual([m['content'] for m in welcome['history']], ['message 2', 'message 1'])
+            self.assertIsNotNone(welcome['next'])
+            await communicator.disconnect()
+
+            communicator = self.communicator()
+            await communicator.connect()
+            cached_welcome = await communicator.receive_json_from()
+            self.assertEqual(cached_welcome['history'], welcome['history'])
+            self.assertEqual(cached_welcome['next'], welcome['next'])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_chat_message_events(self):
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.receive_json_from()
+            channel_layer = get_channel_layer()
+            group = f'chat_{self.channel.pk}'
+
+            await channel_layer.group_send(group, {'type': 'chat_message', 'text': '{"content": "pre-encoded"}'})
+            self.assertEqual(await communicator.receive_from(), '{"content": "pre-encoded"}')
+
+            await channel_layer.group_send(group, {'type': 'chat_message', 'message': {'content': 'dict'}})
+            self.assertEqual(await communicator.receive_json_from(), {'content': 'dict'})
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_message_payload_matches_serializer(self):
+        message = Message.objects.create(channel=self.channel, sender=self.user, content='hello')
+        self.assertEqual(message_payload(message, self.user.username), MessageSerializer(message).data)
+
+    def test_membership_cache(self):
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.receive_json_from()
+            self.assertTrue(membership_cache.get((self.channel.pk, self.user.pk)))
+
+            with patch.object(ChatConsumer, 'check_permission_to_channel') as check:
+                for i in range(3):
+                    await communicator.send_json_to({'message': f'hello {i}'})
+                    await communicator.receive_json_from()
+                check.assert_not_called()
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+        membership_cache.set((self.channel.pk, self.second_user.pk), True)
+        self.channel.members.remove(self.second_user)
+        self.assertIsNone(membership_cache.get((self.channel.pk, self.second_user.pk)))
+        self.assertTrue(membership_cache.get((self.channel.pk, self.user.pk)))
+
+        moderator = User.objects.create_user(username='moderator', password='testpass1234', is_moderator=True)
+        self.client.force_authenticate(moderator)
+        self.client.post(reverse('block-user', kwargs={'user_id': self.user.pk}))
+        self.assertIsNone(membership_cache.get((self.channel.pk, self.user.pk)))
+
+    def test_invalidation_event(self):
+        membership_cache.set((self.channel.pk, self.user.pk), True)
+        membership_cache.set((self.channel.pk, self.second_user.pk), True)
+        second_token = str(RefreshToken.for_user(self.second_user).access_token)
+        event = membership_invalidation_event(self.channel.pk, [self.second_user.pk, 0])
+
+        async def scenario():
+            communicators = [self.communicator(), self.communicator(second_token)]
+            for communicator in communicators:
+                await communicator.connect()
+                await communicator.receive_json_from()
+            membership_cache.set((self.channel.pk, self.second_user.pk), True)
+            channel_layer = get_channel_layer()
+            await channel_layer.group_send(f'chat_{self.channel.pk}', event)
+            for communicator in communicators:
+                self.assertTrue(await communicator.receive_nothing())
+            for communicator in communicators:
+                await communicator.disconnect()
+
+        # Exact keys, no cache scan, and applied once per process for both sockets
+        with patch.object(membership_cache, 'delete_matching') as delete_matching, \
+                patch.object(membership_cache, 'delete_many', wraps=membership_cache.delete_many) as delete_many:
+            async_to_sync(scenario)()
+        delete_matching.assert_not_called()
+        self.assertEqual(delete_many.call_count, 1)
+        self.assertIsNone(membership_cache.get((self.channel.pk, self.second_user.pk)))
+        self.assertTrue(membership_cache.get((self.channel.pk, self.user.pk)))
+
+
+    @override_settings(CHAT_RATE_LIMIT={'rate': 0.001, 'burst': 1}, CHAT_RATE_LIMIT_CHANNELS={})
+    def test_revoke_event_reloads_socket_user(self):
+        dropped = self.rate_limit_drops()
+
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+            # Promoted through another process, only the channel layer event reaches this one
+            await sync_to_async(User.objects.filter(pk=self.user.pk).update)(is_moderator=True)
+            await get_channel_layer().group_send(
+                f'chat_{self.channel.pk}', membership_invalidation_event(self.channel.pk, [self.user.pk], revoke=True)
+            )
+            for i in range(3):
+                await communicator.send_json_to({'message': f'hello {i}'})
+                self.assertEqual((await communicator.receive_json_from())['content'], f'hello {i}')
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(self.rate_limit_drops() - dropped, 0)
+
+    def test_bulk_leave_and_global_block_disconnect(self):
+        third_user = User.objects.create_user(username='testuser3', password='testpass1234')
+        self.channel.members.add(third_user)
+        moderator = User.objects.create_user(username='moderator', password='testpass1234', is_moderator=True)
+        self.client.force_authenticate(self.user)
+
+        async def connect(user):
+            communicator = self.communicator(str(RefreshToken.for_user(user).access_token))
+            await communicator.connect()
+            await communicator.receive_json_from()
+            return communicator
+
+        async def scenario():
+            owner, second, third = [await connect(user) for user in (self.user, self.second_user, third_user)]
+
+            url = reverse('channel-bulk-leave', kwargs={'pk': self.channel.pk})
+            await sync_to_async(self.client.post)(url, {'user_ids': [self.second_user.pk, third_user.pk]}, format='json')
+            for communicator in (second, third):
+                self.assertEqual((await communicator.receive_output())['code'], 4000)
+            self.assertTrue(await owner.receive_nothing())
+
+            self.client.force_authenticate(moderator)
+            await sync_to_async(self.client.post)(reverse('block-user', kwargs={'user_id': self.user.pk}))
+            self.assertEqual((await owner.receive_output())['code'], 4000)
+
+        async_to_sync(scenario)()
+
+
+    @override_settings(CHAT_RATE_LIMIT={'rate': 0.001, 'burst': 2}, CHAT_RATE_LIMIT_CHANNELS={})
+    def test_rate_limit(self):
+        moderator = User.objects.create_user(username='moderator', password='testpass1234', is_moderator=True)
+
+        dropped = self.rate_limit_drops()
+
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.receive_json_from()
+            for i in range(2):
+                await communicator.send_json_to({'message': f'hello {i}'})
+                self.assertEqual((await communicator.receive_json_from())['content'], f'hello {i}')
+
+            with patch.object(ChatConsumer, 'create_message') as create_message:
+                await communicator.send_json_to({'message': 'flood'})
+                response = await communicator.receive_json_from()
+                create_message.assert_not_called()
+            self.assertEqual(response['type'], 'error')
+            self.assertEqual(response['code'], 'rate_limited')
+
+            # Moderators are exempt
+            moderator_communicator = self.communicator(str(RefreshToken.for_user(moderator).access_token))
+            await moderator_communicator.connect()
+            await moderator_communicator.receive_json_from()
+            for i in range(3):
+                await moderator_communicator.send_json_to({'message': f'moderated {i}'})
+                self.assertEqual((await moderator_communicator.receive_json_from())['content'], f'moderated {i}')
+                await communicator.receive_json_from()
+            await moderator_communicator.disconnect()
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertEqual(self.rate_limit_drops() - dropped, 1)
+
+        # Per-channel override
+        with override_settings(CHAT_RATE_LIMIT_CHANNELS={str(self.channel.pk): {'rate': 0, 'burst': 0}}):
+            self.assertIsNone(get_rate_limit(self.channel.pk, self.user))
+        self.assertEqual(get_rate_limit(self.channel.pk, self.user), (0.001, 2))
+        self.assertIsNone(get_rate_limit(self.channel.pk, moderator))
+
+    @override_settings(CHAT_PRESENCE_INTERVAL_MS=50)
+    def test_presence(self):
+        second_token = str(RefreshToken.for_user(self.second_user).access_token)
+
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            self.assertEqual((await communicator.receive_json_from())['online'], ['testuser'])
+            self.assertEqual(await communicator.receive_json_from(), {
+                'type': 'presence', 'channel': self.channel.pk, 'joined': ['testuser'], 'left': []
+            })
+
+            second_communicator = self.communicator(second_token)
+            await second_communicator.connect()
+            self.assertEqual((await second_communicator.receive_json_from())['online'], ['testuser', 'testuser2'])
+            self.assertEqual(await communicator.receive_json_from(), {
+                'type': 'presence', 'channel': self.channel.pk, 'joined': ['testuser2'], 'left': []
+            })
+            await second_communicator.receive_json_from()
+
+            await second_communicator.disconnect()
+            self.assertEqual(await communicator.receive_json_from(), {
+                'type': 'presence', 'channel': self.channel.pk, 'joined': [], 'left': ['testuser2']
+            })
+            self.assertEqual(await presence.online(self.channel.pk), ['testuser'])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_PRESENCE_INTERVAL_MS=50, CHAT_RATE_LIMIT={'rate': 0.001, 'burst': 1})
+    def test_typing_coalesced(self):
+        second_token = str(RefreshToken.for_user(self.second_user).access_token)
+
+        dropped = self.rate_limit_drops()
+
+        async def scenario():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.receive_json_from()
+            second_communicator = self.communicator(second_token)
+            await second_communicator.connect()
+            await second_communicator.receive_json_from()
+            # Both joins land in the same interval
+            await communicator.receive_json_from()
+            await second_communicator.receive_json_from()
+
+            with patch.object(ChatConsumer, 'create_message') as create_message:
+                for _ in range(5):
+                    await communicator.send_json_to({'action': 'typing'})
+                await second_communicator.send_json_to({'action': 'typing'})
+                typing = await communicator.receive_json_from()
+                create_message.assert_not_called()
+            self.assertEqual(typing, {'type': 'typing', 'channel': self.channel.pk, 'users': ['testuser', 'testuser2']})
+            self.assertEqual(await second_communicator.receive_json_from(), typing)
+            self.assertTrue(await communicator.receive_nothing(0.1))
+
+            # Typing is not rate limited
+            await communicator.send_json_to({'message': 'hello'})
+            self.assertEqual((await communicator.receive_json_from())['content'], 'hello')
+            await communicator.disconnect()
+            await second_communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(self.rate_limit_drops() - dropped, 0)
+
+    def slow_communicator(self, delay):
+        """A client whose every received frame takes ``delay`` seconds to go out."""
+        async def slow_application(scope, receive, send):
+            async def slow_send(message):
+                if message['type'] == 'websocket.send':
+                    await asyncio.sleep(delay)
+                await send(message)
+            await application(scope, receive, slow_send)
+
+        return WebsocketCommunicator(slow_application, f'/ws/chat/{self.channel.pk}?token={self.access_token}')
+
+    def send_chat_events(self, messages):
+        async def send():
+            channel_layer = get_channel_layer()
+            for message in messages:
+                await channel_layer.group_send(f'chat_{self.channel.pk}', {
+                    'type': 'chat_message', 'text': dumps(message_payload(message, 'testuser')),
+                    'channel_id': self.channel.pk, 'id': message.id,
+                })
+        return send()
+
+    @override_settings(CHAT_RESYNC_CHUNK_SIZE=2, CHAT_RESYNC_MAX_MESSAGES=4)
+    def test_resync_keeps_queued_messages_past_the_cap(self):
+        messages = Message.objects.bulk_create(
+            Message(channel=self.channel, sender=self.user, content=f'message {i}') for i in range(8)
+        )
+
+        async def scenario():
+            async def slow_application(scope, receive, send):
+                async def slow_send(message):
+                    if message['type'] == 'websocket.send':
+                        await asyncio.sleep(0.05)
+                    await send(message)
+                await application(scope, receive, slow_send)
+
+            communicator = WebsocketCommunicator(slow_application, f'/ws/chat/?token={self.access_token}')
+            await communicator.connect()
+            await communicator.send_json_to({'action': 'subscribe', 'channels': [self.channel.pk]})
+            await communicator.receive_json_from()
+
+            # Live messages queue up behind a slow link, then the client resyncs from before them
+            await self.send_chat_events(messages[2:])
+            await asyncio.sleep(0.02)
+            # The gap grew past the cap after the check
+            with patch.object(MultiplexChatConsumer, 'is_too_far_behind', return_value=False):
+                await communicator.send_json_to({
+                    'action': 'subscribe', 'channels': [self.channel.pk],
+                    'since': {str(self.channel.pk): messages[1].id},
+                })
+                frames = []
+                while not frames or frames[-1].get('id') != messages[-1].id:
+                    frames.append(await communicator.receive_json_from())
+            frames = [frame for frame in frames if frame.get('type') != 'welcome']
+
+            last_resync = max(i for i, frame in enumerate(frames) if frame.get('type') == 'resync')
+            self.assertTrue(frames[last_resync]['done'])
+            resynced = [m['id'] for frame in frames if frame.get('type') == 'resync' for m in frame['messages']]
+            self.assertEqual(resynced, [m.id for m in messages[2:6]])
+            # Past the cap, still delivered live and after the resync
+            self.assertEqual([frame['id'] for frame in frames[last_resync + 1:]], [m.id for m in messages[6:]])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_OUTBOUND_HIGH_WATER=4, CHAT_OUTBOUND_LAG_TIMEOUT=60)
+    def test_slow_client_lagged(self):
+        messages = Message.objects.bulk_create(
+            Message(channel=self.channel, sender=self.user, content=f'message {i}') for i in range(20)
+        )
+        dropped_before = sample('chat_ws_outbound_dropped_total', {'kind': 'chat'})
+
+        async def scenario():
+            communicator = self.slow_communicator(0.02)
+            await communicator.connect()
+            await communicator.receive_json_from()
+            await self.send_chat_events(messages)
+
+            received = []
+            frame = await communicator.receive_json_from()
+            while frame.get('type') != 'lagged':
+                received.append(frame['id'])
+                frame = await communicator.receive_json_from()
+            # Delivered in order up to the gap, the notice points at the last of them
+            self.assertEqual(received, [message.id for message in messages[:len(received)]])
+            self.assertLessEqual(len(received), 5)
+            self.assertEqual(frame, {
+                'type': 'lagged', 'channel': self.channel.pk, 'dropped': 20 - len(received), 'last_id': received[-1],
+            })
+            self.assertTrue(await communicator.receive_nothing(0.1))
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertGreaterEqual(sample('chat_ws_outbound_dropped_total', {'kind': 'chat'}) - dropped_before, 15)
+
+    @override_settings(CHAT_OUTBOUND_HIGH_WATER=2, CHAT_OUTBOUND_LAG_TIMEOUT=0.05)
+    def test_chronically_slow_client_closed(self):
+        messages = Message.objects.bulk_create(
+            Message(channel=self.channel, sender=self.user, content=f'message {i}') for i in range(5)
+        )
+
+        async def scenario():
+            communicator = self.slow_communicator(1)
+            await communicator.connect()
+            await communicator.receive_json_from(timeout=2)
+            await self.send_chat_events(messages)
+            await asyncio.sleep(0.1)
+            await self.send_chat_events(messages)
+            while True:
+                output = await communicator.receive_output(timeout=5)
+                if output['type'] == 'websocket.close':
+                    break
+            self.assertEqual(output['code'], 4008)
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    # Presence frames are covered by test_presence
+    @override_settings(CHAT_HISTORY_LENGTH=2, CHAT_PRESENCE_INTERVAL_MS=60000)
+    def test_multiplex(self):
+        second_channel = Channel.objects.create(name='Second Channel', owner=self.user)
+        second_channel.members.add(self.user)
+        foreign_channel = Channel.objects.create(name='Foreign Channel', owner=self.second_user)
+        Message.objects.bulk_create(
+            Message(channel=channel, sender=self.user, content=f'{channel.name} {i}')
+            for channel in (self.channel, second_channel) for i in range(3)
+        )
+        recent_history.invalidate(second_channel.pk)
+
+        async def scenario():
+            communicator = WebsocketCommunicator(application, f'/ws/chat/?token={self.access_token}')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            # One permission query and one history query for all channels
+            before = len(queries.captured_queries)
+            await communicator.send_json_to({
+                'action': 'subscribe', 'channels': [self.channel.pk, second_channel.pk, foreign_channel.pk]
+            })
+            denied = await communicator.receive_json_from()
+            welcomes = [await communicator.receive_json_from() for _ in range(2)]
+            self.assertEqual(len(queries.captured_queries) - before, 2)
+            self.assertEqual(denied['code'], 'forbidden')
+            self.assertEqual(denied['channels'], [foreign_channel.pk])
+            self.assertEqual({welcome['channel']: [m['content'] for m in welcome['history']] for welcome in welcomes}, {
+                self.channel.pk: ['Test Channel 2', 'Test Channel 1'],
+                second_channel.pk: ['Second Channel 2', 'Second Channel 1'],
+            })
+            self.assertTrue(all(welcome['next'] for welcome in welcomes))
+
+            await communicator.send_json_to({'channel': second_channel.pk, 'message': 'hello'})
+            response = await communicator.receive_json_from()
+            self.assertEqual((response['channel'], response['content']), (second_channel.pk, 'hello'))
+
+            await communicator.send_json_to({'action': 'history', 'channel': second_channel.pk, 'before': welcomes[1]['next']})
+            history = await communicator.receive_json_from()
+            self.assertEqual((history['type'], history['channel']), ('history', second_channel.pk))
+            self.assertEqual([m['content'] for m in history['history']], ['Second Channel 0'])
+
+            await communicator.send_json_to({'channel': foreign_channel.pk, 'message': 'hello'})
+            self.assertEqual((await communicator.receive_json_from())['code'], 'not_subscribed')
+
+            await communicator.send_json_to({'action': 'unsubscribe', 'channels': [self.channel.pk]})
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'unsubscribed', 'channel': self.channel.pk})
+            await get_channel_layer().group_send(f'chat_{self.channel.pk}', {'type': 'chat_message', 'text': '{}'})
+            self.assertTrue(await communicator.receive_nothing())
+
+            # Removal from one channel only drops that subscription
+            await sync_to_async(second_channel.members.remove)(self.user)
+            self.assertEqual(await communicator.receive_json_from(), {
+                'type': 'unsubscribed', 'channel': second_channel.pk, 'message': 'You were deleted from chat'
+            })
+            await communicator.send_json_to({'channel': second_channel.pk, 'message': 'hello'})
+            self.assertEqual((await communicator.receive_json_from())['code'], 'not_subscribed')
+            await communicator.disconnect()
+
+        # Database calls run on this thread, resolve its connection here rather than in the event loop
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            async_to_sync(scenario)()
+
+    @override_settings(CHAT_MULTIPLEX_MAX_CHANNELS=1, CHAT_SUBSCRIBE_RATE_LIMIT={'rate': 0.001, 'burst': 2})
+    def test_multiplex_limits(self):
+        dropped = self.rate_limit_drops('subscribe')
+
+        async def scenario():
+            communicator = WebsocketCommunicator(application, f'/ws/chat/?token={self.access_token}')
+            await communicator.connect()
+            await communicator.send_json_to({'action': 'subscribe', 'channels': [self.channel.pk, self.channel.pk + 1]})
+            self.assertEqual((await communicator.receive_json_from())['code'], 'too_many_channels')
+            await communicator.send_json_to({'action': 'subscribe', 'channels': 'all'})
+            self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+
+            # Subscriptions are limited per user, a new socket doesn't refill the bucket
+            await communicator.send_json_to({'action': 'unsubscribe', 'channels': [self.channel.pk]})
+            await communicator.disconnect()
+            communicator = WebsocketCommunicator(application, f'/ws/chat/?token={self.access_token}')
+            await communicator.connect()
+            with patch.object(MultiplexChatConsumer, 'subscribe') as subscribe:
+                await communicator.send_json_to({'action': 'subscribe', 'channels': [self.channel.pk]})
+                self.assertEqual((await communicator.receive_json_from())['code'], 'rate_limited')
+                subscribe.assert_not_called()
+            await communicator.disconnect()
+
+            communicator = WebsocketCommunicator(application, '/ws/chat/?token=invalid')
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(scenario)()
+        self.assertEqual(self.rate_limit_drops('subscribe') - dropped, 1)
+
+@override_settings(CHAT_RATE_LIMIT={'rate': 0, 'burst': 0}, CHAT_RATE_LIMIT_CHANNELS={})
+class ConnectionReuseTestCase(TransactionTestCase):
+    """Outside of a test transaction, so connections are really closed when they expire."""
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('In-memory SQLite connections are never closed, run with Postgres or a file-backed test database.')
+        self.opened = 0
+        connection_created.connect(self.count_connection)
+        self.addCleanup(connection_created.disconnect, self.count_connection)
+        # Messages counted in the background must land before the tables are flushed
+        self.addCleanup(message_counter.drain_sync)
+
+    def count_connection(self, sender, connection, **kwargs):
+        self.opened += 1
+
+    def physical_connections(self):
+        pool = getattr(type(connection), '_connection_pools', {}).get(connection.alias)
+        if pool is not None:
+            return pool.get_stats().get('connections_num', 0)
+        return self.opened
+
+    def test_connections_reused_across_messages(self):
+        membership_cache.clear()
+        user = User.objects.create_user(username='testuser', password='testpass1234')
+        channel = Channel.objects.create(name='Test Channel', owner=user)
+        channel.members.add(user)
+        recent_history.invalidate(channel.pk)
+        token = str(RefreshToken.for_user(user).access_token)
+        opened_before = self.physical_connections()
+
+        async def scenario():
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{channel.pk}?token={token}')
+            await communicator.connect()
+            await communicator.receive_json_from()
+            for i in range(2000):
+                await communicator.send_json_to({'message': f'hello {i}'})
+                await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(Message.objects.count(), 2000)
+        # At most the first connection of the thread running database calls.
+        self.assertLessEqual(self.physical_connections() - opened_before, 1)
+
+class EventDispatcherTestCase(SimpleTestCase):
+    class RecordingLayer:
+        def __init__(self):
+            self.sent = []
+            self.release = threading.Event()
+
+        async def group_send(self, group, event):
+            await asyncio.get_running_loop().run_in_executor(None, self.release.wait)
+            self.sent.append((group, event['type']))
+
+    @override_settings(CHAT_EVENT_DISPATCH='background')
+    def test_background_dispatch(self):
+        layer = self.RecordingLayer()
+        dispatcher = EventDispatcher()
+        with patch('chat.dispatch.get_channel_layer', return_value=layer):
+            dispatcher.send([('chat_1', {'type': 'force_disconnect'}), ('chat_2', {'type': 'force_disconnect'})])
+            dispatcher.send([('chat_1', {'type': 'membership_invalidate'})])
+            # The caller returns before the layer has sent anything
+            self.assertEqual(layer.sent, [])
+            layer.release.set()
+            dispatcher.flush()
+        self.assertEqual(sorted(layer.sent), [
+            ('chat_1', 'force_disconnect'), ('chat_1', 'membership_invalidate'), ('chat_2', 'force_disconnect'),
+        ])
+
+    @override_settings(CHAT_EVENT_DISPATCH='inline')
+    def test_inline_dispatch(self):
+        layer = self.RecordingLayer()
+        layer.release.set()
+        with patch('chat.dispatch.get_channel_layer', return_value=layer):
+            EventDispatcher().send([('chat_1', {'type': 'force_disconnect'})])
+        self.assertEqual(layer.sent, [('chat_1', 'force_disconnect')])
+
+class DatabaseExecutorTestCase(SimpleTestCase):
+    def run_in_thread(self):
+        def thread_name():
+            return threading.current_thread().name
+
+        return async_to_sync(database_sync_to_async(thread_name))()
+
+    def test_thread_sensitive_by_default(self):
+        with override_settings(CHAT_DB_EXECUTOR_WORKERS=0):
+            self.assertEqual(self.run_in_thread(), threading.current_thread().name)
+
+    def test_dedicated_executor(self):
+        with override_settings(CHAT_DB_EXECUTOR_WORKERS=2), patch('chat.db._executor', None):
+            self.assertTrue(self.run_in_thread().startswith('chat-db'))
+            get_executor().shutdown()
+
+class MessageCounterTestCase(SimpleTestCase):
+    @override_settings(CHAT_UNREAD_FLUSH_INTERVAL_MS=10)
+    def test_timer_follows_the_running_loop(self):
+        counter = MessageCounter()
+        counted = []
+
+        async def add_and_wait(channel_id, delay):
+            counter.add(channel_id)
+            await asyncio.sleep(delay)
+
+        with patch('chat.unread.advance_counts', side_effect=counted.append):
+            # The first loop closes before its timer fires, the second one has to arm its own
+            async_to_sync(add_and_wait)(1, 0)
+            async_to_sync(add_and_wait)(2, 0.1)
+        self.assertEqual(counted, [{1, 2}])
+
+class RateLimiterTestCase(SimpleTestCase):
+    def assert_bucket(self, limiter):
+        async def scenario():
+            results = [await limiter.allow('1:1', 0.001, 2) for _ in range(3)]
+            self.assertEqual(results, [True, True, False])
+            self.assertTrue(await limiter.allow('1:2', 0.001, 2))
+            # Refills over time
+            self.assertTrue(await limiter.allow('2:1', 1000, 1))
+            await asyncio.sleep(0.01)
+            self.assertTrue(await limiter.allow('2:1', 1000, 1))
+
+        async_to_sync(scenario)()
+
+    def test_local_limiter(self):
+        self.assert_bucket(LocalRateLimiter(max_buckets=100))
+
+    @skipUnless(fakeredis, 'Needs fakeredis[lua]')
+    def test_redis_limiter(self):
+        limiter = RedisRateLimiter(url='redis://localhost')
+        limiter._client = fakeredis.aioredis.FakeRedis()
+        self.assert_bucket(limiter)
+
+class PresenceTestCase(SimpleTestCase):
+    def test_local_presence(self):
+        async def scenario():
+            backend = LocalPresence(ttl=60)
+            self.assertTrue(await backend.join(1, 1, 'first'))
+            self.assertFalse(await backend.join(1, 1, 'first'))
+            self.assertTrue(await backend.join(1, 2, 'second'))
+            self.assertEqual(await backend.online(1), ['first', 'second'])
+            self.assertFalse(await backend.leave(1, 1))
+            self.assertTrue(await backend.leave(1, 1))
+            self.assertEqual(await backend.online(1), ['second'])
+
+        async_to_sync(scenario)()
+
+    @skipUnless(fakeredis, 'Needs fakeredis')
+    def test_redis_presence(self):
+        server = fakeredis.FakeServer()
+
+        async def scenario():
+            workers = [RedisPresence(ttl=60, url='redis://localhost') for _ in range(2)]
+            for worker in workers:
+                worker._client = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+
+            # Online across workers until the last connection anywhere closes
+            self.assertTrue(await workers[0].join(1, 1, 'first'))
+            self.assertFalse(await workers[1].join(1, 1, 'first'))
+            self.assertTrue(await workers[1].join(1, 2, 'second'))
+            self.assertEqual(await workers[0].online(1), ['first', 'second'])
+            self.assertFalse(await workers[0].leave(1, 1))
+            self.assertTrue(await workers[1].leave(1, 1))
+            self.assertEqual(await workers[0].online(1), ['second'])
+
+            await workers[0].refresh()
+            await workers[1].refresh()
+            self.assertEqual(await workers[0].online(1), ['second'])
+            for worker in workers:
+                worker._heartbeat.cancel()
+
+        async_to_sync(scenario)()
+
+class RecentHistoryTestCase(SimpleTestCase):
+    def test_local_append_keeps_order(self):
+        async def scenario():
+            history = LocalHistory(length=3, ttl=60, max_channels=10)
+            history.watch(1)
+            await history.fill(1, [{'id': 5}, {'id': 2}])
+            # Messages of other processes can arrive late
+            for message_id in (6, 3, 3, 1):
+                await history.append(1, {'id': message_id})
+            self.assertEqual([m['id'] for m in await history.get(1)], [6, 5, 3])
+
+        async_to_sync(scenario)()
+
+    @skipUnless(fakeredis, 'Needs fakeredis')
+    def test_redis_fill_keeps_concurrent_appends(self):
+        def message(i):
+            return {'id': i, 'content': f'message {i}'}
+
+        async def scenario():
+            history = RedisHistory(length=3, ttl=60, url='redis://localhost')
+            history._client = fakeredis.aioredis.FakeRedis()
+
+            # Another worker appends between this one's miss and its fill
+            self.assertIsNone(await history.get(1))
+            await history.append(1, message(3))
+            await history.fill(1, [message(2), message(1), message(0)])
+            self.assertEqual([m['id'] for m in await history.get(1)], [3, 2, 1])
+
+            # Already filled by someone else
+            await history.fill(1, [message(0)])
+            self.assertEqual([m['id'] for m in await history.get(1)], [3, 2, 1])
+
+        async_to_sync(scenario)()
+
+
+class MetricsTestCase(APITestCase):
+    def tearDown(self):
+        message_counter.drain_sync()
+
+    def test_timed_recording_can_be_switched_off(self):
+        registry = CollectorRegistry()
+        latency = Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1), registry=registry)
+
+        @timed(latency)
+        async def handler():
+            pass
+
+        async_to_sync(handler)()
+        set_enabled(False)
+        try:
+            async_to_sync(handler)()
+        finally:
+            set_enabled(True)
+        self.assertEqual(registry.get_sample_value('latency_seconds_count'), 1)
+        self.assertEqual(registry.get_sample_value('latency_seconds_bucket', {'le': '0.1'}), 1)
+
+    def test_endpoint_and_instrumentation(self):
+        user = User.objects.create_user(username='testuser', password='testpass1234')
+        channel = Channel.objects.create(name='Test Channel', owner=user)
+        channel.members.add(user)
+        recent_history.invalidate(channel.pk)
+        token = str(RefreshToken.for_user(user).access_token)
+        connections_before = sample('chat_ws_connections')
+
+        async def scenario():
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{channel.pk}?token={token}')
+            await communicator.connect()
+            await communicator.receive_json_from()
+            self.assertEqual(sample('chat_ws_connections'), connections_before + 1)
+            await communicator.send_json_to({'message': 'hello'})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(sample('chat_ws_connections'), connections_before)
+
+        self.client.force_authenticate(user)
+        self.client.get(reverse('channel-list'))
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('# TYPE chat_ws_event_seconds histogram', body)
+        for name, labels in (
+            ('chat_http_request_seconds_count', {'view': 'channel-list', 'method': 'GET', 'status': '200'}),
+            ('chat_http_request_queries_bucket', {'view': 'channel-list', 'le': '1.0'}),
+            ('chat_ws_event_seconds_count', {'event': 'receive'}),
+            ('chat_db_call_seconds_count', {'function': 'ChatConsumer.create_message'}),
+            ('chat_db_queue_seconds_count', None),
+            ('chat_group_send_seconds_count', None),
+            ('chat_ws_handshake_seconds_count', {'outcome': 'db_lookups'}),
+        ):
+            self.assertGreater(sample(name, labels), 0, name)
+
+        with override_settings(METRICS_ENABLED=False):
+            self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_404_NOT_FOUND)
+
+class HashRingTestCase(SimpleTestCase):
+    def test_mapping_is_stable_and_spread(self):
+        ring = HashRing(['redis-a:6379', 'redis-b:6379', 'redis-c:6379'])
+        keys = [f'chat_{i}' for i in range(3000)]
+        indexes = [ring.get_index(key) for key in keys]
+        self.assertEqual(indexes, [HashRing(ring.nodes).get_index(key) for key in keys])
+        for index in range(3):
+            self.assertGreater(indexes.count(index), 700)
+
+    def test_adding_a_shard_moves_few_keys(self):
+        keys = [f'chat_{i}' for i in range(3000)]
+        before = HashRing(['redis-a:6379', 'redis-b:6379', 'redis-c:6379'])
+        after = HashRing(['redis-a:6379', 'redis-b:6379', 'redis-c:6379', 'redis-d:6379'])
+        moved = [key for key in keys if before.get_index(key) != after.get_index(key)]
+        # Only keys taken over by the new shard move, roughly a quarter.
+        self.assertLess(len(moved), len(keys) * 0.35)
+        self.assertTrue(all(after.get_index(key) == 3 for key in moved))
+
+
+@skipUnless(
+    os.getenv('REDIS_SHARD_TEST_HOSTS') or fakeredis,
+    'Needs fakeredis[lua] or REDIS_SHARD_TEST_HOSTS with several local redis-server instances'
+)
+class ShardedChannelLayerTestCase(SimpleTestCase):
+    """
+    Rooms spread over three shards, two workers subscribed to every room and
+    a third one sending. Uses the redis-server instances listed in
+    REDIS_SHARD_TEST_HOSTS (comma separated redis:// URLs) or fakeredis.
+    """
+
+    def setUp(self):
+        if os.getenv('REDIS_SHARD_TEST_HOSTS'):
+            self.hosts = os.getenv('REDIS_SHARD_TEST_HOSTS').split(',')
+            return
+
+        self.hosts = ['redis://shard-0', 'redis://shard-1', 'redis://shard-2']
+        servers = {}
+
+        def create_pool(host):
+            server = servers.setdefault(shard_name(host), fakeredis.FakeServer())
+            return fakeredis.aioredis.FakeRedis(server=server).connection_pool
+
+        for target in ('channels_redis.core.create_pool', 'channels_redis.pubsub.create_pool'):
+            patcher = patch(target, create_pool)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assert_fan_out(self, layer_class):
+        rooms = [f'chat_{i}' for i in range(12)]
+
+        async def scenario():
+            workers = [layer_class(hosts=self.hosts) for _ in range(3)]
+            self.assertEqual({workers[0].ring.get_index(room) for room in rooms}, {0, 1, 2})
+
+            subscriptions = []
+            for room in rooms:
+                for worker in workers[:2]:
+                    channel_name = await worker.new_channel()
+                    await worker.group_add(room, channel_name)
+                    subscriptions.append((room, worker, channel_name))
+
+            for room in rooms:
+                await workers[2].group_send(room, {'type': 'chat_message', 'text': room})
+
+            for room, worker, channel_name in subscriptions:
+                event = await asyncio.wait_for(worker.receive(channel_name), timeout=5)
+                self.assertEqual(event['text'], room)
+
+            for worker in workers:
+                await worker.flush()
+
+        async_to_sync(scenario)()
+
+    def test_core_layer_fan_out(self):
+        self.assert_fan_out(ShardedRedisChannelLayer)
+
+    def test_pubsub_layer_fan_out(self):
+        self.assert_fan_out(ShardedRedisPubSubChannelLayer)
@@ -0,0 +1,38 @@
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+# Copied into access tokens so the WebSocket handshake can authenticate
+# without a user lookup, see chat.middleware.get_user.
+USER_CLAIMS = ('username', 'is_moderator', 'is_blocked')
+
+
+class ChatRefreshToken(RefreshToken):
+    """
+    Refresh tokens carry no user claims. Every access token minted from one
+    reads them from the user row, so a refresh picks up role and block
+    changes and stale claims live at most ``ACCESS_TOKEN_LIFETIME``.
+    """
+
+    user = None
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token.user = user
+        return token
+
+    @property
+    def access_token(self):
+        from django.contrib.auth import get_user_model
+        access = super().access_token
+        user = self.user
+        if user is None:
+            user = get_user_model().objects.filter(
+                **{api_settings.USER_ID_FIELD: self[api_settings.USER_ID_CLAIM]}
+            ).first()
+        for claim in USER_CLAIMS:
+            # Refresh tokens issued before carry claims of their own, never copy those
+            access.payload.pop(claim, None)
+            if user is not None:
+                access[claim] = getattr(user, claim)
+        return access
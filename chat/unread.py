@@ -0,0 +1,240 @@
+import asyncio
+import logging
+from bisect import bisect_right
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, IntegerField, Max, OuterRef, Subquery, When
+from django.db.models.functions import Coalesce, Greatest
+
+from chat.db import database_sync_to_async
+from chat.models import Channel, Message, ReadState
+
+logger = logging.getLogger(__name__)
+
+
+def count_messages(channel_id, **lookups):
+    """Messages of the channel matching ``lookups`` on id, a range scan of message_channel_id_idx."""
+    return Coalesce(Subquery(
+        Message.objects.filter(channel_id=channel_id, **lookups).order_by().values('channel_id').annotate(
+            count=Count('*'),
+        ).values('count'),
+        output_field=IntegerField(),
+    ), 0)
+
+
+def count_after(channel_id, message_id):
+    return count_messages(channel_id, id__gt=message_id)
+
+
+def count_between(channel_id, low, high):
+    """Messages with ``low < id <= high``."""
+    return count_messages(channel_id, id__gt=low, id__lte=high)
+
+
+def unread_annotations(user_id, is_member):
+    """
+    ``last_read_id`` and ``unread`` of ``user_id`` for a channel queryset,
+    ``unread`` is null where the ``is_member`` condition doesn't hold.
+
+    One lookup in the read state unique index per channel, whatever the
+    channel size. Members who never read a channel have every message unread.
+    """
+    read_state = ReadState.objects.filter(channel_id=OuterRef('pk'), user_id=user_id)
+    unread = Greatest(F('message_count') - Coalesce(Subquery(read_state.values('read_count')), 0), 0)
+    return {
+        'last_read_id': Subquery(read_state.values('last_read_id')),
+        'unread': Case(When(is_member, then=unread), default=None, output_field=IntegerField()),
+    }
+
+
+def advance_counts(channel_ids):
+    """
+    Adds the messages inserted since the last call to ``Channel.message_count``.
+
+    Runs after the inserts rather than in their transaction: messages above
+    ``counted_id`` are new, so writers never touch the channel row and each
+    call locks it once per channel, however many messages arrived.
+    """
+    for channel_id in sorted(channel_ids):
+        with transaction.atomic():
+            counted_id = Channel.objects.select_for_update().filter(pk=channel_id).values_list(
+                'counted_id', flat=True,
+            ).first()
+            if counted_id is None:
+                continue
+            new = Message.objects.filter(channel_id=channel_id, id__gt=counted_id).aggregate(
+                count=Count('id'), last_id=Max('id'),
+            )
+            if new['count']:
+                Channel.objects.filter(pk=channel_id).update(
+                    message_count=F('message_count') + new['count'], counted_id=new['last_id'],
+                )
+
+
+def forget_messages(channel_id, message_ids):
+    """
+    Takes deleted messages of ``channel_id`` out of its counter and out of
+    the read counts of readers past them. Call it in the deleting transaction.
+    """
+    message_ids = sorted(message_ids)
+    if not message_ids:
+        return
+
+    # Messages above counted_id were never counted
+    counted_id = Channel.objects.select_for_update().filter(pk=channel_id).values_list('counted_id', flat=True).first()
+    counted = bisect_right(message_ids, counted_id or 0)
+    if counted:
+        Channel.objects.filter(pk=channel_id).update(message_count=Greatest(F('message_count') - counted, 0))
+
+    ReadState.objects.filter(channel_id=channel_id, last_read_id__gte=message_ids[-1]).update(
+        read_count=F('read_count') - len(message_ids),
+    )
+    # Only readers whose pointer falls inside the deleted range need a count of their own
+    inside = ReadState.objects.filter(
+        channel_id=channel_id, last_read_id__gte=message_ids[0], last_read_id__lt=message_ids[-1],
+    ).values_list('id', 'last_read_id')
+    for state_id, last_read_id in inside:
+        ReadState.objects.filter(pk=state_id).update(
+            read_count=F('read_count') - bisect_right(message_ids, last_read_id),
+        )
+
+
+def start_reading(channel_id, user_ids):
+    """New members start with nothing unread, read states already there are kept."""
+    row = Channel.objects.filter(pk=channel_id).annotate(
+        last_id=Subquery(Message.objects.filter(channel_id=OuterRef('pk')).order_by('-id').values('id')[:1]),
+    ).annotate(
+        uncounted=count_between(OuterRef('pk'), OuterRef('counted_id'), OuterRef('last_id')),
+    ).values_list('message_count', 'last_id', 'uncounted').first()
+    if row is None or row[1] is None:
+        return
+    message_count, last_id, uncounted = row
+    ReadState.objects.bulk_create([
+        ReadState(user_id=user_id, channel_id=channel_id, last_read_id=last_id, read_count=message_count + uncounted)
+        for user_id in user_ids
+    ], ignore_conflicts=True)
+
+
+def mark_read(user_id, channel_id, message_id):
+    """
+    Moves the read pointer of ``user_id`` in ``channel_id`` forward to
+    ``message_id``, it never moves back. Returns ``(last_read_id, unread)``.
+
+    Raises ``Message.DoesNotExist`` when ``message_id`` isn't a message of
+    the channel.
+    """
+    # One statement, so the counter and the ranges around message_id come from the same snapshot.
+    # Messages up to message_id are the counted ones minus those counted past it, plus those
+    # not counted yet below it.
+    row = Channel.objects.filter(pk=channel_id).annotate(
+        found=Exists(Message.objects.filter(channel_id=OuterRef('pk'), id=message_id)),
+        newer=count_after(OuterRef('pk'), message_id),
+        counted_newer=count_between(OuterRef('pk'), message_id, OuterRef('counted_id')),
+        uncounted_older=count_between(OuterRef('pk'), OuterRef('counted_id'), message_id),
+    ).values_list('found', 'message_count', 'newer', 'counted_newer', 'uncounted_older').first()
+    if row is None or not row[0]:
+        raise Message.DoesNotExist(f'Message {message_id} not found in channel {channel_id}.')
+    _, message_count, newer, counted_newer, uncounted_older = row
+    read_count = message_count - counted_newer + uncounted_older
+
+    with transaction.atomic():
+        state, created = ReadState.objects.select_for_update().get_or_create(
+            user_id=user_id, channel_id=channel_id,
+            defaults={'last_read_id': message_id, 'read_count': read_count},
+        )
+        if created:
+            return message_id, newer
+        if state.last_read_id >= message_id:
+            return state.last_read_id, max(0, message_count - state.read_count)
+        state.last_read_id = message_id
+        state.read_count = read_count
+        state.save(update_fields=['last_read_id', 'read_count', 'updated_at'])
+    return message_id, newer
+
+
+def reconcile_channel(channel_id):
+    """
+    Recounts ``Channel.message_count`` and the read counts of ``channel_id``
+    from the message table. Returns ``(counter drift, read states fixed)``.
+
+    The channel row stays locked while counting, which only holds back
+    ``advance_counts`` for this channel, not message inserts.
+    """
+    with transaction.atomic():
+        stored = Channel.objects.select_for_update().filter(pk=channel_id).values_list('message_count', flat=True).first()
+        if stored is None:
+            return 0, 0
+        counted = Message.objects.filter(channel_id=channel_id).aggregate(count=Count('id'), last_id=Max('id'))
+        message_count, counted_id = counted['count'], counted['last_id'] or 0
+        Channel.objects.filter(pk=channel_id).update(message_count=message_count, counted_id=counted_id)
+
+        # Messages inserted since the count above are left to advance_counts
+        expected = message_count - count_between(channel_id, OuterRef('last_read_id'), counted_id)
+        fixed = list(ReadState.objects.filter(channel_id=channel_id).annotate(expected=expected).exclude(
+            read_count=F('expected'),
+        ).values_list('id', 'expected'))
+        for state_id, read_count in fixed:
+            ReadState.objects.filter(pk=state_id).update(read_count=read_count)
+    return message_count - stored, len(fixed)
+
+
+class MessageCounter:
+    """
+    Channels that got messages in this process, counted by ``advance_counts``
+    every ``CHAT_UNREAD_FLUSH_INTERVAL_MS`` instead of in every insert.
+
+    Nothing is written at exit: messages left above ``counted_id`` are
+    counted by the next flush of their channel or by ``reconcile_unread``.
+    """
+
+    def __init__(self):
+        self._channel_ids = set()
+        self._timer = None
+        self._loop = None
+        self._tasks = set()
+
+    def add(self, channel_id):
+        self._channel_ids.add(channel_id)
+        loop = asyncio.get_running_loop()
+        # A timer armed on another loop (one that closed, e.g. under async_to_sync) never fires
+        if self._timer is None or self._loop is not loop:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._loop = loop
+            self._timer = loop.call_later(settings.CHAT_UNREAD_FLUSH_INTERVAL_MS / 1000, self._start_flush, loop)
+
+    def _start_flush(self, loop):
+        task = loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _take_channels(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = self._loop = None
+        channel_ids, self._channel_ids = self._channel_ids, set()
+        return channel_ids
+
+    async def flush(self):
+        channel_ids = self._take_channels()
+        if not channel_ids:
+            return
+        try:
+            await database_sync_to_async(advance_counts)(channel_ids)
+        except Exception as e:
+            # Left above counted_id, the next flush of these channels picks them up
+            logger.error(f"Error counting messages of {len(channel_ids)} channels: {e}")
+
+    async def drain(self):
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def drain_sync(self):
+        channel_ids = self._take_channels()
+        if channel_ids:
+            advance_counts(channel_ids)
+
+
+message_counter = MessageCounter()
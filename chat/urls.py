@@ -2,16 +2,25 @@ from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
 from chat.views import (MessageViewSet, ChannelViewSet, ChannelJoinView, ChannelLeaveView,
-                        BlockUserGloballyView, RegisterView)
+                        BlockUserGloballyView, RegisterView, ChannelExportView,
+                        ChannelMembersView, ChannelBulkJoinView, ChannelBulkLeaveView, MessageSearchView,
+                        ChannelMarkReadView)
 
 router = DefaultRouter()
 router.register(r'channels', ChannelViewSet)
 router.register(r'messages', MessageViewSet, basename='messages')
 
 urlpatterns = [
+    # Before the router, whose messages/<pk>/ route would match it
+    path('messages/search/', MessageSearchView.as_view(), name='message-search'),
     path('', include(router.urls)),
     path('register/', RegisterView.as_view(), name='user-register'),
     path('moderator/block-globally/<int:user_id>/', BlockUserGloballyView.as_view(), name='block-user'),
     path('channels/join/<int:pk>/', ChannelJoinView.as_view(), name='channel-join'),
     path('channels/leave/<int:pk>/', ChannelLeaveView.as_view(), name='channel-leave'),
+    path('channels/<int:pk>/read/', ChannelMarkReadView.as_view(), name='channel-read'),
+    path('channels/<int:pk>/members/', ChannelMembersView.as_view(), name='channel-members'),
+    path('channels/<int:pk>/members/bulk-join/', ChannelBulkJoinView.as_view(), name='channel-bulk-join'),
+    path('channels/<int:pk>/members/bulk-leave/', ChannelBulkLeaveView.as_view(), name='channel-bulk-leave'),
+    path('channels/<int:pk>/export/', ChannelExportView.as_view(), name='channel-export'),
 ]
\ No newline at end of file
@@ -1,13 +1,30 @@
+from django.conf import settings
+from django.db import transaction
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Count, Exists, OuterRef
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import viewsets, status
-from rest_framework.generics import GenericAPIView, CreateAPIView
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.generics import GenericAPIView, CreateAPIView, ListAPIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.tokens import RefreshToken
 
-from chat.models import User, Channel, Message
-from chat.permissions import IsModerator, IsOwnerOrModerator, IsNotBlocked
-from chat.serializers import UserSerializer, ChannelSerializer, MessageSerializer, RegisterSerializer
+from chat.export import aiter_chunks, iter_gzip, iter_ndjson
+from chat.history import invalidate_recent_history
+from chat.membership import add_members, kick_users, remove_member, remove_members
+from chat.models import ArchivedMessage, User, Channel, Message
+from chat.pagination import IdCursorPagination, MessageCursorPagination, SearchCursorPagination
+from chat.permissions import IsModerator, IsOwnerOrModerator, IsNotBlocked, IsChannelOwnerOrModerator
+from chat.serializers import (UserSerializer, ChannelSerializer, MessageSerializer, RegisterSerializer,
+                              BulkMembershipSerializer, ChannelListSerializer, MemberSerializer,
+                              MessageSearchSerializer, ArchivedMessageSerializer, MarkReadSerializer)
+from chat.search import search_messages
+from chat.tokens import ChatRefreshToken
+from chat.unread import advance_counts, forget_messages, mark_read, unread_annotations
 
 
 class RegisterView(CreateAPIView):
@@ -18,7 +35,7 @@ class RegisterView(CreateAPIView):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = serializer.save()
-        refresh = RefreshToken.for_user(user)
+        refresh = ChatRefreshToken.for_user(user)
         return Response({
             'refresh': str(refresh),
             'access': str(refresh.access_token)
@@ -29,6 +46,23 @@ class ChannelViewSet(viewsets.ModelViewSet):
     queryset = Channel.objects.all()
     serializer_class = ChannelSerializer
     permission_classes = [IsAuthenticated, IsOwnerOrModerator]
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            is_member = Exists(Channel.members.through.objects.filter(channel_id=OuterRef('pk'), user_id=self.request.user.id))
+            queryset = queryset.annotate(
+                member_count=Count('members'),
+                is_member=is_member,
+                **unread_annotations(self.request.user.id, is_member),
+            )
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return ChannelListSerializer
+        return super().get_serializer_class()
 
     def perform_create(self, serializer):
         channel = serializer.save(owner=self.request.user)
@@ -41,13 +75,15 @@ class ChannelJoinView(GenericAPIView):
 
     def put(self, request, pk):
         try:
-            channel = Channel.objects.get(pk=pk)
-            if request.user in channel.black_list.all() or request.user.is_blocked:
+            channel = Channel.objects.annotate(
+                is_banned=Exists(Channel.black_list.through.objects.filter(channel_id=OuterRef('pk'), user_id=request.user.id)),
+                is_member=Exists(Channel.members.through.objects.filter(channel_id=OuterRef('pk'), user_id=request.user.id)),
+            ).only('id').get(pk=pk)
+            if channel.is_banned or request.user.is_blocked:
                 return Response(status=status.HTTP_403_FORBIDDEN)
-            if request.user in channel.members.all():
+            if channel.is_member:
                 return Response({'status': 'already joined'})
-            channel.members.add(request.user)
-            channel.save()
+            add_members(channel.id, [request.user.id])
             return Response(status=status.HTTP_200_OK)
         except Channel.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
@@ -58,27 +94,170 @@ class ChannelLeaveView(APIView):
     permission_classes = [IsAuthenticated]
 
     def put(self, request, pk):
-        try:
-            channel = Channel.objects.get(pk=pk)
-            if request.user not in channel.members.all():
-                return Response(status=status.HTTP_404_NOT_FOUND)
-            channel.members.remove(request.user)
-            channel.save()
-            return Response(status=status.HTTP_200_OK)
-        except Channel.DoesNotExist:
+        # A missing channel and a missing membership both answer 404.
+        if not remove_member(pk, request.user.id):
             return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_200_OK)
+
+
+class ChannelMarkReadView(GenericAPIView):
+    serializer_class = MarkReadSerializer
+    permission_classes = [IsAuthenticated]
+
+    def put(self, request, pk):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if not Channel.members.through.objects.filter(channel_id=pk, user_id=request.user.id).exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        try:
+            last_read_id, unread = mark_read(request.user.id, pk, serializer.validated_data['message_id'])
+        except Message.DoesNotExist:
+            raise ValidationError({'message_id': 'Not a message of this channel.'})
+        return Response({'channel': pk, 'last_read_id': last_read_id, 'unread': unread})
+
+
+class ChannelMembersView(ListAPIView):
+    serializer_class = MemberSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        if not Channel.objects.filter(pk=self.kwargs['pk']).exists():
+            raise NotFound()
+        return User.objects.filter(channels=self.kwargs['pk']).only('id', 'username', 'is_moderator')
+
+
+class ChannelBulkJoinView(GenericAPIView):
+    serializer_class = BulkMembershipSerializer
+    permission_classes = [IsAuthenticated, IsChannelOwnerOrModerator]
+
+    def post(self, request, pk):
+        channel = get_object_or_404(Channel.objects.only('id', 'owner_id'), pk=pk)
+        self.check_object_permissions(request, channel)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        user_ids = list(
+            User.objects.filter(pk__in=serializer.validated_data['user_ids'], is_blocked=False)
+            .exclude(black_list=channel)
+            .exclude(channels=channel)
+            .values_list('id', flat=True)
+        )
+        if user_ids:
+            add_members(channel.id, user_ids)
+        return Response({'added': user_ids})
+
+
+class ChannelBulkLeaveView(GenericAPIView):
+    serializer_class = BulkMembershipSerializer
+    permission_classes = [IsAuthenticated, IsChannelOwnerOrModerator]
+
+    def post(self, request, pk):
+        channel = get_object_or_404(Channel.objects.only('id', 'owner_id'), pk=pk)
+        self.check_object_permissions(request, channel)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        user_ids = remove_members(channel.id, serializer.validated_data['user_ids'])
+        return Response({'removed': user_ids})
 
 
 class MessageViewSet(viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageCursorPagination
+
+    def is_archive(self):
+        # Archived history is read-only and continues where the live history ends, same cursors
+        return self.action == 'list' and self.request.query_params.get('archive') in ('1', 'true')
 
     def get_queryset(self):
         channel_id = self.request.query_params.get('channel', None)
-        return Message.objects.filter(channel_id=channel_id)
+        model = ArchivedMessage if self.is_archive() else Message
+        return model.objects.filter(channel_id=channel_id).select_related('sender')
+
+    def get_serializer_class(self):
+        return ArchivedMessageSerializer if self.is_archive() else MessageSerializer
 
     def perform_create(self, serializer):
-        serializer.save(sender=self.request.user)
+        message = serializer.save(sender=self.request.user)
+        advance_counts([message.channel_id])
+        invalidate_recent_history(message.channel_id)
+
+    def perform_update(self, serializer):
+        old_channel_id = serializer.instance.channel_id
+        with transaction.atomic():
+            message = serializer.save()
+            if message.channel_id != old_channel_id:
+                forget_messages(old_channel_id, [message.id])
+        if message.channel_id != old_channel_id:
+            # Only counted if it is above the new channel's counted_id, reconcile_unread catches the rest
+            advance_counts([message.channel_id])
+            invalidate_recent_history(old_channel_id)
+        invalidate_recent_history(message.channel_id)
+
+    def perform_destroy(self, instance):
+        message_id = instance.id
+        with transaction.atomic():
+            instance.delete()
+            forget_messages(instance.channel_id, [message_id])
+        invalidate_recent_history(instance.channel_id)
+
+
+class MessageSearchView(ListAPIView):
+    serializer_class = MessageSearchSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = SearchCursorPagination
+
+    def get_queryset(self):
+        text = self.request.query_params.get('q', '').strip()
+        if not text:
+            raise ValidationError({'q': 'This query parameter is required.'})
+        if len(text) > settings.CHAT_SEARCH_MAX_LENGTH:
+            raise ValidationError({'q': f'Ensure this value has at most {settings.CHAT_SEARCH_MAX_LENGTH} characters.'})
+
+        channel_id = self.request.query_params.get('channel')
+        if channel_id is not None:
+            try:
+                channel_id = int(channel_id)
+            except ValueError:
+                raise ValidationError({'channel': 'A valid integer is required.'})
+        return search_messages(self.request.user, text, channel_id)
+
+
+class ChannelExportView(APIView):
+    permission_classes = [IsAuthenticated, IsChannelOwnerOrModerator]
+    serializer_class = None
+
+    def get(self, request, pk):
+        channel = get_object_or_404(Channel, pk=pk)
+        self.check_object_permissions(request, channel)
+
+        queryset = Message.objects.filter(channel_id=channel.pk)
+        for param, lookup in (('since', 'created_at__gte'), ('until', 'created_at__lt')):
+            value = request.query_params.get(param)
+            if value is None:
+                continue
+            parsed = parse_datetime(value)
+            if parsed is None:
+                return Response({param: 'Expected an ISO 8601 datetime.'}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(parsed):
+                parsed = timezone.make_aware(parsed)
+            queryset = queryset.filter(**{lookup: parsed})
+
+        content = iter_ndjson(queryset)
+        filename = f'channel-{channel.pk}.ndjson'
+        content_type = 'application/x-ndjson'
+        if request.query_params.get('compress') == 'gzip':
+            content = iter_gzip(content)
+            filename += '.gz'
+            content_type = 'application/gzip'
+        if isinstance(request._request, ASGIRequest):
+            content = aiter_chunks(content)
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
 
 
 class BlockUserGloballyView(APIView):
@@ -89,7 +268,9 @@ class BlockUserGloballyView(APIView):
         try:
             user = User.objects.get(pk=user_id)
             user.is_blocked = True
+            # Revoked and invalidated in every channel of the user by chat.signals.user_saved
             user.save()
+            kick_users(list(user.channels.values_list('id', flat=True)), [user.id])
             return Response(data=UserSerializer(user).data, status=status.HTTP_200_OK)
         except User.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
@@ -13,13 +13,18 @@ from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
-from chat.middleware import JWTAuthMiddleware
-from chat_api import routing
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_api.settings')
+# Read by the settings to pick connection defaults fit for ASGI
+os.environ.setdefault('CHAT_SERVER', 'asgi')
+
+# Set up Django before importing code that touches settings or models.
+django_asgi_app = get_asgi_application()
+
+from chat.middleware import JWTAuthMiddleware  # noqa: E402
+from chat_api import routing  # noqa: E402
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": JWTAuthMiddleware(
         URLRouter(
             routing.websocket_urlpatterns
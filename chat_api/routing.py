@@ -4,4 +4,5 @@ from chat import consumers
 
 websocket_urlpatterns = [
     path('ws/chat/<int:channel_id>', consumers.ChatConsumer.as_asgi()),
+    path('ws/chat/', consumers.MultiplexChatConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -9,10 +9,13 @@ https://docs.djangoproject.com/en/5.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
+import json
 import os
 from datetime import timedelta
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -45,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,11 +86,37 @@ REST_FRAMEWORK = {
 WSGI_APPLICATION = 'chat_api.wsgi.application'
 ASGI_APPLICATION = 'chat_api.asgi.application'
 
+
+def redis_host(entry):
+    if '://' in entry:
+        return entry
+    host, port = entry.rsplit(':', 1) if ':' in entry else (entry, '6379')
+    if not host or not port.isdigit():
+        raise ImproperlyConfigured(f'REDIS_HOSTS entry {entry!r} is not host[:port] or a redis:// URL.')
+    return host, int(port)
+
+
+# REDIS_HOSTS is a comma separated list of host[:port] entries (6379 by default)
+# or redis:// URLs. Groups are spread over them with consistent hashing,
+# CHANNEL_LAYER selects the list-based ('core') or the pub/sub ('pubsub') Redis layer.
+REDIS_HOSTS = [
+    redis_host(entry.strip())
+    for entry in os.getenv(
+        'REDIS_HOSTS', f"{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', '6379')}"
+    ).split(',')
+    if entry.strip()
+]
+
+CHANNEL_LAYER_BACKENDS = {
+    'core': 'chat.layers.ShardedRedisChannelLayer',
+    'pubsub': 'chat.layers.ShardedRedisPubSubChannelLayer',
+}
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': CHANNEL_LAYER_BACKENDS[os.getenv('CHANNEL_LAYER', 'core')],
         'CONFIG': {
-            'hosts': [(os.getenv('REDIS_HOST', 'localhost'), 6379)],
+            'hosts': REDIS_HOSTS,
         }
     }
 }
@@ -106,11 +136,22 @@ SIMPLE_JWT = {
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': SECRET_KEY,
     'AUTH_HEADER_TYPES': ('Bearer',),
+    'TOKEN_OBTAIN_SERIALIZER': 'chat.serializers.ChatTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'chat.serializers.ChatTokenRefreshSerializer',
 }
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# DB_POOL=true keeps a psycopg connection pool per process, sized per service
+# (gunicorn worker, daphne with its CHAT_DB_EXECUTOR_WORKERS threads). Without
+# it connections are kept for DB_CONN_MAX_AGE seconds and checked before reuse.
+# Under ASGI (CHAT_SERVER=asgi, set by chat_api/asgi.py) every HTTP request
+# runs in a thread of its own, so a kept connection outlives its thread: the
+# pool is on by default there, and DB_CONN_MAX_AGE defaults to 0 without it.
+ASGI_SERVER = os.getenv('CHAT_SERVER') == 'asgi'
+DB_POOL = os.getenv('DB_POOL', 'true' if ASGI_SERVER else 'false').lower() == 'true'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -119,8 +160,19 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD', 'password'),
         'HOST': os.getenv('DB_HOST', 'localhost'),
         'PORT': os.getenv('DB_PORT', '5432'),
+        'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv('DB_CONN_MAX_AGE', '0' if ASGI_SERVER else '60')),
+        'CONN_HEALTH_CHECKS': not DB_POOL,
+        'OPTIONS': {},
     }
 }
+if DB_POOL:
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+        # Seconds before an idle connection above min_size is closed.
+        'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', '600')),
+    }
 
 
 # Password validation
@@ -165,3 +217,127 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Chat
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', '100000'))
+MEMBERSHIP_CACHE_TTL = int(os.getenv('MEMBERSHIP_CACHE_TTL', '300'))
+
+# Write-behind mode batches message INSERTs per process. MESSAGE_WRITE_BEHIND_ACK
+# is 'flush' (fan out once the batch is committed) or 'immediate' (fan out
+# before the write, messages carry no id).
+MESSAGE_WRITE_BEHIND = os.getenv('MESSAGE_WRITE_BEHIND', 'false').lower() == 'true'
+MESSAGE_WRITE_BEHIND_ACK = os.getenv('MESSAGE_WRITE_BEHIND_ACK', 'flush')
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv('MESSAGE_FLUSH_INTERVAL_MS', '20'))
+MESSAGE_FLUSH_BATCH_SIZE = int(os.getenv('MESSAGE_FLUSH_BATCH_SIZE', '500'))
+
+MESSAGE_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', '50'))
+MESSAGE_PAGE_MAX_SIZE = int(os.getenv('MESSAGE_PAGE_MAX_SIZE', '200'))
+
+CHANNEL_PAGE_SIZE = int(os.getenv('CHANNEL_PAGE_SIZE', '50'))
+CHANNEL_PAGE_MAX_SIZE = int(os.getenv('CHANNEL_PAGE_MAX_SIZE', '200'))
+
+MESSAGE_EXPORT_CHUNK_SIZE = int(os.getenv('MESSAGE_EXPORT_CHUNK_SIZE', '2000'))
+
+# Default retention of channels without their own retention_days, 0 keeps messages forever.
+CHAT_RETENTION_DAYS = int(os.getenv('CHAT_RETENTION_DAYS', '0'))
+CHAT_ARCHIVE_BATCH_SIZE = int(os.getenv('CHAT_ARCHIVE_BATCH_SIZE', '1000'))
+
+# Text search configuration of message_content_search_idx (Postgres only).
+# Migration 0003 builds the index with 'simple', changing it needs a migration
+# rebuilding the index with the new configuration.
+CHAT_SEARCH_CONFIG = os.getenv('CHAT_SEARCH_CONFIG', 'simple')
+CHAT_SEARCH_MAX_LENGTH = int(os.getenv('CHAT_SEARCH_MAX_LENGTH', '256'))
+
+# Frames queued per socket before new ones are dropped with a lagged notice, 0 sends
+# inline. Sockets still dropping after CHAT_OUTBOUND_LAG_TIMEOUT seconds are closed.
+CHAT_OUTBOUND_HIGH_WATER = int(os.getenv('CHAT_OUTBOUND_HIGH_WATER', '256'))
+CHAT_OUTBOUND_LAG_TIMEOUT = float(os.getenv('CHAT_OUTBOUND_LAG_TIMEOUT', '30'))
+
+# Reconnects with since=<message id> get the missed messages in chunks, up to
+# CHAT_RESYNC_MAX_MESSAGES; further behind they are sent to REST history.
+CHAT_RESYNC_CHUNK_SIZE = int(os.getenv('CHAT_RESYNC_CHUNK_SIZE', '100'))
+CHAT_RESYNC_MAX_MESSAGES = int(os.getenv('CHAT_RESYNC_MAX_MESSAGES', '1000'))
+
+# Messages sent over WebSocket are added to Channel.message_count once per channel per
+# interval instead of in their insert, so unread counts lag by up to this much.
+CHAT_UNREAD_FLUSH_INTERVAL_MS = int(os.getenv('CHAT_UNREAD_FLUSH_INTERVAL_MS', '1000'))
+
+# Channels one ws/chat/ connection may subscribe to.
+CHAT_MULTIPLEX_MAX_CHANNELS = int(os.getenv('CHAT_MULTIPLEX_MAX_CHANNELS', '100'))
+
+# Recent history served in the welcome frame. The local backend keeps a copy per
+# ASGI process, fed by the channel layer events of messages sent through other
+# processes and dropped on edits, deletes and archiving in any process, and only
+# while the channel has local sockets. Redis keeps one copy for all workers.
+CHAT_HISTORY_LENGTH = int(os.getenv('CHAT_HISTORY_LENGTH', '20'))
+CHAT_HISTORY_TTL = int(os.getenv('CHAT_HISTORY_TTL', '3600'))
+if os.getenv('CHAT_HISTORY_BACKEND', 'local') == 'redis':
+    CHAT_HISTORY_BACKEND = 'chat.history.RedisHistory'
+    CHAT_HISTORY_OPTIONS = {
+        'url': os.getenv('CHAT_HISTORY_REDIS_URL', f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/1"),
+    }
+else:
+    CHAT_HISTORY_BACKEND = 'chat.history.LocalHistory'
+    CHAT_HISTORY_OPTIONS = {
+        'max_channels': int(os.getenv('CHAT_HISTORY_MAX_CHANNELS', '10000')),
+    }
+
+# Online users per channel and typing notifications, never stored in the
+# database. Use the redis backend with several ASGI workers. Typing and
+# join/leave changes are sent at most once per CHAT_PRESENCE_INTERVAL_MS.
+CHAT_PRESENCE_TTL = int(os.getenv('CHAT_PRESENCE_TTL', '60'))
+CHAT_PRESENCE_INTERVAL_MS = int(os.getenv('CHAT_PRESENCE_INTERVAL_MS', '500'))
+if os.getenv('CHAT_PRESENCE_BACKEND', 'local') == 'redis':
+    CHAT_PRESENCE_BACKEND = 'chat.presence.RedisPresence'
+    CHAT_PRESENCE_OPTIONS = {
+        'url': os.getenv('CHAT_PRESENCE_REDIS_URL', f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/3"),
+    }
+else:
+    CHAT_PRESENCE_BACKEND = 'chat.presence.LocalPresence'
+    CHAT_PRESENCE_OPTIONS = {}
+
+# Token bucket per user and channel on the WebSocket receive path: 'rate'
+# messages per second on average, bursts of up to 'burst'. A rate of 0 turns
+# the limit off. CHAT_RATE_LIMIT_CHANNELS overrides it per channel id, e.g.
+# '{"42": {"rate": 1, "burst": 3}}'.
+CHAT_RATE_LIMIT = {
+    'rate': float(os.getenv('CHAT_RATE_LIMIT_RATE', '5')),
+    'burst': int(os.getenv('CHAT_RATE_LIMIT_BURST', '10')),
+}
+CHAT_RATE_LIMIT_CHANNELS = json.loads(os.getenv('CHAT_RATE_LIMIT_CHANNELS', '{}'))
+# Subscribe and unsubscribe frames of the multiplexed socket, per user. Each
+# one checks permissions and loads histories of up to CHAT_MULTIPLEX_MAX_CHANNELS.
+CHAT_SUBSCRIBE_RATE_LIMIT = {
+    'rate': float(os.getenv('CHAT_SUBSCRIBE_RATE_LIMIT_RATE', '1')),
+    'burst': int(os.getenv('CHAT_SUBSCRIBE_RATE_LIMIT_BURST', '5')),
+}
+CHAT_RATE_LIMIT_EXEMPT_MODERATORS = os.getenv('CHAT_RATE_LIMIT_EXEMPT_MODERATORS', 'true').lower() == 'true'
+if os.getenv('CHAT_RATE_LIMIT_BACKEND', 'local') == 'redis':
+    CHAT_RATE_LIMIT_BACKEND = 'chat.ratelimit.RedisRateLimiter'
+    CHAT_RATE_LIMIT_OPTIONS = {
+        'url': os.getenv('CHAT_RATE_LIMIT_REDIS_URL', f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/2"),
+    }
+else:
+    CHAT_RATE_LIMIT_BACKEND = 'chat.ratelimit.LocalRateLimiter'
+    CHAT_RATE_LIMIT_OPTIONS = {
+        'max_buckets': int(os.getenv('CHAT_RATE_LIMIT_MAX_BUCKETS', '100000')),
+    }
+
+# 'auto' uses orjson when it is installed, 'orjson' requires it, 'json' is stdlib.
+CHAT_JSON_ENCODER = os.getenv('CHAT_JSON_ENCODER', 'auto')
+
+# Group events sent from views and signals (kicks, cache invalidation) go
+# through a background thread ('background') or block the request ('inline').
+CHAT_EVENT_DISPATCH = os.getenv('CHAT_EVENT_DISPATCH', 'background')
+
+# Worker threads for database calls of consumers. 0 keeps asgiref's default
+# of a single shared thread, otherwise size it like the database pool.
+CHAT_DB_EXECUTOR_WORKERS = int(os.getenv('CHAT_DB_EXECUTOR_WORKERS', '0'))
+
+# Prometheus metrics of the current process on /metrics, restrict access to it
+# at the proxy.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+
+JWT_CACHE_SIZE = int(os.getenv('JWT_CACHE_SIZE', '50000'))
+JWT_CACHE_TTL = int(os.getenv('JWT_CACHE_TTL', '300'))
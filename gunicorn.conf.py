@@ -0,0 +1,21 @@
+"""
+Gunicorn settings, read from the working directory. With PROMETHEUS_MULTIPROC_DIR
+set every worker writes its metrics there and /metrics serves them summed over
+the workers, see chat.metrics.get_registry.
+"""
+import os
+import shutil
+
+
+def on_starting(server):
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        # Files of a previous run would be added to this one's values
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)